@@ -1,13 +1,205 @@
 
 import anthill.common.admin as a
 
+import time
+
 
 class RootAdminController(a.AdminController):
+    # metric -> title, see Metrics.summary
+    TIMERS = [
+        ("http_request_duration_seconds", "Handlers"),
+        ("model_method_duration_seconds", "Model methods"),
+        ("db_statement_duration_seconds", "Database statements"),
+        ("cache_command_duration_seconds", "Cache commands"),
+        ("internal_request_duration_seconds", "Requests to other services"),
+        ("social_api_duration_seconds", "Social network APIs")
+    ]
+
+    COUNTERS = [
+        ("cache_hits_total", "Cache hits"),
+        ("cache_misses_total", "Cache misses"),
+        ("db_commits_total", "Transactions")
+    ]
+
+    async def get(self):
+        metrics = self.application.metrics
+
+        if metrics is None:
+            return {}
+
+        return {
+            "timers": [
+                (title, metrics.summary(name))
+                for name, title in RootAdminController.TIMERS
+            ],
+            "counters": [
+                (title, metrics.counter_summary(name))
+                for name, title in RootAdminController.COUNTERS
+            ]
+        }
+
     def render(self, data):
-        return [
-            a.notice("Not implemented", "Not implemented yet.")
+        if "timers" not in data:
+            return [
+                a.notice("Metrics are disabled", "Turn on the 'metrics' option to see what the service is busy with.")
+            ]
+
+        result = [
+            a.notice("Metrics", "Since the service has started, the most time consuming first. "
+                                "The same metrics are available in the Prometheus format at /metrics."),
+            a.links("Navigate", [
+                a.link("traces", "Slow requests", icon="clock-o")
+            ])
         ]
 
+        for title, items in data["timers"]:
+            result.append(a.content(title, [
+                {"id": "labels", "title": "Labels"},
+                {"id": "count", "title": "Calls"},
+                {"id": "errors", "title": "Errors"},
+                {"id": "total", "title": "Total, ms"},
+                {"id": "avg", "title": "Average, ms"},
+                {"id": "p50", "title": "p50, ms"},
+                {"id": "p99", "title": "p99, ms"}
+            ], [
+                {
+                    "labels": item["labels"],
+                    "count": str(item["count"]),
+                    "errors": str(item["errors"]),
+                    "total": "{0:.1f}".format(item["total"]),
+                    "avg": "{0:.2f}".format(item["avg"]),
+                    "p50": "<= {0:g}".format(item["p50"]),
+                    "p99": "<= {0:g}".format(item["p99"])
+                }
+                for item in items
+            ], "primary"))
+
+        for title, items in data["counters"]:
+            result.append(a.content(title, [
+                {"id": "labels", "title": "Labels"},
+                {"id": "value", "title": "Count"}
+            ], [
+                {
+                    "labels": item["labels"],
+                    "value": str(item["value"])
+                }
+                for item in items
+            ], "primary"))
+
+        return result
+
+    def access_scopes(self):
+        return ["social_admin"]
+
+
+class TracesAdminController(a.AdminController):
+    async def get(self):
+        tracer = self.application.tracer
+
+        if tracer is None:
+            return {}
+
+        return {
+            "threshold": tracer.threshold,
+            "traces": tracer.recent()
+        }
+
+    def render(self, data):
+        result = [
+            a.breadcrumbs([
+                a.link("index", "Social")
+            ], "Slow requests")
+        ]
+
+        if "traces" not in data:
+            result.append(a.notice(
+                "Tracing is disabled", "Set the 'trace_threshold' option (and turn on 'metrics') "
+                                       "to keep traces of slow requests."))
+            return result
+
+        result.append(a.content("Requests that took longer than {0:g} ms, the most recent first".format(
+            data["threshold"] * 1000.0), [
+                {"id": "time", "title": "Time"},
+                {"id": "name", "title": "Request"},
+                {"id": "duration", "title": "Duration, ms"},
+                {"id": "spans", "title": "Spans"}
+            ], [
+                {
+                    "time": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(trace["time"])),
+                    "name": [a.link("trace", trace["name"], icon="clock-o", trace=trace["id"])],
+                    "duration": "{0:.1f}".format(trace["duration"]),
+                    "spans": str(trace["spans"])
+                }
+                for trace in data["traces"]
+            ], "primary"))
+
+        return result
+
     def access_scopes(self):
         return ["social_admin"]
 
+
+class TraceAdminController(a.AdminController):
+    async def get(self, trace):
+        tracer = self.application.tracer
+
+        try:
+            trace_id = int(trace)
+        except (TypeError, ValueError):
+            raise a.ActionError("Bad trace")
+
+        data = tracer.get(trace_id) if tracer is not None else None
+
+        if data is None:
+            raise a.ActionError("No such trace (traces are only kept for a while)")
+
+        return {
+            "trace": data
+        }
+
+    @staticmethod
+    def __flatten__(span, depth, result):
+        result.append((depth, span))
+
+        for child in span["children"]:
+            TraceAdminController.__flatten__(child, depth + 1, result)
+
+        return result
+
+    def render(self, data):
+        trace = data["trace"]
+
+        spans = [
+            {
+                "name": ". " * depth + span["name"],
+                "start": "{0:.1f}".format(span["start"]),
+                "duration": "{0:.1f}".format(span["duration"]),
+                "error": "yes" if span["error"] else "",
+                "tags": ", ".join("{0}={1}".format(key, value) for key, value in sorted(span["tags"].items()))
+            }
+            for depth, span in TraceAdminController.__flatten__(trace["root"], 0, [])
+        ]
+
+        result = [
+            a.breadcrumbs([
+                a.link("index", "Social"),
+                a.link("traces", "Slow requests")
+            ], trace["name"]),
+            a.content("Spans", [
+                {"id": "name", "title": "Span"},
+                {"id": "start", "title": "Start, ms"},
+                {"id": "duration", "title": "Duration, ms"},
+                {"id": "error", "title": "Error"},
+                {"id": "tags", "title": "Tags"}
+            ], spans, "primary")
+        ]
+
+        if trace["dropped"]:
+            result.append(a.notice("Incomplete", "{0} more spans were not recorded.".format(trace["dropped"]),
+                                   style="warning"))
+
+        result.append(a.json_view(trace))
+        return result
+
+    def access_scopes(self):
+        return ["social_admin"]
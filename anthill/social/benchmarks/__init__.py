@@ -0,0 +1,6 @@
+"""
+Standalone benchmarks, run them as modules, for example:
+
+    python -m anthill.social.benchmarks.name_index
+    python -m anthill.social.benchmarks.load
+"""
@@ -0,0 +1,297 @@
+"""
+Load test of the hot paths of SocialServer, over HTTP, with scripted scenarios: friends listing, a group join storm,
+    group join requests approval, and unique names search. Reports latency percentiles, throughput, and database
+    statements and commits per request (from the service's own metrics).
+
+    python -m anthill.social.benchmarks.load --accounts 1000 --concurrency 50 --db_host=127.0.0.1
+
+The server runs against MySQL and redis configured the same way as for the tests (the 'test' database is recreated),
+    other services, the message queue and the social networks are local stand-ins, see stubs.py.
+    Unknown arguments are passed to the service as options.
+"""
+
+from tornado.gen import multi
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+from anthill.common import sign
+from anthill.common.access import AccessToken
+from anthill.common.gen import AccessTokenGenerator
+from anthill.common.internal import Internal
+from anthill.common.options import options
+from anthill.common.testing import ServerTestCase
+
+from anthill.social.server import SocialServer
+from anthill.social.model.group import GroupFlags, GroupJoinMethod, GroupsModel
+from anthill.social.benchmarks.name_index import generate_name, percentile
+from anthill.social.benchmarks.stubs import FakeServices, FakeSubscriber, SocialNetworks
+
+from urllib import parse
+
+import argparse
+import datetime
+import random
+import sys
+import time
+import ujson
+
+
+TESTING_KEY = "m233TJDKgFdW8HbSwFh3B5DgatTMZDgH"
+SCOPES = ["group", "group_create", "names", "names_write"]
+SCENARIOS = ["friends", "join_storm", "approval", "names"]
+NAME_KIND = "nickname"
+
+
+class BenchmarkServer(SocialServer):
+    def init_discovery(self):
+        pass
+
+    async def acquire_subscriber(self):
+        if self.subscriber is None:
+            self.subscriber = FakeSubscriber()
+
+        return self.subscriber
+
+
+class LoadTest(object):
+    def __init__(self, application, host, gamespace_id, args):
+        self.application = application
+        self.host = host
+        self.gamespace_id = gamespace_id
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.client = AsyncHTTPClient(force_instance=True, max_clients=args.concurrency)
+        self.tokens = {}
+        # accounts are 1..accounts, the owner of the groups is the one after
+        self.accounts = list(range(1, args.accounts + 1))
+        self.owner = args.accounts + 1
+
+    async def token(self, account_id):
+        token = self.tokens.get(account_id)
+
+        if token is None:
+            token = AccessTokenGenerator.generate(sign.TOKEN_SIGNATURE_HMAC, SCOPES, additional_containers={
+                AccessToken.ACCOUNT: str(account_id),
+                AccessToken.GAMESPACE: str(self.gamespace_id)
+            }, token_only=True)
+
+            await self.application.token_cache.store_token_no_db(AccessToken(token))
+            self.tokens[account_id] = token
+
+        return token
+
+    def counters(self):
+        metrics = self.application.metrics
+
+        statements = sum(
+            histogram.count
+            for histogram in metrics.histograms.get("db_statement_duration_seconds", {}).values())
+        commits = sum(metrics.counters.get("db_commits_total", {}).values())
+
+        return statements, commits
+
+    async def __call__(self, account_id, method, path, arguments):
+        arguments = dict(arguments, access_token=await self.token(account_id))
+
+        if method == "GET":
+            request = HTTPRequest(self.host + path + "?" + parse.urlencode(arguments))
+        else:
+            request = HTTPRequest(self.host + path, method=method, body=parse.urlencode(arguments))
+
+        started = time.perf_counter()
+        response = await self.client.fetch(request, raise_error=False)
+        return time.perf_counter() - started, response
+
+    async def run(self, title, calls):
+        """
+        Makes the calls (account_id, method, path, arguments), `concurrency` at a time, and reports how it went
+
+        :returns a list of the responses, in the order of the calls
+        """
+
+        # tokens are not a part of the measurement
+        for account_id, method, path, arguments in calls:
+            await self.token(account_id)
+
+        responses = [None] * len(calls)
+        timings = []
+        errors = []
+        pending = iter(enumerate(calls))
+
+        async def worker():
+            for index, (account_id, method, path, arguments) in pending:
+                timing, response = await self(account_id, method, path, arguments)
+                timings.append(timing)
+                responses[index] = response
+
+                if response.code >= 400:
+                    errors.append("{0} {1}: {2}".format(response.code, path, response.body))
+
+        statements, commits = self.counters()
+        started = time.perf_counter()
+
+        await multi([worker() for i in range(self.args.concurrency)])
+
+        elapsed = time.perf_counter() - started
+        statements_after, commits_after = self.counters()
+
+        print("{0:<20} {1:6} req {2:5} err {3:9.1f} req/s  p50 {4:8.2f}ms  p99 {5:8.2f}ms  "
+              "{6:6.1f} queries/req  {7:5.2f} commits/req".format(
+                title, len(calls), len(errors), len(calls) / elapsed,
+                percentile(timings, 0.5) * 1000, percentile(timings, 0.99) * 1000,
+                (statements_after - statements) / len(calls), (commits_after - commits) / len(calls)))
+
+        for error in errors[:3]:
+            print("    " + error)
+
+        return responses
+
+    async def friends(self):
+        tokens = self.application.tokens
+        expires_at = datetime.datetime.now() + datetime.timedelta(days=1)
+
+        for account_id in self.accounts:
+            for credential, username, access_token in [
+                    ("facebook", "fb" + str(account_id), "fb-" + str(account_id)),
+                    ("vk", str(account_id), "vk-" + str(account_id))]:
+                await tokens.update_token(self.gamespace_id, credential, username, access_token, expires_at, {})
+                await tokens.attach(self.gamespace_id, credential, username, account_id)
+
+        # and a couple of friends made in game
+        await self.application.connections.create_many(self.gamespace_id, [
+            [account_id, self.accounts[(account_id + offset) % len(self.accounts)]]
+            for account_id in self.accounts
+            for offset in (self.args.friends + 1, self.args.friends + 2)
+        ])
+
+        calls = [(account_id, "GET", "/connections", {}) for account_id in self.accounts]
+
+        await self.run("friends (cold)", calls)
+        await self.run("friends (cached)", calls)
+
+    async def join_storm(self):
+        calls = []
+
+        # everyone joins one of a few groups at once
+        group_size = GroupsModel.MAX_MEMBERS_LIMIT - 1
+
+        for first in range(0, len(self.accounts), group_size):
+            group_id = await self.application.groups.create_group(
+                self.gamespace_id, {}, GroupFlags([GroupFlags.MESSAGE_SUPPORT]),
+                GroupJoinMethod(GroupJoinMethod.FREE), GroupsModel.MAX_MEMBERS_LIMIT, self.owner, {})
+
+            calls.extend(
+                (account_id, "POST", "/group/{0}/join".format(group_id), {"participation_profile": "{}"})
+                for account_id in self.accounts[first:first + group_size])
+
+        self.rnd.shuffle(calls)
+        await self.run("group join storm", calls)
+
+    async def approval(self):
+        group_id = await self.application.groups.create_group(
+            self.gamespace_id, {}, GroupFlags([GroupFlags.MESSAGE_SUPPORT]),
+            GroupJoinMethod(GroupJoinMethod.APPROVE), GroupsModel.MAX_MEMBERS_LIMIT, self.owner, {})
+
+        accounts = self.accounts[:GroupsModel.MAX_MEMBERS_LIMIT - 1]
+
+        responses = await self.run("group join requests", [
+            (account_id, "POST", "/group/{0}/request".format(group_id), {"participation_profile": "{}"})
+            for account_id in accounts
+        ])
+
+        await self.run("request approval", [
+            (self.owner, "POST", "/group/{0}/approve/{1}".format(group_id, account_id), {
+                "role": "0",
+                "key": ujson.loads(response.body)["key"],
+                "permissions": "[]"
+            })
+            for account_id, response in zip(accounts, responses)
+            if response.code == 200
+        ])
+
+    async def names(self):
+        names = [generate_name(self.rnd) + " " + str(account_id) for account_id in self.accounts]
+
+        await self.run("name acquire", [
+            (account_id, "POST", "/names/acquire/" + NAME_KIND, {"name": name})
+            for account_id, name in zip(self.accounts, names)
+        ])
+
+        await self.run("name search", [
+            (self.rnd.choice(self.accounts), "GET", "/names/search/" + NAME_KIND, {
+                "query": self.rnd.choice(names)[:self.rnd.randint(2, 5)]
+            })
+            for i in range(self.args.searches)
+        ])
+
+
+async def run(args):
+    services = FakeServices(latency=args.service_latency / 1000.0)
+    services.install(Internal())
+
+    networks = SocialNetworks(args.accounts, args.friends, latency=args.api_latency / 1000.0)
+    networks.start()
+
+    AccessToken.init([sign.HMACAccessTokenSignature(key=TESTING_KEY)])
+
+    db = await ServerTestCase.get_test_db()
+    application = BenchmarkServer(db)
+    networks.install(application.social)
+
+    await application.started()
+
+    sock, port = bind_unused_port()
+    http_server = HTTPServer(application)
+    http_server.add_sockets([sock])
+
+    # a fresh gamespace every run, so nothing is cached from the previous ones
+    gamespace_id = random.randint(1000, 1000000)
+    load = LoadTest(application, "http://127.0.0.1:{0}".format(port), gamespace_id, args)
+
+    print("{0} accounts, {1} friends each, {2} concurrent requests, gamespace {3}".format(
+        args.accounts, args.friends, args.concurrency, gamespace_id))
+
+    try:
+        for scenario in args.scenarios.split(","):
+            await getattr(load, scenario.strip())()
+    finally:
+        http_server.stop()
+        networks.stop()
+        await application.process_shutdown()
+
+    print("social network requests: {0}, requests to other services: {1}".format(
+        networks.requests, ", ".join(
+            "{0}.{1} {2}".format(service, method, count)
+            for (service, method), count in sorted(services.calls.items()))))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="SocialServer load test", epilog="Other arguments are passed to the service as options.")
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--friends", type=int, default=50, help="social network friends of every account")
+    parser.add_argument("--searches", type=int, default=1000)
+    parser.add_argument("--service-latency", type=float, default=2, help="of the other services, ms")
+    parser.add_argument("--api-latency", type=float, default=50, help="of the social networks, ms")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=1)
+    args, service_args = parser.parse_known_args()
+
+    for scenario in args.scenarios.split(","):
+        if scenario.strip() not in SCENARIOS:
+            parser.error("Unknown scenario: {0}, known ones are: {1}".format(scenario, ", ".join(SCENARIOS)))
+
+    options.parse_command_line([sys.argv[0]] + service_args)
+    options.parse_env()
+
+    # queries per request are counted by the metrics
+    options.metrics = True
+
+    IOLoop.current().run_sync(lambda: run(args))
+
+
+if __name__ == "__main__":
+    main()
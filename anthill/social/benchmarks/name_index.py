@@ -0,0 +1,95 @@
+"""
+Benchmarks NameIndex (used by NamesModel.search_names and GroupsModel.search_groups) against generated names.
+
+    python -m anthill.social.benchmarks.name_index --names 1000000
+"""
+
+from anthill.social.model.nameindex import NameIndex
+
+import argparse
+import random
+import string
+import time
+
+
+SYLLABLES = [
+    "ka", "ri", "to", "na", "mi", "ro", "sa", "ke", "lu", "vo", "dra", "gon", "fi", "re", "zen", "tar",
+    "shi", "mo", "bel", "wyn", "ash", "or", "th", "el", "qu", "ix", "ur", "an"
+]
+
+
+def generate_name(rnd):
+    words = []
+    for i in range(rnd.randint(1, 3)):
+        words.append("".join(rnd.choice(SYLLABLES) for j in range(rnd.randint(1, 4))))
+    if rnd.random() < 0.3:
+        words.append(str(rnd.randint(0, 9999)))
+    return " ".join(words).title()
+
+
+def percentile(timings, p):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * p))]
+
+
+def measure(index, bucket, queries, limit, offset=0):
+    timings = []
+    found = 0
+
+    for query in queries:
+        started = time.perf_counter()
+        found += len(index.search(bucket, query, limit, offset=offset))
+        timings.append(time.perf_counter() - started)
+
+    return timings, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NameIndex benchmark")
+    parser.add_argument("--names", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    bucket = (1, "nickname")
+
+    names = [generate_name(rnd) for i in range(args.names)]
+
+    index = NameIndex()
+
+    started = time.perf_counter()
+    for account_id, name in enumerate(names, 1):
+        index.add(bucket, account_id, name, defer=True)
+    index.sort()
+    print("build: {0} names in {1:.2f}s".format(index.size(), time.perf_counter() - started))
+
+    samples = [rnd.choice(names) for i in range(args.queries)]
+
+    scenarios = [
+        ("prefix (2 chars)", [name[:2] for name in samples]),
+        ("prefix (4 chars)", [name[:4] for name in samples]),
+        ("infix", [name.split(" ")[0][1:5] for name in samples]),
+        ("full name", samples),
+        ("no match", ["".join(rnd.choice(string.ascii_lowercase) for j in range(6)) for i in samples]),
+    ]
+
+    for title, queries in scenarios:
+        timings, found = measure(index, bucket, queries, args.limit)
+        print("{0:<18} p50 {1:8.2f}ms  p99 {2:8.2f}ms  avg results {3:.1f}".format(
+            title, percentile(timings, 0.5) * 1000, percentile(timings, 0.99) * 1000, found / len(queries)))
+
+    timings, found = measure(index, bucket, [name[:4] for name in samples], args.limit, offset=args.limit * 4)
+    print("{0:<18} p50 {1:8.2f}ms  p99 {2:8.2f}ms".format(
+        "page 5", percentile(timings, 0.5) * 1000, percentile(timings, 0.99) * 1000))
+
+    started = time.perf_counter()
+    for account_id in range(1, min(args.names, 10000) + 1):
+        index.add(bucket, account_id, names[account_id - 1] + " x")
+    print("rename: {0:.3f}ms per name".format(
+        (time.perf_counter() - started) * 1000 / min(args.names, 10000)))
+
+
+if __name__ == "__main__":
+    main()
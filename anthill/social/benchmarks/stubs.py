@@ -0,0 +1,176 @@
+"""
+Local stand-ins for everything SocialServer talks to, apart from MySQL and redis: other services of the environment
+    (profile, message, login), the message queue and the social networks (Facebook, VK).
+"""
+
+from tornado.gen import sleep
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
+
+import ujson
+
+
+class FakeServices(object):
+    """
+    Answers requests to other services (replaces Internal.request and Internal.rpc), after `latency` seconds
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        # (service, method) -> number of calls
+        self.calls = {}
+
+    async def request(self, service, method, timeout=None, *args, **kwargs):
+        self.calls[(service, method)] = self.calls.get((service, method), 0) + 1
+
+        if self.latency:
+            await sleep(self.latency)
+
+        if (service, method) == ("profile", "mass_profiles"):
+            return {
+                account: {"name": "Player " + str(account)}
+                for account in kwargs.get("accounts", [])
+            }
+
+        if (service, method) == ("login", "get_key"):
+            return {
+                "client_id": "benchmark",
+                "client_secret": "benchmark"
+            }
+
+        # message service: create_group, join_group, send_message etc
+        return {}
+
+    async def rpc(self, service, method, *args, **kwargs):
+        self.calls[(service, method)] = self.calls.get((service, method), 0) + 1
+
+    # noinspection PyUnusedLocal
+    async def listen(self, service_name, on_receive):
+        pass
+
+    async def stop(self):
+        pass
+
+    def install(self, internal_):
+        """
+        Replaces the methods of the Internal singleton, should be done before the server is created
+            (so the metrics wrap these)
+        """
+
+        internal_.request = self.request
+        internal_.rpc = self.rpc
+        internal_.listen = self.listen
+        internal_.stop = self.stop
+
+
+class FakeSubscriber(object):
+    """
+    A pub/sub subscriber that never receives anything (instead of the RabbitMQ one)
+    """
+
+    async def handle(self, channel, callback):
+        pass
+
+    async def start(self):
+        pass
+
+    async def release(self):
+        pass
+
+
+class SocialNetworks(object):
+    """
+    A local HTTP server that answers the friends lists of Facebook and VK. Friends of a user are the next `friends`
+        users (by their number), a user number is a part of the access token: "fb-<number>", "vk-<number>".
+    """
+
+    def __init__(self, users, friends, latency=0):
+        self.users = users
+        self.friends = friends
+        self.latency = latency
+        self.requests = 0
+        self.http_server = None
+        self.url = None
+
+    def friends_of(self, user):
+        return [(user - 1 + i) % self.users + 1 for i in range(1, self.friends + 1)]
+
+    def start(self):
+        networks = self
+
+        class FacebookFriendsHandler(RequestHandler):
+            async def get(self):
+                user = await networks.__user__(self.get_argument("access_token"), "fb-")
+
+                self.write(ujson.dumps({
+                    "data": [
+                        {"id": "fb" + str(friend), "name": "Friend " + str(friend)}
+                        for friend in networks.friends_of(user)
+                    ]
+                }))
+
+        class VKFriendsHandler(RequestHandler):
+            async def get(self):
+                user = await networks.__user__(self.get_argument("access_token"), "vk-")
+
+                self.write(ujson.dumps({
+                    "response": {
+                        "items": [
+                            {"id": friend, "first_name": "Friend", "last_name": str(friend)}
+                            for friend in networks.friends_of(user)
+                        ]
+                    }
+                }))
+
+        sock, port = bind_unused_port()
+
+        self.http_server = HTTPServer(Application([
+            (r"/facebook/v2.5/me/friends", FacebookFriendsHandler),
+            (r"/vk/friends.get", VKFriendsHandler)
+        ]))
+
+        self.http_server.add_sockets([sock])
+        self.url = "http://127.0.0.1:{0}/".format(port)
+
+    def stop(self):
+        if self.http_server is not None:
+            self.http_server.stop()
+
+    async def __user__(self, access_token, prefix):
+        self.requests += 1
+
+        if self.latency:
+            await sleep(self.latency)
+
+        return int(access_token[len(prefix):])
+
+    def install(self, social):
+        """
+        Points the social network APIs of the SocialAPIModel to this server
+        """
+
+        social.api("facebook").client = RedirectingClient(
+            social.api("facebook").client, "https://graph.facebook.com/", self.url + "facebook/")
+        social.api("vk").client = RedirectingClient(
+            social.api("vk").client, "https://api.vk.com/method/", self.url + "vk/")
+
+
+class RedirectingClient(object):
+    """
+    An AsyncHTTPClient that sends requests to `origin` to `replacement` instead
+    """
+
+    def __init__(self, client, origin, replacement):
+        self.client = client
+        self.origin = origin
+        self.replacement = replacement
+
+    def fetch(self, request, *args, **kwargs):
+        if isinstance(request, str) and request.startswith(self.origin):
+            request = self.replacement + request[len(self.origin):]
+
+        return self.client.fetch(request, *args, **kwargs)
+
+    def __getattr__(self, item):
+        return getattr(self.client, item)
@@ -5,14 +5,15 @@ from anthill.common import to_int
 from anthill.common.internal import InternalError
 from anthill.common.social import APIError, AuthResponse
 from anthill.common.handler import AuthenticatedHandler
-from anthill.common.access import scoped, AccessToken, parse_scopes
+from anthill.common.access import scoped, internal, AccessToken, parse_scopes
 from anthill.common.validate import validate, validate_value, ValidationError
 
-from . model.request import RequestError, RequestType, NoSuchRequest
+from . model.request import RequestError, RequestType, NoSuchRequest, RequestsModel
 from . model.connection import ConnectionError, ConnectionsModel
 from . model.social import SocialNotFound, NoFriendsFound, SocialAuthenticationRequired
 from . model.group import GroupError, GroupsModel, GroupFlags, NoSuchGroup, NoSuchParticipation, GroupJoinMethod
-from . model.names import NameIsBusyError, NamesModelError
+from . model.names import NameIsBusyError, NamesModelError, NamesModel
+from . model.deletion import AccountDeletionsError
 
 import ujson
 
@@ -104,12 +105,20 @@ class RequestsHandler(AuthenticatedHandler):
             except (KeyError, ValueError, ValidationError):
                 raise HTTPError(400, "Corrupted profile_fields")
 
+        limit = to_int(self.get_argument("limit", None), None)
+        if limit is not None:
+            limit = max(1, min(limit, RequestsModel.MAX_TOTAL_LIMIT))
+        cursor = self.get_argument("cursor", None)
+
         try:
             requests = await requests.list_total_account_requests(
                 self.token.get(AccessToken.GAMESPACE),
-                self.token.account, profile_fields=profile_fields)
+                self.token.account, profile_fields=profile_fields,
+                limit=limit, cursor=cursor)
 
         except RequestError as e:
+            if e.code == 400:
+                raise HTTPError(400, e.message)
             raise HTTPError(401, e.message)
 
         result = {
@@ -119,6 +128,9 @@ class RequestsHandler(AuthenticatedHandler):
             ]
         }
 
+        if limit is not None and requests and len(requests) >= limit:
+            result["cursor"] = RequestsModel.cursor(requests[-1])
+
         self.dumps(result)
 
 
@@ -293,6 +305,28 @@ class InternalHandler(object):
 
         return account_id
 
+    @validate(gamespace="int", kind="str_name", names="json_list_of_strings")
+    async def check_names(self, gamespace, kind, names):
+        names_model = self.application.names
+
+        try:
+            result = await names_model.check_names(gamespace, kind, names)
+        except NamesModelError as e:
+            raise InternalError(e.code, e.message)
+
+        return result
+
+    @validate(gamespace="int", kind="str_name", base="str", count="int")
+    async def suggest_name(self, gamespace, kind, base, count=5):
+        names = self.application.names
+
+        try:
+            suggested = await names.suggest_name(gamespace, kind, base, count)
+        except NamesModelError as e:
+            raise InternalError(e.code, e.message)
+
+        return suggested
+
     async def release_name(self, gamespace, account, kind):
         names = self.application.names
 
@@ -356,6 +390,68 @@ class InternalHandler(object):
 
         return connections
 
+    @validate(deletion_id="int")
+    async def get_account_deletion(self, deletion_id):
+        try:
+            deletion = await self.application.deletions.get_deletion(deletion_id)
+        except AccountDeletionsError as e:
+            raise InternalError(e.code, e.message)
+
+        return deletion.dump()
+
+    @validate(gamespace="int", account_id="int", target_account="int")
+    async def are_connected(self, gamespace, account_id, target_account):
+        try:
+            connected = await self.application.connections.are_connected(gamespace, account_id, target_account)
+        except ConnectionError as e:
+            raise InternalError(e.code, e.message)
+
+        return connected
+
+    @validate(gamespace="int", account_id="int", target_accounts="json_list_of_ints")
+    async def are_connected_many(self, gamespace, account_id, target_accounts):
+        try:
+            connected = await self.application.connections.are_connected_many(
+                gamespace, account_id, target_accounts)
+        except ConnectionError as e:
+            raise InternalError(e.code, e.message)
+
+        return {
+            str(target_account): result
+            for target_account, result in connected.items()
+        }
+
+    @validate(gamespace="int", connections="json_list")
+    async def import_connections(self, gamespace, connections):
+        try:
+            created = await self.application.connections.create_many(gamespace, connections)
+        except ConnectionError as e:
+            raise InternalError(e.code, e.message)
+
+        return {
+            "created": created
+        }
+
+    @validate(gamespace="int", connections="json_list")
+    async def delete_connections(self, gamespace, connections):
+        try:
+            deleted = await self.application.connections.delete_many(gamespace, connections)
+        except ConnectionError as e:
+            raise InternalError(e.code, e.message)
+
+        return {
+            "deleted": deleted
+        }
+
+    @validate(gamespace="int", account_id="int")
+    async def count_connections(self, gamespace, account_id):
+        try:
+            count = await self.application.connections.count_connections(gamespace, account_id)
+        except ConnectionError as e:
+            raise InternalError(e.code, e.message)
+
+        return count
+
     async def get_group(self, gamespace, group_id):
 
         try:
@@ -397,32 +493,108 @@ class InternalHandler(object):
 
         return result
 
-    @validate(gamespace="int", group_id="int", profile="json_dict", path="json_list_of_strings", merge="bool")
-    async def update_group_profile(self, gamespace, group_id, profile, path=None, merge=True):
+    @validate(gamespace="int", group_id="int", profile="json_dict", path="json_list_of_strings", merge="bool",
+              server_side="bool", coalesced="bool")
+    async def update_group_profile(self, gamespace, group_id, profile, path=None, merge=True, server_side=False,
+                                   coalesced=False):
 
         try:
-            result = await self.application.groups.update_group_no_check(
-                gamespace, group_id, profile, path=path, merge=merge)
+            if coalesced:
+                result = await self.application.groups.update_group_coalesced(
+                    gamespace, group_id, profile, path=path, merge=merge)
+            else:
+                result = await self.application.groups.update_group_no_check(
+                    gamespace, group_id, profile, path=path, merge=merge, server_side=server_side)
         except GroupError as e:
             raise InternalError(e.code, e.message)
 
         return result
 
-    @validate(gamespace="int", group_profiles="json_dict", path="json_list_of_strings", merge="bool", synced="bool")
-    async def update_group_profiles(self, gamespace, group_profiles, path=None, merge=True, synced=False):
+    @validate(gamespace="int", group_profiles="json_dict", path="json_list_of_strings", merge="bool", synced="bool",
+              server_side="bool", report_failures="bool", coalesced="bool")
+    async def update_group_profiles(self, gamespace, group_profiles, path=None, merge=True, synced=False,
+                                    server_side=False, report_failures=False, coalesced=False):
+
+        groups = self.application.groups
 
         try:
             if synced:
-                result = await self.application.groups.update_groups(
-                    gamespace, group_profiles, merge=merge)
+                # without the failures reported, the call fails as a whole, as it used to: nothing is written
+                #   unless every group can be updated
+                updated, failed = await groups.update_groups(
+                    gamespace, group_profiles, merge=merge, atomic=not report_failures)
             else:
-                result = await self.application.groups.update_groups_no_check(
-                    gamespace, group_profiles, path=path, merge=merge)
+                if not report_failures:
+                    # these write every group on its own, so make sure they all exist before anything is written
+                    #   (a failed profile function still fails its group only, after the others are written)
+                    try:
+                        group_ids = [int(group_id) for group_id in group_profiles.keys()]
+                    except (TypeError, ValueError):
+                        raise InternalError(400, "Bad group id")
+
+                    missing = await groups.find_missing_groups(gamespace, group_ids)
+
+                    if missing:
+                        raise InternalError(404, "Failed to update group {0}: No such group".format(missing[0]))
+
+                if coalesced:
+                    updated, failed = await groups.update_groups_coalesced(
+                        gamespace, group_profiles, path=path, merge=merge)
+                else:
+                    updated, failed = await groups.update_groups_no_check(
+                        gamespace, group_profiles, path=path, merge=merge, server_side=server_side)
+        except GroupError as e:
+            raise InternalError(e.code, e.message)
+
+        if report_failures:
+            return {
+                "groups": updated,
+                "failed": failed
+            }
+
+        # callers that do not ask for the failures expect the whole call to fail, as it used to
+        if failed:
+            group_id, error = sorted(failed.items())[0]
+            raise InternalError(error["code"], "Failed to update group {0}: {1}".format(group_id, error["message"]))
+
+        return updated
+
+    @validate(gamespace="int", group_id="int", operations="json_list")
+    async def update_group_counters(self, gamespace, group_id, operations):
+
+        try:
+            result = await self.application.groups.update_group_counters_no_check(
+                gamespace, group_id, operations)
+        except GroupError as e:
+            raise InternalError(e.code, e.message)
+
+        return result
+
+    @validate(gamespace="int", group_id="int", account_id="int", operations="json_list")
+    async def update_group_participation_counters(self, gamespace, group_id, account_id, operations):
+
+        try:
+            result = await self.application.groups.update_group_participation_counters_no_check(
+                gamespace, group_id, account_id, operations)
+        except NoSuchParticipation:
+            raise InternalError(404, "Player is not participating this group")
         except GroupError as e:
             raise InternalError(e.code, e.message)
 
         return result
 
+    @validate(gamespace="int", group_id="int", notify="json_dict")
+    async def disband_group(self, gamespace, group_id, notify=None):
+
+        try:
+            await self.application.groups.disband_group_no_check(gamespace, group_id, notify=notify)
+        except NoSuchGroup:
+            raise InternalError(404, "No such group")
+        except GroupError as e:
+            raise InternalError(e.code, e.message)
+
+        return "OK"
+
 
 class CreateGroupHandler(AuthenticatedHandler):
     @scoped(scopes=["group_create"])
@@ -473,13 +645,28 @@ class SearchGroupsHandler(AuthenticatedHandler):
     @scoped()
     async def get(self):
 
-        query = self.get_argument("query")
+        query = self.get_argument("query", "")
+        limit = to_int(self.get_argument("limit", GroupsModel.DEFAULT_SEARCH_LIMIT), GroupsModel.DEFAULT_SEARCH_LIMIT)
+        offset = to_int(self.get_argument("offset", 0))
+        join_method_str = self.get_argument("join_method", None)
+        has_free_members = self.get_argument("has_free_members", "false") == "true"
+        name_prefix = self.get_argument("name_prefix", None)
+        with_profile = self.get_argument("profile", "true") == "true"
+
+        if join_method_str:
+            if join_method_str not in GroupJoinMethod.ALL:
+                raise HTTPError(400, "Bad 'join_method'")
+
+            join_method = GroupJoinMethod(join_method_str)
+        else:
+            join_method = None
 
         gamespace = self.token.get(AccessToken.GAMESPACE)
-        account = self.token.account
 
         try:
-            groups = await self.application.groups.search_groups(gamespace, query)
+            groups = await self.application.groups.search_groups(
+                gamespace, query, limit=limit, offset=offset, join_method=join_method,
+                has_free_members=has_free_members, name_prefix=name_prefix, with_profile=with_profile)
         except GroupError as e:
             raise HTTPError(e.code, e.message)
 
@@ -499,6 +686,51 @@ class SearchGroupsHandler(AuthenticatedHandler):
         })
 
 
+class TopGroupsHandler(AuthenticatedHandler):
+    @scoped()
+    async def get(self):
+
+        field = self.get_argument("field")
+        limit = to_int(self.get_argument("limit", 20), 20)
+        offset = to_int(self.get_argument("offset", 0))
+        cursor = self.get_argument("cursor", None)
+
+        gamespace = self.token.get(AccessToken.GAMESPACE)
+
+        try:
+            groups = await self.application.groups.list_top_groups(
+                gamespace, field, limit=limit, offset=offset, cursor=cursor)
+        except GroupError as e:
+            raise HTTPError(e.code, e.message)
+        except ValidationError as e:
+            raise HTTPError(400, e.message)
+
+        result = {
+            "groups": [
+                {
+                    "group": {
+                        "group_id": str(group.group_id),
+                        "profile": group.profile,
+                        "join_method": str(group.join_method),
+                        "free_members": int(group.free_members),
+                        "owner": str(group.owner),
+                        "name": group.name
+                    },
+                    "score": group.score
+                } for group in groups
+            ]
+        }
+
+        if not cursor:
+            for rank, group in enumerate(result["groups"]):
+                group["rank"] = offset + rank + 1
+
+        if groups:
+            result["cursor"] = groups[-1].cursor()
+
+        self.dumps(result)
+
+
 class UniqueNamesAcquireHandler(AuthenticatedHandler):
     @scoped(scopes=["names_write"])
     async def post(self, kind):
@@ -534,10 +766,14 @@ class UniqueNamesSearchHandler(AuthenticatedHandler):
             except (KeyError, ValueError, ValidationError):
                 raise HTTPError(400, "Corrupted profile_fields")
 
+        limit = to_int(self.get_argument("limit", NamesModel.DEFAULT_SEARCH_LIMIT), NamesModel.DEFAULT_SEARCH_LIMIT)
+        offset = to_int(self.get_argument("offset", 0))
+
         try:
             names = await names.search_names(
                 gamespace, kind, query,
-                profile_fields=profile_fields)
+                profile_fields=profile_fields,
+                limit=limit, offset=offset)
         except NamesModelError as e:
             raise HTTPError(e.code, e.message)
 
@@ -654,6 +890,30 @@ class GroupHandler(AuthenticatedHandler):
         except GroupError as e:
             raise HTTPError(e.code, e.message)
 
+    @scoped(scopes=["group", "group_write"])
+    async def delete(self, group_id):
+
+        notify_str = self.get_argument("notify", None)
+        if notify_str:
+            try:
+                notify = ujson.loads(notify_str)
+            except (KeyError, ValueError):
+                raise HTTPError(400, "Notify is corrupted")
+        else:
+            notify = None
+
+        authoritative = self.token.has_scope("message_authoritative")
+        gamespace = self.token.get(AccessToken.GAMESPACE)
+        account = self.token.account
+
+        try:
+            await self.application.groups.disband_group(
+                gamespace, group_id, account, notify=notify, authoritative=authoritative)
+        except NoSuchGroup:
+            raise HTTPError(404, "No such group")
+        except GroupError as e:
+            raise HTTPError(e.code, e.message)
+
 
 class GroupBatchProfilesHandler(AuthenticatedHandler):
     @scoped(scopes=["group_batch"])
@@ -707,7 +967,7 @@ class GroupBatchProfilesHandler(AuthenticatedHandler):
         gamespace = self.token.get(AccessToken.GAMESPACE)
 
         try:
-            result = await self.application.groups.update_groups(
+            updated, failed = await self.application.groups.update_groups(
                 gamespace, group_profiles, merge=merge)
         except NoSuchParticipation:
             raise HTTPError(406, "This account does not participate this group.")
@@ -719,8 +979,9 @@ class GroupBatchProfilesHandler(AuthenticatedHandler):
                 group_id: {
                     "profile": group_profile
                 }
-                for group_id, group_profile in result.items()
-            }
+                for group_id, group_profile in updated.items()
+            },
+            "failed": failed
         })
 
 
@@ -780,17 +1041,58 @@ class GroupProfileHandler(AuthenticatedHandler):
 
         authoritative = self.token.has_scope("message_authoritative")
         merge = self.get_argument("merge", "true") == "true"
+        server_side = self.get_argument("server_side", "false") == "true"
         gamespace = self.token.get(AccessToken.GAMESPACE)
         account = self.token.account
 
         try:
             result = await self.application.groups.update_group(
                 gamespace, group_id, account, group_profile, merge=merge,
+                notify=notify, authoritative=authoritative, server_side=server_side)
+        except NoSuchParticipation:
+            raise HTTPError(406, "This account does not participate this group.")
+        except GroupError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps({
+            "group": {
+                "profile": result
+            }
+        })
+
+
+class GroupProfileCountersHandler(AuthenticatedHandler):
+    @scoped(scopes=["group", "group_write"])
+    async def post(self, group_id):
+
+        try:
+            operations = ujson.loads(self.get_argument("operations"))
+        except (KeyError, ValueError):
+            raise HTTPError(400, "Operations are corrupted")
+
+        notify_str = self.get_argument("notify", None)
+        if notify_str:
+            try:
+                notify = ujson.loads(notify_str)
+            except (KeyError, ValueError):
+                raise HTTPError(400, "Notify is corrupted")
+        else:
+            notify = None
+
+        authoritative = self.token.has_scope("message_authoritative")
+        gamespace = self.token.get(AccessToken.GAMESPACE)
+        account = self.token.account
+
+        try:
+            result = await self.application.groups.update_group_counters(
+                gamespace, group_id, account, operations,
                 notify=notify, authoritative=authoritative)
         except NoSuchParticipation:
             raise HTTPError(406, "This account does not participate this group.")
         except GroupError as e:
             raise HTTPError(e.code, e.message)
+        except ValidationError as e:
+            raise HTTPError(400, e.message)
 
         self.dumps({
             "group": {
@@ -1166,11 +1468,12 @@ class GroupParticipationHandler(AuthenticatedHandler):
 
         authoritative = self.token.has_scope("message_authoritative")
         merge = self.get_argument("merge", "true") == "true"
+        server_side = self.get_argument("server_side", "false") == "true"
 
         try:
             result = await self.application.groups.update_group_participation(
                 gamespace, group_id, my_account, account_id, participation_profile, merge=merge,
-                notify=notify, authoritative=authoritative)
+                notify=notify, authoritative=authoritative, server_side=server_side)
         except NoSuchParticipation:
             raise HTTPError(404, "Player is not participating this group")
         except GroupError as e:
@@ -1207,6 +1510,51 @@ class GroupParticipationHandler(AuthenticatedHandler):
             raise HTTPError(e.code, e.message)
 
 
+class GroupParticipationCountersHandler(AuthenticatedHandler):
+    @scoped(scopes=["group"])
+    async def post(self, group_id, account_id):
+
+        if account_id == "me":
+            account_id = self.token.account
+        else:
+            account_id = to_int(account_id)
+
+        try:
+            operations = ujson.loads(self.get_argument("operations"))
+        except (KeyError, ValueError):
+            raise HTTPError(400, "Operations are corrupted")
+
+        notify_str = self.get_argument("notify", None)
+        if notify_str:
+            try:
+                notify = ujson.loads(notify_str)
+            except (KeyError, ValueError):
+                raise HTTPError(400, "Notify is corrupted")
+        else:
+            notify = None
+
+        authoritative = self.token.has_scope("message_authoritative")
+        gamespace = self.token.get(AccessToken.GAMESPACE)
+        my_account = self.token.account
+
+        try:
+            result = await self.application.groups.update_group_participation_counters(
+                gamespace, group_id, my_account, account_id, operations,
+                notify=notify, authoritative=authoritative)
+        except NoSuchGroup:
+            raise HTTPError(404, "No such group")
+        except NoSuchParticipation:
+            raise HTTPError(404, "Player is not participating this group")
+        except GroupError as e:
+            raise HTTPError(e.code, e.message)
+        except ValidationError as e:
+            raise HTTPError(400, e.message)
+
+        self.dumps({
+            "profile": result
+        })
+
+
 class GroupParticipationPermissionsHandler(AuthenticatedHandler):
     @scoped(scopes=["group"])
     async def post(self, group_id, account_id):
@@ -1247,3 +1595,15 @@ class GroupParticipationPermissionsHandler(AuthenticatedHandler):
             raise HTTPError(406, "Player is not participating this group")
         except GroupError as e:
             raise HTTPError(e.code, e.message)
+
+
+class MetricsHandler(AuthenticatedHandler):
+    @internal
+    async def get(self):
+        metrics = self.application.metrics
+
+        if metrics is None:
+            raise HTTPError(404, "Metrics are disabled")
+
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
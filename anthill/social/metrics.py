@@ -0,0 +1,449 @@
+"""
+Instrumentation of the service: timers and counters for handlers, model methods, database statements,
+    cache commands, internal requests and social network APIs, exposed in the Prometheus text format on /metrics
+    (see MetricsHandler) and summarized on the admin page.
+
+The database, the cache, the models etc are wrapped in place (see Instrumented* and instrument_*) when the server
+    is created, if the 'metrics' option is on; they behave exactly as before. Everything timed is traced as well,
+    see tracing.py.
+"""
+
+import bisect
+import contextvars
+import inspect
+import time
+
+from .tracing import Tracer
+
+
+# a model method being executed (like "GroupsModel.join_group"), statements, commands and requests are labeled with it
+operation = contextvars.ContextVar("operation", default="-")
+
+
+class Histogram(object):
+    # seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.buckets = [0] * (len(Histogram.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, value, error=False):
+        self.buckets[bisect.bisect_left(Histogram.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+        if error:
+            self.errors += 1
+
+    def quantile(self, q):
+        """
+        :returns an upper bound of the bucket the quantile falls into (the last bucket bound if above that)
+        """
+
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return Histogram.BUCKETS[min(index, len(Histogram.BUCKETS) - 1)]
+
+        return Histogram.BUCKETS[-1]
+
+
+class Metrics(object):
+    """
+    A registry of duration histograms and counters, keyed by a metric name and a set of labels.
+    """
+
+    PREFIX = "anthill_social_"
+
+    HELP = {
+        "http_request_duration_seconds": "Time spent handling HTTP requests, by handler",
+        "model_method_duration_seconds": "Time spent in model methods",
+        "db_statement_duration_seconds": "Time spent on database statements, by model method",
+        "db_commits_total": "Transactions committed, by model method",
+        "db_replica_reads_total": "Reads made on replicas, by replica and model method",
+        "db_replica_fallbacks_total": "Reads of read-only model methods made on the primary, by reason",
+        "cache_command_duration_seconds": "Time spent on cache commands, by model method",
+        "cache_hits_total": "Keys found in the cache, by command and model method",
+        "cache_misses_total": "Keys not found in the cache, by command and model method",
+        "internal_request_duration_seconds": "Time spent on requests to other services",
+        "social_api_duration_seconds": "Time spent on social network API calls"
+    }
+
+    def __init__(self, tracer=None):
+        # name -> labels (a tuple of (key, value) pairs) -> Histogram
+        self.histograms = {}
+        # name -> labels -> value
+        self.counters = {}
+        self.started = time.time()
+        # everything timed is also traced, if set, see Tracer
+        self.tracer = tracer
+
+    def observe(self, name, seconds, error=False, **labels):
+        family = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+
+        histogram = family.get(key)
+        if histogram is None:
+            histogram = family[key] = Histogram()
+
+        histogram.observe(seconds, error)
+
+    def inc(self, name, value=1, **labels):
+        family = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        family[key] = family.get(key, 0) + value
+
+    async def time(self, name, awaitable, trace=None, **labels):
+        """
+        Awaits the awaitable and observes how long that took
+
+        :param trace: tags of the span to describe the call in a trace, in addition to the labels
+        """
+
+        if self.tracer is not None:
+            awaitable = self.tracer.span(name, awaitable, trace, **labels)
+
+        started = time.perf_counter()
+        error = False
+
+        try:
+            return await awaitable
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, error=error, **labels)
+
+    @staticmethod
+    def __labels__(labels, extra=None):
+        labels = list(labels) + (extra or [])
+
+        if not labels:
+            return ""
+
+        return "{" + ",".join(
+            '{0}="{1}"'.format(key, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+            for key, value in labels) + "}"
+
+    def render(self):
+        """
+        :returns all metrics in the Prometheus text exposition format
+        """
+
+        lines = []
+
+        for name in sorted(self.histograms):
+            full_name = Metrics.PREFIX + name
+            lines.append("# HELP {0} {1}".format(full_name, Metrics.HELP.get(name, name)))
+            lines.append("# TYPE {0} histogram".format(full_name))
+
+            for labels, histogram in sorted(self.histograms[name].items()):
+                cumulative = 0
+
+                for bound, count in zip(Histogram.BUCKETS, histogram.buckets):
+                    cumulative += count
+                    lines.append("{0}_bucket{1} {2}".format(
+                        full_name, Metrics.__labels__(labels, [("le", repr(bound))]), cumulative))
+
+                lines.append("{0}_bucket{1} {2}".format(
+                    full_name, Metrics.__labels__(labels, [("le", "+Inf")]), histogram.count))
+                lines.append("{0}_sum{1} {2!r}".format(full_name, Metrics.__labels__(labels), histogram.sum))
+                lines.append("{0}_count{1} {2}".format(full_name, Metrics.__labels__(labels), histogram.count))
+
+            errors_name = full_name.replace("_duration_seconds", "_errors_total")
+            lines.append("# TYPE {0} counter".format(errors_name))
+
+            for labels, histogram in sorted(self.histograms[name].items()):
+                lines.append("{0}{1} {2}".format(errors_name, Metrics.__labels__(labels), histogram.errors))
+
+        for name in sorted(self.counters):
+            full_name = Metrics.PREFIX + name
+            lines.append("# HELP {0} {1}".format(full_name, Metrics.HELP.get(name, name)))
+            lines.append("# TYPE {0} counter".format(full_name))
+
+            for labels, value in sorted(self.counters[name].items()):
+                lines.append("{0}{1} {2}".format(full_name, Metrics.__labels__(labels), value))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self, name, limit=50):
+        """
+        :returns a list of dicts (labels, count, errors, total/avg/p50/p99 in milliseconds) of a histogram,
+            the most time consuming first
+        """
+
+        result = [
+            {
+                "labels": ", ".join("{0}={1}".format(key, value) for key, value in labels),
+                "count": histogram.count,
+                "errors": histogram.errors,
+                "total": histogram.sum * 1000.0,
+                "avg": histogram.sum * 1000.0 / histogram.count if histogram.count else 0,
+                "p50": histogram.quantile(0.5) * 1000.0,
+                "p99": histogram.quantile(0.99) * 1000.0
+            }
+            for labels, histogram in self.histograms.get(name, {}).items()
+        ]
+
+        result.sort(key=lambda item: item["total"], reverse=True)
+        return result[:limit]
+
+    def counter_summary(self, name, limit=50):
+        result = [
+            {
+                "labels": ", ".join("{0}={1}".format(key, value) for key, value in labels),
+                "value": value
+            }
+            for labels, value in self.counters.get(name, {}).items()
+        ]
+
+        result.sort(key=lambda item: item["value"], reverse=True)
+        return result[:limit]
+
+
+def timed_method(metrics, name, method, metric, label_operation=False, **labels):
+    """
+    Wraps a method (a coroutine function, or a function that returns an awaitable, like @validate ones)
+        so every call is timed. Calls that return something else are passed through as is.
+
+    :param label_operation: the call becomes the current operation for everything it does, see `operation`
+    """
+
+    async def timed(awaitable):
+        token = operation.set(name) if label_operation else None
+
+        try:
+            return await metrics.time(metric, awaitable, **labels)
+        finally:
+            if token is not None:
+                operation.reset(token)
+
+    def wrapper(*args, **kwargs):
+        result = method(*args, **kwargs)
+
+        if not inspect.isawaitable(result):
+            return result
+
+        return timed(result)
+
+    wrapper.__wrapped__ = method
+    return wrapper
+
+
+def instrument_model(model, metrics):
+    """
+    Times every public method of the model instance, and labels everything it does with its name
+    """
+
+    model_name = model.__class__.__name__
+
+    for name, _ in inspect.getmembers(model.__class__, predicate=inspect.isfunction):
+        if name.startswith("_"):
+            continue
+
+        full_name = model_name + "." + name
+
+        setattr(model, name, timed_method(
+            metrics, full_name, getattr(model, name), "model_method_duration_seconds",
+            label_operation=True, operation=full_name))
+
+
+def instrument_internal(internal_, metrics):
+    """
+    Times requests to other services. Internal is a singleton, so the original methods are kept
+        in case it's instrumented again (by another server instance in tests).
+    """
+
+    original = getattr(internal_, "__uninstrumented__", None)
+
+    if original is None:
+        original = internal_.__uninstrumented__ = {
+            "request": internal_.request,
+            "rpc": internal_.rpc
+        }
+
+    def wrap(kind):
+        method = original[kind]
+
+        def wrapper(service, method_name, *args, **kwargs):
+            return metrics.time(
+                "internal_request_duration_seconds", method(service, method_name, *args, **kwargs),
+                service=service, method=method_name, kind=kind, operation=operation.get())
+
+        return wrapper
+
+    internal_.request = wrap("request")
+    internal_.rpc = wrap("rpc")
+
+
+def instrument_social_api(api, metrics):
+    provider = api.type()
+
+    for name in ["list_friends", "get_social_profile", "import_social", "call"]:
+        method = getattr(api, name, None)
+
+        if method is None:
+            continue
+
+        setattr(api, name, timed_method(
+            metrics, name, method, "social_api_duration_seconds", provider=provider, method=name))
+
+
+class InstrumentedConnection(object):
+    """
+    A DatabaseConnection (see Database.acquire) that times every statement
+    """
+
+    def __init__(self, connection, metrics):
+        self.connection = connection
+        self.metrics = metrics
+
+    async def __aenter__(self):
+        await self.connection.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return await self.connection.__aexit__(*exc_info)
+
+    async def init(self):
+        await self.connection.init()
+        return self
+
+    def __getattr__(self, item):
+        return getattr(self.connection, item)
+
+    def __statement__(self, statement, query, args, kwargs):
+        trace = {"query": Tracer.statement(query)} if self.metrics.tracer is not None else None
+
+        return self.metrics.time(
+            "db_statement_duration_seconds", getattr(self.connection, statement)(query, *args, **kwargs),
+            trace=trace, statement=statement, operation=operation.get())
+
+    def execute(self, query, *args, **kwargs):
+        return self.__statement__("execute", query, args, kwargs)
+
+    def get(self, query, *args, **kwargs):
+        return self.__statement__("get", query, args, kwargs)
+
+    def insert(self, query, *args, **kwargs):
+        return self.__statement__("insert", query, args, kwargs)
+
+    def query(self, query, *args, **kwargs):
+        return self.__statement__("query", query, args, kwargs)
+
+    def commit(self):
+        self.metrics.inc("db_commits_total", operation=operation.get())
+        return self.connection.commit()
+
+
+class InstrumentedDatabase(InstrumentedConnection):
+    """
+    A Database that times every statement, including the ones made on acquired connections
+    """
+
+    def __init__(self, db, metrics):
+        super(InstrumentedDatabase, self).__init__(db, metrics)
+        self.db = db
+
+    def acquire(self, *args, **kwargs):
+        return InstrumentedConnection(self.db.acquire(*args, **kwargs), self.metrics)
+
+
+class InstrumentedRedis(object):
+    """
+    A redis connection (see KeyValueStorage.acquire) that times every command
+    """
+
+    # command -> a function that counts (hits, misses) of the result
+    LOOKUPS = {
+        "get": lambda result: (0, 1) if result is None else (1, 0),
+        "mget": lambda result: (sum(1 for r in result if r is not None), sum(1 for r in result if r is None))
+    }
+
+    def __init__(self, redis, metrics):
+        self.redis = redis
+        self.metrics = metrics
+
+    async def __command__(self, command, awaitable):
+        result = await self.metrics.time(
+            "cache_command_duration_seconds", awaitable, command=command, operation=operation.get())
+
+        lookup = InstrumentedRedis.LOOKUPS.get(command)
+
+        if lookup is not None:
+            hits, misses = lookup(result)
+            if hits:
+                self.metrics.inc("cache_hits_total", hits, command=command, operation=operation.get())
+            if misses:
+                self.metrics.inc("cache_misses_total", misses, command=command, operation=operation.get())
+
+        return result
+
+    def __getattr__(self, item):
+        attr = getattr(self.redis, item)
+
+        if item.startswith("_") or not callable(attr):
+            return attr
+
+        def command(*args, **kwargs):
+            result = attr(*args, **kwargs)
+
+            if item in ("pipeline", "multi_exec"):
+                # commands of a pipeline resolve at once, on execute
+                return InstrumentedPipeline(result, self.metrics, item)
+
+            if not inspect.isawaitable(result):
+                return result
+
+            return self.__command__(item, result)
+
+        return command
+
+
+class InstrumentedPipeline(object):
+    def __init__(self, pipeline, metrics, kind):
+        self.pipeline = pipeline
+        self.metrics = metrics
+        self.kind = kind
+
+    def __getattr__(self, item):
+        return getattr(self.pipeline, item)
+
+    def execute(self, *args, **kwargs):
+        return self.metrics.time(
+            "cache_command_duration_seconds", self.pipeline.execute(*args, **kwargs),
+            command=self.kind, operation=operation.get())
+
+
+class InstrumentedCacheConnection(object):
+    def __init__(self, connection, metrics):
+        self.connection = connection
+        self.metrics = metrics
+
+    async def __aenter__(self):
+        return InstrumentedRedis(await self.connection.__aenter__(), self.metrics)
+
+    async def __aexit__(self, *exc_info):
+        return await self.connection.__aexit__(*exc_info)
+
+
+class InstrumentedKeyValueStorage(object):
+    def __init__(self, cache, metrics):
+        self.cache = cache
+        self.metrics = metrics
+
+    def __getattr__(self, item):
+        return getattr(self.cache, item)
+
+    def acquire(self):
+        return InstrumentedCacheConnection(self.cache.acquire(), self.metrics)
+
@@ -0,0 +1,204 @@
+from tornado.gen import convert_yielded
+from tornado.ioloop import IOLoop
+
+from anthill.common.database import DatabaseError
+
+import hashlib
+import logging
+
+
+class NamesBloomFilter(object):
+    """
+    Bloom filter of taken unique names, one per (gamespace_id, kind), kept as redis bitmaps, so every
+        instance of the service sees names acquired by the others.
+
+    It can only tell that a name is definitely free: names that might be taken are checked against the database
+        as usual. Released names are never removed from the filter, they only cause an extra database lookup
+        until the bitmap is rebuilt (delete its key to rebuild it).
+
+    A bitmap is built from the unique_names table the first time it's needed, in the background, and has the bit
+        right after the hashed ones (see `bits`) set once it's built. A bitmap without that bit (not built yet,
+        or evicted from the cache) tells nothing, and is rebuilt. The size and the number of hashes are a part of
+        the key, so changing them does not mix the bits of different layouts.
+
+    Only ASCII names are handled: the unique key of unique_names compares names with a case-insensitive
+        collation, which is easy to follow for ASCII, but not for the rest of unicode, so for other names
+        the filter always answers "might be taken".
+
+    :param cache: a key-value storage the bitmaps are kept in
+    :param db: a database to build the bitmaps from
+    :param bits: size of each bitmap, in bits
+    :param hashes: number of bits set for every name
+    """
+
+    KEY = "names:bloom:{0}:{1}:{2}:{3}"
+    BUILD_LOCK_TTL = 600
+    BUILD_CHUNK = 10000
+
+    def __init__(self, cache, db, bits=16777216, hashes=7):
+        self.cache = cache
+        self.db = db
+        self.bits = bits
+        self.hashes = hashes
+        # (gamespace_id, kind) -> a Future of the bitmap being built by this instance
+        self.building = {}
+
+    @staticmethod
+    def normalize(name):
+        """
+        :returns the name as the database would compare it, or None if that cannot be told
+        """
+
+        # PAD SPACE collations ignore trailing spaces
+        name = name.rstrip(" ")
+
+        try:
+            name.encode("ascii")
+        except UnicodeEncodeError:
+            return None
+
+        return name.lower()
+
+    def key(self, gamespace_id, kind):
+        return NamesBloomFilter.KEY.format(self.bits, self.hashes, gamespace_id, kind)
+
+    def positions(self, name):
+        digest = hashlib.md5(name.encode("utf-8")).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(0, self.hashes)]
+
+    async def are_free(self, gamespace_id, kind, names):
+        """
+        :returns a list of booleans, one for each name: True if the name is definitely free,
+            False if it might be taken (or the bitmap is not built)
+        """
+
+        normalized = [NamesBloomFilter.normalize(name) for name in names]
+        key = self.key(gamespace_id, kind)
+
+        async with self.cache.acquire() as db:
+            pipe = db.pipeline()
+            built = pipe.getbit(key, self.bits)
+            checks = [
+                [pipe.getbit(key, position) for position in self.positions(name)] if name is not None else None
+                for name in normalized
+            ]
+            await pipe.execute()
+
+            if not (await built):
+                self.__schedule_build__(gamespace_id, kind)
+                return [False] * len(names)
+
+            result = []
+
+            for check in checks:
+                if check is None:
+                    result.append(False)
+                    continue
+
+                bits = [await bit for bit in check]
+                result.append(not all(bits))
+
+            return result
+
+    async def is_free(self, gamespace_id, kind, name):
+        free = await self.are_free(gamespace_id, kind, [name])
+        return free[0]
+
+    async def add(self, gamespace_id, kind, name):
+        name = NamesBloomFilter.normalize(name)
+
+        if name is None:
+            return
+
+        key = self.key(gamespace_id, kind)
+
+        async with self.cache.acquire() as db:
+            pipe = db.pipeline()
+            for position in self.positions(name):
+                pipe.setbit(key, position, 1)
+            await pipe.execute()
+
+    def __schedule_build__(self, gamespace_id, kind):
+        bucket = (gamespace_id, kind)
+
+        if bucket in self.building:
+            return
+
+        def done(future):
+            self.building.pop(bucket, None)
+            # logs the error, if any
+            future.result()
+
+        future = convert_yielded(self.build(gamespace_id, kind))
+        self.building[bucket] = future
+        IOLoop.current().add_future(future, done)
+
+    async def build(self, gamespace_id, kind):
+        """
+        Fills the bitmap of a (gamespace_id, kind) from the unique_names table, unless it is being done by another
+            instance. Names acquired while the bitmap is being built are kept: the built bitmap is OR'ed into
+            the live one, which sets the 'built' bit at the same time.
+        """
+
+        key = self.key(gamespace_id, kind)
+        lock_key = key + ":lock"
+        building_key = key + ":building"
+
+        async with self.cache.acquire() as db:
+            locked = await db.set(
+                lock_key, "1", expire=NamesBloomFilter.BUILD_LOCK_TTL, exist=db.SET_IF_NOT_EXIST)
+
+            if not locked:
+                return
+
+        # one more bit to tell the bitmap is built
+        bitmap = bytearray(self.bits // 8 + 1)
+        last_account_id = 0
+        count = 0
+
+        def set_bit(position):
+            # redis counts bits from the most significant one
+            bitmap[position >> 3] |= 0x80 >> (position & 7)
+
+        try:
+            while True:
+                names = await self.db.query(
+                    """
+                        SELECT `account_id`, `name`
+                        FROM `unique_names`
+                        WHERE `gamespace_id`=%s AND `kind`=%s AND `account_id`>%s
+                        ORDER BY `account_id`
+                        LIMIT %s;
+                    """, gamespace_id, kind, last_account_id, NamesBloomFilter.BUILD_CHUNK)
+
+                if not names:
+                    break
+
+                for name in names:
+                    normalized = NamesBloomFilter.normalize(name["name"])
+                    if normalized is None:
+                        continue
+
+                    for position in self.positions(normalized):
+                        set_bit(position)
+
+                last_account_id = names[-1]["account_id"]
+                count += len(names)
+        except DatabaseError as e:
+            logging.error("Failed to build unique names bloom filter of {0}/{1}: {2}".format(
+                gamespace_id, kind, e.args[1]))
+
+            async with self.cache.acquire() as db:
+                await db.delete(lock_key)
+            return
+
+        set_bit(self.bits)
+
+        async with self.cache.acquire() as db:
+            await db.set(building_key, bytes(bitmap))
+            await db.bitop_or(key, key, building_key)
+            await db.delete(building_key, lock_key)
+
+        logging.info("Unique names bloom filter of {0}/{1} built: {2} names".format(gamespace_id, kind, count))
@@ -0,0 +1,95 @@
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.gen import multi
+
+import logging
+
+
+class ProfileUpdateBuffer(object):
+    """
+    Write-combining buffer for profile updates.
+
+    Updates of the same object that arrive within one window are kept in memory, and then flushed together:
+        every object is read and written once per window, no matter how many updates it has got. Updates are
+        still applied one by one in the order they came in, so functions (like '++') work as expected.
+
+    A future returned from ProfileUpdateBuffer.update resolves once the flush is committed, with the same result
+        the update would have had if made directly.
+
+    :param flush: a coroutine function (gamespace_id, updates) that applies the updates, where
+        updates is a dict key -> list of (fields, path, merge) tuples, and returns a dict key -> list of
+        (result, error) tuples, one for each update (see GroupsModel.apply_group_updates)
+    :param window: number of seconds updates are collected for before they are flushed
+    :param max_pending: number of pending updates that causes an immediate flush
+    """
+
+    def __init__(self, flush, window, max_pending=10000):
+        self.flush_updates = flush
+        self.window = window
+        self.max_pending = max_pending
+
+        # gamespace_id -> key -> list of (fields, path, merge, future)
+        self.pending = {}
+        self.pending_count = 0
+        self.scheduled = None
+
+    def update(self, gamespace_id, key, fields, path=None, merge=True):
+        future = Future()
+
+        gamespace_pending = self.pending.setdefault(gamespace_id, {})
+        gamespace_pending.setdefault(str(key), []).append((fields, path, merge, future))
+        self.pending_count += 1
+
+        if self.pending_count >= self.max_pending:
+            self.__schedule__(0)
+        elif self.scheduled is None:
+            self.__schedule__(self.window)
+
+        return future
+
+    def __schedule__(self, delay):
+        io_loop = IOLoop.current()
+
+        if self.scheduled is not None:
+            io_loop.remove_timeout(self.scheduled)
+
+        self.scheduled = io_loop.call_later(delay, lambda: io_loop.spawn_callback(self.flush))
+
+    async def flush(self):
+        if self.scheduled is not None:
+            IOLoop.current().remove_timeout(self.scheduled)
+            self.scheduled = None
+
+        pending = self.pending
+        self.pending = {}
+        self.pending_count = 0
+
+        if pending:
+            await multi([
+                self.__flush_gamespace__(gamespace_id, gamespace_pending)
+                for gamespace_id, gamespace_pending in pending.items()
+            ])
+
+    async def __flush_gamespace__(self, gamespace_id, gamespace_pending):
+        updates = {
+            key: [(fields, path, merge) for fields, path, merge, future in items]
+            for key, items in gamespace_pending.items()
+        }
+
+        try:
+            results = await self.flush_updates(gamespace_id, updates)
+        except Exception as e:
+            logging.exception("Failed to flush {0} buffered updates".format(len(updates)))
+            for items in gamespace_pending.values():
+                for fields, path, merge, future in items:
+                    future.set_exception(e)
+            return
+
+        for key, items in gamespace_pending.items():
+            key_results = results.get(key, [])
+
+            for index, (fields, path, merge, future) in enumerate(items):
+                if index < len(key_results):
+                    future.set_result(key_results[index])
+                else:
+                    future.set_result((None, {"code": 500, "message": "Update was lost"}))
@@ -1,10 +1,14 @@
 from . import profile
 from .request import RequestType, RequestError, NoSuchRequest
+from .deletion import delete_accounts
+from .schema import add_missing_indexes
 
 from anthill.common.internal import InternalError
 from anthill.common.validate import validate
 from anthill.common.database import DatabaseError
 
+import logging
+
 
 class ConnectionError(Exception):
     def __init__(self, code, message):
@@ -15,6 +19,76 @@ class ConnectionError(Exception):
         return str(self.code) + ": " + self.message
 
 
+async def migrate_gamespace(db, table, legacy_gamespace):
+    """
+    Connections used to be global (no gamespace_id). The table is keyed by
+        (gamespace_id, account_id, account_connection) now, so each gamespace's connections are clustered
+        together, and the table can be partitioned by gamespace_id (every key starts with it), for example:
+
+        ALTER TABLE `account_connections` PARTITION BY KEY (`gamespace_id`) PARTITIONS 16;
+
+    Nothing tells which gamespace an existing connection belongs to, so they all are moved into
+        @legacy_gamespace, and the migration is refused (the service does not start) if there are connections to
+        move and it is not set (is negative): in any other gamespace, they would be lost to the players.
+
+    Failing to check or change the table fails the start as well, as every query of the ConnectionsModel
+        expects the gamespace_id column to be there.
+    """
+
+    try:
+        columns = await db.query(
+            """
+                SHOW COLUMNS FROM `{0}` LIKE %s;
+            """.format(table), "gamespace_id")
+    except DatabaseError as e:
+        raise ConnectionError(500, "Failed to check {0} schema: {1}".format(table, e.args[1]))
+
+    if columns:
+        return
+
+    if legacy_gamespace < 0:
+        try:
+            existing = await db.get(
+                """
+                    SELECT 1 AS `existing` FROM `{0}` LIMIT 1;
+                """.format(table))
+        except DatabaseError as e:
+            raise ConnectionError(500, "Failed to check existing connections: " + str(e.args[1]))
+
+        if existing:
+            raise ConnectionError(500, "Existing connections have to be moved into a gamespace: "
+                                       "set connections_legacy_gamespace to the one they belong to")
+
+        legacy_gamespace = 0
+
+    try:
+        await db.execute(
+            """
+                ALTER TABLE `{0}`
+                ADD COLUMN `gamespace_id` int(11) unsigned NOT NULL DEFAULT %s FIRST,
+                DROP INDEX `account_id`,
+                DROP INDEX `account_id_2`,
+                DROP INDEX `account_connection`,
+                ADD PRIMARY KEY (`gamespace_id`, `account_id`, `account_connection`),
+                ADD KEY `account_connection` (`gamespace_id`, `account_connection`);
+            """.format(table), int(legacy_gamespace))
+    except DatabaseError as e:
+        raise ConnectionError(500, "Failed to add gamespace to {0}: {1}".format(table, e.args[1]))
+
+    logging.warning("Added gamespace to {0}, existing connections are moved into gamespace {1}".format(
+        table, legacy_gamespace))
+
+    try:
+        await db.execute(
+            """
+                ALTER TABLE `{0}`
+                ALTER COLUMN `gamespace_id` DROP DEFAULT;
+            """.format(table))
+    except DatabaseError as e:
+        # the column is there, the default only hides inserts without a gamespace
+        logging.error("Failed to drop the gamespace default of {0}: {1}".format(table, e.args[1]))
+
+
 class ConnectionsModel(profile.ProfilesModel):
     APPROVAL_SCOPE = 'connection_approval'
 
@@ -24,10 +98,16 @@ class ConnectionsModel(profile.ProfilesModel):
     MESSAGE_CONNECTION_APPROVED = 'connection_approved'
     MESSAGE_CONNECTION_REJECTED = 'connection_rejected'
 
-    def __init__(self, db, cache, requests):
+    MAX_CHECK_ACCOUNTS = 1000
+    MAX_BULK_CONNECTIONS = 10000
+    BULK_CHUNK_SIZE = 500
+
+    def __init__(self, db, cache, requests, legacy_gamespace=-1):
         super(ConnectionsModel, self).__init__(db, cache)
 
         self.requests = requests
+        # connections made before they were scoped by gamespace are moved into this gamespace (-1 if not known)
+        self.legacy_gamespace = legacy_gamespace
 
     def get_setup_db(self):
         return self.db
@@ -38,32 +118,205 @@ class ConnectionsModel(profile.ProfilesModel):
     def has_delete_account_event(self):
         return True
 
-    async def accounts_deleted(self, gamespace, accounts, gamespace_only):
-        if gamespace_only:
-            return
+    async def started(self, application):
+        await super(ConnectionsModel, self).started(application)
+        await migrate_gamespace(self.db, "account_connections", self.legacy_gamespace)
+        await add_missing_indexes(self.db, "account_connections", [("account_id", "(`account_id`)")])
+
+    async def delete_accounts_chunk(self, gamespace, accounts, gamespace_only, limit):
+        """
+        Connections are symmetric, so the rows of the accounts are looked up by `account_id`, and then both
+            directions of each are deleted by the primary key (`account_connection` alone has no index).
+        """
 
         try:
+            if gamespace_only:
+                rows = await self.db.query(
+                    """
+                        SELECT `gamespace_id`, `account_id`, `account_connection`
+                        FROM `account_connections`
+                        WHERE `gamespace_id`=%s AND `account_id` IN %s
+                        LIMIT %s;
+                    """, gamespace, accounts, limit // 2)
+            else:
+                rows = await self.db.query(
+                    """
+                        SELECT `gamespace_id`, `account_id`, `account_connection`
+                        FROM `account_connections`
+                        WHERE `account_id` IN %s
+                        LIMIT %s;
+                    """, accounts, limit // 2)
+
+            if not rows:
+                return 0
+
+            keys = set()
+            for row in rows:
+                keys.add((row["gamespace_id"], row["account_id"], row["account_connection"]))
+                keys.add((row["gamespace_id"], row["account_connection"], row["account_id"]))
+
             await self.db.execute(
                 """
                     DELETE FROM `account_connections`
-                    WHERE `account_id` IN %s OR `account_connection` IN %s;
-                """, accounts, accounts)
+                    WHERE (`gamespace_id`, `account_id`, `account_connection`) IN %s;
+                """, sorted(keys))
         except DatabaseError as e:
             raise ConnectionError(500, "Failed to delete user connections: " + e.args[1])
 
-    @validate(account_id="int", target_account="int")
-    async def create(self, account_id, target_account):
+        return len(rows)
+
+    async def accounts_deleted(self, gamespace, accounts, gamespace_only):
+        await delete_accounts(self, gamespace, accounts, gamespace_only)
+
+    @validate(gamespace_id="int", account_id="int", target_account="int")
+    async def create(self, gamespace_id, account_id, target_account):
 
         try:
             await self.db.insert(
                 """
                     INSERT INTO `account_connections`
-                    (`account_id`, `account_connection`)
-                    VALUES (%s, %s), (%s, %s);
-                """, account_id, target_account, target_account, account_id)
+                    (`gamespace_id`, `account_id`, `account_connection`)
+                    VALUES (%s, %s, %s), (%s, %s, %s);
+                """, gamespace_id, account_id, target_account, gamespace_id, target_account, account_id)
         except DatabaseError as e:
             raise ConnectionError(500, "Failed to add a connection: " + e.args[1])
 
+    @staticmethod
+    def __bulk_chunks__(connections):
+        """
+        :param connections: a list of [account_id, target_account] pairs
+        :returns a list of chunks of (account_id, account_connection) rows: both directions of every pair,
+            no duplicates, both directions of a pair always in the same chunk, every chunk sorted
+            (so concurrent bulk operations lock rows in the same order)
+        """
+
+        if len(connections) > ConnectionsModel.MAX_BULK_CONNECTIONS:
+            raise ConnectionError(400, "Too many connections")
+
+        pairs = set()
+
+        for pair in connections:
+            if not isinstance(pair, (list, tuple)) or len(pair) != 2:
+                raise ConnectionError(400, "Each connection should be a pair of accounts")
+
+            try:
+                account_id, target_account = int(pair[0]), int(pair[1])
+            except (TypeError, ValueError):
+                raise ConnectionError(400, "Each connection should be a pair of accounts")
+
+            if account_id == target_account:
+                continue
+
+            pairs.add((min(account_id, target_account), max(account_id, target_account)))
+
+        pairs = sorted(pairs)
+        pairs_per_chunk = ConnectionsModel.BULK_CHUNK_SIZE // 2
+
+        return [
+            sorted([(a, b) for a, b in chunk] + [(b, a) for a, b in chunk])
+            for chunk in (pairs[offset:offset + pairs_per_chunk] for offset in range(0, len(pairs), pairs_per_chunk))
+        ]
+
+    @staticmethod
+    def __pairs_of__(rows):
+        """
+        :param rows: (account_id, account_connection) rows
+        :returns number of distinct pairs these rows belong to (a pair counts once, whatever directions it has)
+        """
+        return len({(min(a, b), max(a, b)) for a, b in rows})
+
+    @staticmethod
+    async def __existing_rows__(db, gamespace_id, chunk):
+        """
+        Locks and returns the rows of the chunk that are in the table already
+        """
+        rows = await db.query(
+            """
+                SELECT `account_id`, `account_connection`
+                FROM `account_connections`
+                WHERE `gamespace_id`=%s AND (`account_id`, `account_connection`) IN %s
+                FOR UPDATE;
+            """, gamespace_id, chunk)
+
+        return {(row["account_id"], row["account_connection"]) for row in rows}
+
+    @validate(gamespace_id="int", connections="json_list")
+    async def create_many(self, gamespace_id, connections):
+        """
+        Creates lots of connections at once: the pairs are deduplicated and made symmetric, and written with
+            multi-row INSERT IGNORE statements, BULK_CHUNK_SIZE rows per transaction (existing connections
+            are left as they are, a pair with one direction missing gets the other one).
+
+        :param connections: a list of [account_id, target_account] pairs
+        :returns number of connections (pairs) that got at least one new row
+        """
+
+        created = 0
+
+        for chunk in ConnectionsModel.__bulk_chunks__(connections):
+            try:
+                async with self.db.acquire(auto_commit=False) as db:
+                    try:
+                        existing = await ConnectionsModel.__existing_rows__(db, gamespace_id, chunk)
+                        missing = [row for row in chunk if row not in existing]
+
+                        if not missing:
+                            continue
+
+                        args = []
+
+                        for account_id, account_connection in missing:
+                            args.extend([gamespace_id, account_id, account_connection])
+
+                        await db.execute(
+                            """
+                                INSERT IGNORE INTO `account_connections`
+                                (`gamespace_id`, `account_id`, `account_connection`)
+                                VALUES {0};
+                            """.format(", ".join(["(%s, %s, %s)"] * len(missing))), *args)
+                    finally:
+                        await db.commit()
+            except DatabaseError as e:
+                raise ConnectionError(500, "Failed to add connections: " + e.args[1])
+
+            created += ConnectionsModel.__pairs_of__(missing)
+
+        return created
+
+    @validate(gamespace_id="int", connections="json_list")
+    async def delete_many(self, gamespace_id, connections):
+        """
+        Deletes lots of connections at once (both directions of every pair), BULK_CHUNK_SIZE rows per statement.
+
+        :param connections: a list of [account_id, target_account] pairs
+        :returns number of connections (pairs) that had at least one row deleted
+        """
+
+        deleted = 0
+
+        for chunk in ConnectionsModel.__bulk_chunks__(connections):
+            try:
+                async with self.db.acquire(auto_commit=False) as db:
+                    try:
+                        existing = await ConnectionsModel.__existing_rows__(db, gamespace_id, chunk)
+
+                        if not existing:
+                            continue
+
+                        await db.execute(
+                            """
+                                DELETE FROM `account_connections`
+                                WHERE `gamespace_id`=%s AND (`account_id`, `account_connection`) IN %s;
+                            """, gamespace_id, sorted(existing))
+                    finally:
+                        await db.commit()
+            except DatabaseError as e:
+                raise ConnectionError(500, "Failed to delete connections: " + e.args[1])
+
+            deleted += ConnectionsModel.__pairs_of__(existing)
+
+        return deleted
+
     @validate(gamespace_id="int", account_id="int", approve_account_id="int", key="str", notify="json_dict")
     async def approve_connection(self, gamespace_id, account_id, approve_account_id, key, notify=None):
 
@@ -80,7 +333,7 @@ class ConnectionsModel(profile.ProfilesModel):
 
         try:
             await self.create(
-                account_id, request.account)
+                gamespace_id, account_id, request.account)
         except ConnectionError as e:
             raise ConnectionError(500, e.message)
 
@@ -137,7 +390,7 @@ class ConnectionsModel(profile.ProfilesModel):
             }
         else:
             try:
-                await self.create(account_id, target_account)
+                await self.create(gamespace_id, account_id, target_account)
             except ConnectionError as e:
                 raise ConnectionError(500, e.message)
 
@@ -159,14 +412,13 @@ class ConnectionsModel(profile.ProfilesModel):
         except InternalError:
             pass  # well
 
-    async def cleanup(self, account_id):
+    async def cleanup(self, gamespace_id, account_id):
         try:
             await self.db.execute(
                 """
                     DELETE FROM `account_connections`
-                    WHERE `account_id`=%s OR `account_connection`=%s
-                    LIMIT 2;
-                """, account_id, account_id)
+                    WHERE `gamespace_id`=%s AND (`account_id`=%s OR `account_connection`=%s);
+                """, gamespace_id, account_id, account_id)
         except DatabaseError as e:
             raise ConnectionError(500, "Failed to delete a connection: " + e.args[1])
 
@@ -177,10 +429,11 @@ class ConnectionsModel(profile.ProfilesModel):
             await self.db.execute(
                 """
                     DELETE FROM `account_connections`
-                    WHERE (`account_id`=%s AND `account_connection`=%s) OR
-                          (`account_connection`=%s AND `account_id`=%s)
+                    WHERE `gamespace_id`=%s AND (
+                        (`account_id`=%s AND `account_connection`=%s) OR
+                        (`account_connection`=%s AND `account_id`=%s))
                     LIMIT 2;
-                """, account_id, target_account, account_id, target_account)
+                """, gamespace_id, account_id, target_account, account_id, target_account)
         except DatabaseError as e:
             raise ConnectionError(500, "Failed to delete a connection: " + e.args[1])
 
@@ -190,8 +443,74 @@ class ConnectionsModel(profile.ProfilesModel):
                 ConnectionsModel.MESSAGE_CONNECTION_DELETED, notify, ["remove_delivered"],
                 authoritative=True)
 
+    @validate(gamespace_id="int", account_id="int", target_account="int")
+    async def are_connected(self, gamespace_id, account_id, target_account):
+        """
+        :returns True if the accounts are connected (a single primary key lookup)
+        """
+
+        try:
+            connection = await self.db.get(
+                """
+                    SELECT 1 AS `connected`
+                    FROM `account_connections`
+                    WHERE `gamespace_id`=%s AND `account_id`=%s AND `account_connection`=%s
+                    LIMIT 1;
+                """, gamespace_id, account_id, target_account)
+        except DatabaseError as e:
+            raise ConnectionError(500, "Failed to check a connection: " + e.args[1])
+
+        return connection is not None
+
+    @validate(gamespace_id="int", account_id="int", target_accounts="json_list_of_ints")
+    async def are_connected_many(self, gamespace_id, account_id, target_accounts):
+        """
+        :returns a dict target account -> True if the account is connected with it
+        """
+
+        if len(target_accounts) > ConnectionsModel.MAX_CHECK_ACCOUNTS:
+            raise ConnectionError(400, "Too many accounts to check")
+
+        if not target_accounts:
+            return {}
+
+        try:
+            connections = await self.db.query(
+                """
+                    SELECT `account_connection`
+                    FROM `account_connections`
+                    WHERE `gamespace_id`=%s AND `account_id`=%s AND `account_connection` IN %s;
+                """, gamespace_id, account_id, list(set(target_accounts)))
+        except DatabaseError as e:
+            raise ConnectionError(500, "Failed to check connections: " + e.args[1])
+
+        connected = set(connection["account_connection"] for connection in connections)
+
+        return {
+            target_account: target_account in connected
+            for target_account in target_accounts
+        }
+
+    @validate(gamespace_id="int", account_id="int")
+    async def count_connections(self, gamespace_id, account_id):
+        """
+        :returns number of connections of the account (counted over the primary key range, without loading them)
+        """
+
+        try:
+            count = await self.db.get(
+                """
+                    SELECT COUNT(*) AS `count`
+                    FROM `account_connections`
+                    WHERE `gamespace_id`=%s AND `account_id`=%s;
+                """, gamespace_id, account_id)
+        except DatabaseError as e:
+            raise ConnectionError(500, "Failed to count connections: " + e.args[1])
+
+        return count["count"]
+
     async def get_connections_profiles(self, gamespace_id, account_id, profile_fields):
-        connections = await self.list_connections(account_id)
+        connections = await self.list_connections(gamespace_id, account_id)
 
         try:
             connection_profiles = await self.get_profiles(
@@ -205,14 +524,14 @@ class ConnectionsModel(profile.ProfilesModel):
 
         return connection_profiles
 
-    async def list_connections(self, account_id):
+    async def list_connections(self, gamespace_id, account_id):
         try:
             connections = await self.db.query(
                 """
-                    SELECT * 
-                    FROM `account_connections` 
-                    WHERE `account_id`=%s;
-                """, account_id)
+                    SELECT `account_connection`
+                    FROM `account_connections`
+                    WHERE `gamespace_id`=%s AND `account_id`=%s;
+                """, gamespace_id, account_id)
         except DatabaseError as e:
             raise ConnectionError(500, "Failed to get connections: " + e.args[1])
 
@@ -0,0 +1,311 @@
+from tornado.gen import multi, sleep
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Semaphore
+
+from anthill.common.database import DatabaseError
+from anthill.common.model import Model
+
+import hashlib
+import logging
+import ujson
+
+
+async def delete_accounts(model, gamespace_id, accounts, gamespace_only, chunk_size=1000):
+    """
+    Deletes all account data of a model (see AccountDeletionsModel), chunk by chunk, without pauses.
+    """
+
+    while await model.delete_accounts_chunk(gamespace_id, accounts, gamespace_only, chunk_size):
+        pass
+
+
+class AccountDeletionsError(Exception):
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return str(self.code) + ": " + str(self.message)
+
+
+class AccountDeletionAdapter(object):
+    def __init__(self, data):
+        self.deletion_id = data.get("deletion_id")
+        self.gamespace_id = data.get("gamespace_id")
+        self.gamespace_only = bool(data.get("gamespace_only"))
+        self.accounts = data.get("deletion_accounts")
+        self.progress = data.get("deletion_progress")
+        self.status = data.get("deletion_status")
+        self.attempts = data.get("deletion_attempts")
+
+        if isinstance(self.accounts, str):
+            self.accounts = ujson.loads(self.accounts)
+        if isinstance(self.progress, str):
+            self.progress = ujson.loads(self.progress)
+
+    def dump(self):
+        return {
+            "id": self.deletion_id,
+            "gamespace": self.gamespace_id,
+            "gamespace_only": self.gamespace_only,
+            "accounts": len(self.accounts),
+            "progress": self.progress,
+            "status": self.status
+        }
+
+
+class AccountDeletionsModel(Model):
+    """
+    Deletes data of deleted accounts in the background, instead of one unbounded DELETE per model.
+
+    Each deletion (one 'DEL' event) is stored in the account_deletions table, and then processed:
+        accounts are split into batches of ACCOUNTS_PER_BATCH, and every model deletes its rows of a batch with
+        delete_accounts_chunk(gamespace, accounts, gamespace_only, limit), which deletes at most @limit rows
+        and returns the number of rows deleted, until it returns 0. The pipeline sleeps for @pause between
+        chunks, so live traffic is not stalled, and only @concurrency models (over all deletions) work at
+        the same time.
+
+    The number of batches done for every model is saved after each batch, so a deletion that has been interrupted
+        (a crash, a restart, an error) resumes from where it stopped: pending deletions are picked up by any
+        instance once the lease of the instance that has been processing it expires.
+
+    :param models: the models to delete account data from, see delete_accounts_chunk
+    """
+
+    ACCOUNTS_PER_BATCH = 500
+    LEASE_TIME = 60
+    MAX_ATTEMPTS = 5
+    RESUME_INTERVAL = 60
+
+    STATUS_PENDING = "pending"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    def __init__(self, db, models, chunk_size=1000, pause=0.05, concurrency=2):
+        self.db = db
+        self.models = models
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.budget = Semaphore(concurrency)
+        self.processing = set()
+        self.resume_callback = None
+
+    def get_setup_db(self):
+        return self.db
+
+    def get_setup_tables(self):
+        return ["account_deletions"]
+
+    async def started(self, application):
+        await super(AccountDeletionsModel, self).started(application)
+
+        self.resume_callback = PeriodicCallback(self.__resume__, AccountDeletionsModel.RESUME_INTERVAL * 1000)
+        self.resume_callback.start()
+
+        IOLoop.current().spawn_callback(self.__resume__)
+
+    async def stopped(self):
+        if self.resume_callback:
+            self.resume_callback.stop()
+            self.resume_callback = None
+
+        await super(AccountDeletionsModel, self).stopped()
+
+    @staticmethod
+    def __key__(gamespace_id, accounts, gamespace_only):
+        h = hashlib.sha256()
+        h.update("{0}:{1}:".format(gamespace_id, int(gamespace_only)).encode())
+        h.update(",".join(str(account) for account in accounts).encode())
+        return h.hexdigest()
+
+    async def enqueue(self, gamespace_id, accounts, gamespace_only):
+        """
+        Stores a deletion and starts processing it. The same deletion enqueued more than once (every instance
+            gets the 'DEL' event) is stored only once, a failed one is retried.
+
+        :returns an id of the deletion
+        """
+
+        accounts = sorted(set(int(account) for account in accounts))
+        key = AccountDeletionsModel.__key__(gamespace_id, accounts, gamespace_only)
+
+        try:
+            await self.db.execute(
+                """
+                    INSERT INTO `account_deletions`
+                    (`deletion_key`, `gamespace_id`, `gamespace_only`, `deletion_accounts`, `deletion_progress`)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        `deletion_attempts`=IF(`deletion_status`=%s, 0, `deletion_attempts`),
+                        `deletion_status`=IF(`deletion_status`=%s, %s, `deletion_status`);
+                """, key, gamespace_id, int(bool(gamespace_only)), ujson.dumps(accounts), "{}",
+                AccountDeletionsModel.STATUS_FAILED, AccountDeletionsModel.STATUS_FAILED,
+                AccountDeletionsModel.STATUS_PENDING)
+
+            deletion = await self.db.get(
+                """
+                    SELECT `deletion_id`
+                    FROM `account_deletions`
+                    WHERE `deletion_key`=%s
+                    LIMIT 1;
+                """, key)
+        except DatabaseError as e:
+            raise AccountDeletionsError(500, "Failed to enqueue account deletion: " + str(e.args[1]))
+
+        deletion_id = deletion["deletion_id"]
+        IOLoop.current().spawn_callback(self.process, deletion_id)
+        return deletion_id
+
+    async def get_deletion(self, deletion_id):
+        try:
+            deletion = await self.db.get(
+                """
+                    SELECT *
+                    FROM `account_deletions`
+                    WHERE `deletion_id`=%s
+                    LIMIT 1;
+                """, deletion_id)
+        except DatabaseError as e:
+            raise AccountDeletionsError(500, "Failed to get account deletion: " + str(e.args[1]))
+
+        if deletion is None:
+            raise AccountDeletionsError(404, "No such deletion")
+
+        return AccountDeletionAdapter(deletion)
+
+    async def list_deletions(self, status=STATUS_PENDING, limit=100):
+        try:
+            deletions = await self.db.query(
+                """
+                    SELECT *
+                    FROM `account_deletions`
+                    WHERE `deletion_status`=%s
+                    ORDER BY `deletion_id`
+                    LIMIT %s;
+                """, status, limit)
+        except DatabaseError as e:
+            raise AccountDeletionsError(500, "Failed to list account deletions: " + str(e.args[1]))
+
+        return list(map(AccountDeletionAdapter, deletions))
+
+    async def __resume__(self):
+        try:
+            deletions = await self.db.query(
+                """
+                    SELECT `deletion_id`
+                    FROM `account_deletions`
+                    WHERE `deletion_status`=%s AND (`deletion_lease` IS NULL OR `deletion_lease`<NOW())
+                    ORDER BY `deletion_id`
+                    LIMIT 100;
+                """, AccountDeletionsModel.STATUS_PENDING)
+        except DatabaseError as e:
+            logging.error("Failed to list pending account deletions: " + str(e.args[1]))
+            return
+
+        for deletion in deletions:
+            IOLoop.current().spawn_callback(self.process, deletion["deletion_id"])
+
+    async def __claim__(self, deletion_id):
+        """
+        Takes (or renews) the lease on the deletion, so other instances leave it alone
+        :returns True if the lease is ours
+        """
+
+        claimed = await self.db.execute(
+            """
+                UPDATE `account_deletions`
+                SET `deletion_lease`=NOW() + INTERVAL %s SECOND
+                WHERE `deletion_id`=%s AND `deletion_status`=%s
+                    AND (`deletion_lease` IS NULL OR `deletion_lease`<NOW() OR %s)
+                LIMIT 1;
+            """, AccountDeletionsModel.LEASE_TIME, deletion_id, AccountDeletionsModel.STATUS_PENDING,
+            deletion_id in self.processing)
+
+        return bool(claimed)
+
+    async def process(self, deletion_id):
+        if deletion_id in self.processing:
+            return
+
+        try:
+            if not await self.__claim__(deletion_id):
+                return
+        except DatabaseError as e:
+            logging.error("Failed to claim account deletion {0}: {1}".format(deletion_id, e.args[1]))
+            return
+
+        self.processing.add(deletion_id)
+
+        try:
+            deletion = await self.get_deletion(deletion_id)
+
+            batches = [
+                deletion.accounts[offset:offset + AccountDeletionsModel.ACCOUNTS_PER_BATCH]
+                for offset in range(0, len(deletion.accounts), AccountDeletionsModel.ACCOUNTS_PER_BATCH)
+            ]
+
+            await multi([
+                self.__process_model__(deletion, model, batches)
+                for model in self.models
+            ])
+        except Exception as e:
+            logging.exception("Account deletion {0} has failed, it will be resumed".format(deletion_id))
+            await self.__failed__(deletion_id, str(e))
+        else:
+            await self.__done__(deletion_id)
+            logging.info("Account deletion {0} is done: {1} accounts".format(deletion_id, len(deletion.accounts)))
+        finally:
+            self.processing.discard(deletion_id)
+
+    async def __process_model__(self, deletion, model, batches):
+        name = model.__class__.__name__
+        done = deletion.progress.get(name, 0)
+
+        for index in range(done, len(batches)):
+            async with self.budget:
+                while True:
+                    deleted = await model.delete_accounts_chunk(
+                        deletion.gamespace_id, batches[index], deletion.gamespace_only, self.chunk_size)
+
+                    if not deleted:
+                        break
+
+                    await sleep(self.pause)
+
+            await self.db.execute(
+                """
+                    UPDATE `account_deletions`
+                    SET `deletion_progress`=JSON_SET(`deletion_progress`, %s, %s)
+                    WHERE `deletion_id`=%s
+                    LIMIT 1;
+                """, "$.\"{0}\"".format(name), index + 1, deletion.deletion_id)
+
+            await self.__claim__(deletion.deletion_id)
+
+            logging.info("Account deletion {0}: {1} has done {2}/{3} batches".format(
+                deletion.deletion_id, name, index + 1, len(batches)))
+
+    async def __done__(self, deletion_id):
+        try:
+            await self.db.execute(
+                """
+                    UPDATE `account_deletions`
+                    SET `deletion_status`=%s, `deletion_lease`=NULL
+                    WHERE `deletion_id`=%s
+                    LIMIT 1;
+                """, AccountDeletionsModel.STATUS_DONE, deletion_id)
+        except DatabaseError as e:
+            logging.error("Failed to complete account deletion {0}: {1}".format(deletion_id, e.args[1]))
+
+    async def __failed__(self, deletion_id, reason):
+        try:
+            await self.db.execute(
+                """
+                    UPDATE `account_deletions`
+                    SET `deletion_attempts`=`deletion_attempts` + 1, `deletion_lease`=NULL,
+                        `deletion_status`=IF(`deletion_attempts`>=%s, %s, `deletion_status`)
+                    WHERE `deletion_id`=%s
+                    LIMIT 1;
+                """, AccountDeletionsModel.MAX_ATTEMPTS, AccountDeletionsModel.STATUS_FAILED, deletion_id)
+        except DatabaseError as e:
+            logging.error("Failed to update account deletion {0} ({1}): {2}".format(deletion_id, reason, e.args[1]))
@@ -1,4 +1,5 @@
-from tornado.gen import multi
+from tornado.gen import multi, sleep
+from tornado.ioloop import IOLoop, PeriodicCallback
 
 from anthill.common import Flags, Enum
 from anthill.common.internal import Internal, InternalError
@@ -8,9 +9,18 @@ from anthill.common.database import DatabaseError, DuplicateError
 from anthill.common.profile import DatabaseProfile, NoDataError, ProfileError
 
 from .request import RequestType, NoSuchRequest, RequestError
+from .patch import PatchableProfile, ProfilePatch
+from .buffer import ProfileUpdateBuffer
+from .nameindex import NameIndex
+from .permissions import GroupPermissions
+from .deletion import delete_accounts
+from .schema import add_missing_columns, add_missing_indexes
 
 import ujson
+import copy
+import hashlib
 import logging
+import random
 import re
 
 
@@ -31,7 +41,7 @@ class GroupError(Exception):
         return str(self.code) + ": " + str(self.message)
 
 
-class GroupParticipationProfile(DatabaseProfile):
+class GroupParticipationProfile(PatchableProfile):
     @staticmethod
     def __encode_profile__(profile):
         return ujson.dumps(profile)
@@ -74,8 +84,13 @@ class GroupParticipationProfile(DatabaseProfile):
                 LIMIT 1;
             """, encoded, self.account_id, self.group_id, self.gamespace_id)
 
+    def get_patch_target(self):
+        return "group_participants", "participation_profile", \
+            "`account_id`=%s AND `group_id`=%s AND `gamespace_id`=%s", \
+            [self.account_id, self.group_id, self.gamespace_id]
 
-class GroupProfile(DatabaseProfile):
+
+class GroupProfile(PatchableProfile):
     @staticmethod
     def __encode_profile__(profile):
         return ujson.dumps(profile)
@@ -94,7 +109,7 @@ class GroupProfile(DatabaseProfile):
             """
                 SELECT `group_profile`
                 FROM `groups`
-                WHERE `group_id`=%s AND `gamespace_id`=%s
+                WHERE `group_id`=%s AND `gamespace_id`=%s AND `group_deleted`=0
                 LIMIT 1
                 FOR UPDATE;
             """, self.group_id, self.gamespace_id)
@@ -117,6 +132,10 @@ class GroupProfile(DatabaseProfile):
                 LIMIT 1;
             """, encoded, self.group_id, self.gamespace_id)
 
+    def get_patch_target(self):
+        return "groups", "group_profile", "`group_id`=%s AND `gamespace_id`=%s AND `group_deleted`=0", \
+            [self.group_id, self.gamespace_id]
+
 
 class GroupBatchProfile(DatabaseProfile):
     @staticmethod
@@ -126,7 +145,8 @@ class GroupBatchProfile(DatabaseProfile):
     def __init__(self, db, gamespace_id, group_ids):
         super(GroupBatchProfile, self).__init__(db)
         self.gamespace_id = gamespace_id
-        self.group_ids = group_ids
+        # always lock the rows in the same order, so overlapping batches wait for each other instead of deadlocking
+        self.group_ids = sorted(group_ids, key=int)
 
     @staticmethod
     def __parse_profile__(profile):
@@ -137,13 +157,11 @@ class GroupBatchProfile(DatabaseProfile):
             """
                 SELECT `group_profile`, `group_id`
                 FROM `groups`
-                WHERE `group_id` IN %s AND `gamespace_id`=%s
+                WHERE `group_id` IN %s AND `gamespace_id`=%s AND `group_deleted`=0
+                ORDER BY `group_id`
                 FOR UPDATE;
             """, self.group_ids, self.gamespace_id)
 
-        if len(groups) != len(self.group_ids):
-            raise NoDataError()
-
         return {
             str(group["group_id"]): GroupProfile.__parse_profile__(group["group_profile"])
             for group in groups
@@ -160,8 +178,8 @@ class GroupBatchProfile(DatabaseProfile):
         args = []
         values = []
 
-        for group_id, group_profile in data.items():
-            args.extend([group_id, self.gamespace_id, GroupProfile.__encode_profile__(group_profile)])
+        for group_id in sorted(data.keys(), key=int):
+            args.extend([group_id, self.gamespace_id, GroupProfile.__encode_profile__(data[group_id])])
             values.append("(%s, %s, 0, %s)")
 
         await self.conn.execute(
@@ -173,6 +191,59 @@ class GroupBatchProfile(DatabaseProfile):
                 UPDATE group_profile=VALUES(group_profile);
             """.format(",".join(values)), *args)
 
+    async def set_batch_updates(self, updates, atomic=False):
+        """
+        Applies a list of updates to every group's profile, in order, with a single write per group.
+
+        :param updates: a dict group_id -> list of (fields, path, merge) tuples
+        :param atomic: write nothing if any of the updates fails
+        :returns a dict group_id -> list of (result, error) tuples, one for each update. The result is the profile
+            (or the value at path) right after that update, the error is {"code": ..., "message": ...} or None.
+        """
+
+        await self.init()
+
+        try:
+            existing = await self.get()
+
+            results = {}
+            updated = {}
+
+            for group_id, group_updates in updates.items():
+                group_id = str(group_id)
+                group_results = []
+                results[group_id] = group_results
+
+                if group_id not in existing:
+                    group_results.extend((None, {"code": 404, "message": "No such group"}) for _ in group_updates)
+                    continue
+
+                profile = existing[group_id]
+
+                for fields, path, merge in group_updates:
+                    # merge_data copies the root only, so every update gets a copy of its own: a failed one leaves
+                    #   nothing half-applied behind, and the results of earlier ones are not changed by later ones
+                    source = copy.deepcopy(profile) if len(group_updates) > 1 else profile
+
+                    try:
+                        merged = DatabaseProfile.merge_data(source, fields, path, merge=merge)
+                    except ProfileError as e:
+                        group_results.append((None, {"code": 409, "message": e.message}))
+                    else:
+                        profile = merged
+                        result = DatabaseProfile.__get_field__(profile, list(path)) if path else profile
+                        group_results.append((result, None))
+                        updated[group_id] = profile
+
+            failed = any(error for group_results in results.values() for result, error in group_results)
+
+            if updated and not (atomic and failed):
+                await self.update(updated)
+        finally:
+            await self.release()
+
+        return results
+
 
 class GroupAdapter(object):
     def __init__(self, data):
@@ -188,16 +259,81 @@ class GroupAdapter(object):
         return str(self.owner) == str(owner)
 
 
+class RankedGroupAdapter(GroupAdapter):
+    def __init__(self, data):
+        super(RankedGroupAdapter, self).__init__(data)
+        self.score = data.get("rank_score")
+
+    def cursor(self):
+        return "{0}:{1}".format(repr(float(self.score)), self.group_id)
+
+
 class GroupParticipationAdapter(object):
     def __init__(self, data):
         self.account = int(data.get("account_id", 0))
         self.role = data.get("participation_role", 0)
-        self.permissions = set(data.get("participation_permissions", "").split(","))
+        # NULL for participations that have not been migrated yet, see GroupsModel.__backfill_permission_bits__
+        self.permission_bits = data.get("participation_permission_bits")
         self.profile = data.get("participation_profile", {})
+        self.__permission_names = data.get("participation_permissions", "")
+        self.__permissions = None
+
+    @property
+    def permissions(self):
+        # most of the reads never look at the names, so they are only parsed when asked for
+        if self.__permissions is None:
+            self.__permissions = set(self.__permission_names.split(","))
+        return self.__permissions
+
+    def has_permission(self, permission, bits=None):
+        """
+        :param bits: permission name -> bit of the gamespace (see GroupPermissions.get_bits), without it
+            only built-in permissions are checked by their bits
+        """
 
-    def has_permission(self, permission):
+        bit = (bits or GroupPermissions.BUILTIN_BITS).get(permission)
+
+        if self.permission_bits is not None and bit is not None:
+            return bool(self.permission_bits & (1 << bit))
+
+        # kept by name only (or not migrated yet)
         return permission in self.permissions
 
+    def granted(self, permissions, bits=None):
+        """
+        :returns a list of @permissions this participation has
+        """
+
+        return [permission for permission in set(permissions) if self.has_permission(permission, bits)]
+
+
+class GroupAuthorizationAdapter(object):
+    """
+    Everything a moderation action is authorized with, fetched in one query (see GroupsModel.get_group_authorization):
+        the group (without its profile), the participation of the account that acts, and the participation
+        of the account that is acted upon. Either participation is None if there is no such participation.
+    """
+
+    def __init__(self, data):
+        self.group = GroupAdapter(data)
+        self.actor = GroupAuthorizationAdapter.__participation__(data, "actor_")
+        self.target = GroupAuthorizationAdapter.__participation__(data, "target_")
+
+    @staticmethod
+    def __participation__(data, prefix):
+        if data.get(prefix + "account_id") is None:
+            return None
+
+        return GroupParticipationAdapter({
+            "account_id": data[prefix + "account_id"],
+            "participation_role": data[prefix + "role"],
+            "participation_permissions": data[prefix + "permissions"],
+            "participation_permission_bits": data[prefix + "permission_bits"]
+        })
+
+    def actor_role_higher(self):
+        return self.actor is not None and self.target is not None and self.actor.role > self.target.role
+
 
 class GroupFlags(Flags):
     MESSAGE_SUPPORT = 'messages'
@@ -237,38 +373,217 @@ class GroupsModel(Model):
     MESSAGE_GROUP_REQUEST_APPROVED = "group_request_approved"
     MESSAGE_GROUP_REQUEST_REJECTED = "group_request_rejected"
     MESSAGE_GROUP_INVITE_REJECTED = "group_invite_rejected"
+    MESSAGE_GROUP_DISBANDED = "group_disbanded"
 
-    def __init__(self, db, requests):
+    DEFAULT_SEARCH_LIMIT = 50
+    MAX_SEARCH_LIMIT = 100
+    SEARCH_SPECIAL_CHARACTERS = re.compile(r'[+\-<>()~*"@]')
+
+    NAME_INDEX_BUILD_CHUNK = 10000
+    MAX_NAME_INDEX_CANDIDATES = 1000
+
+    RANK_FIELD_PATTERN = re.compile(r"^[A-Za-z0-9_-]+(\.[A-Za-z0-9_-]+)*$")
+    MAX_TOP_LIMIT = 100
+
+    BATCH_CHUNK_SIZE = 100
+    BATCH_MAX_ATTEMPTS = 4
+    BATCH_RETRY_DELAY = 0.05
+
+    # deadlock found, lock wait timeout exceeded
+    RETRY_ERRORS = {1213, 1205}
+
+    DISBAND_CHUNK_SIZE = 500
+    DISBAND_PAUSE = 0.05
+    DISBAND_MAX_ATTEMPTS = 5
+    DISBAND_RETRY_DELAY = 1.0
+    # seconds between looking for disbanded groups that have not been deleted (failed, or left by another instance)
+    DISBAND_SWEEP_INTERVAL = 300
+
+    COLUMNS = [
+        ("group_deleted", "tinyint(1) NOT NULL DEFAULT '0'")
+    ]
+
+    INDEXES = [
+        ("group_deleted", "(`group_deleted`)"),
+        # name_prefix searches, see search_groups
+        ("gamespace_name", "(`gamespace_id`, `group_name`)")
+    ]
+
+    PARTICIPANT_COLUMNS = [
+        ("participation_permission_bits", "bigint(20) unsigned DEFAULT NULL")
+    ]
+
+    PERMISSION_BITS_BACKFILL_GROUPS = 1000
+    PERMISSION_BITS_BACKFILL_PAUSE = 0.05
+
+    def __init__(self, db, requests, coalesce_window=0.1, rank_fields=None, name_index=False):
         self.db = db
         self.internal = Internal()
         self.requests = requests
+        self.profile_buffer = ProfileUpdateBuffer(self.apply_group_updates, coalesce_window)
+        # gamespace_id -> group names, see search_groups
+        self.name_index = NameIndex() if name_index else None
+        self.permissions = GroupPermissions(db)
+        # groups being disbanded by this instance, see __disband__
+        self.disbanding = set()
+        self.disband_sweep = None
+
+        # field -> a generated column that mirrors the field, see __setup_rank_columns__
+        self.rank_columns = {}
+
+        for field in (rank_fields or []):
+            if not GroupsModel.RANK_FIELD_PATTERN.match(field):
+                logging.error("Bad group rank field: '{0}'".format(field))
+                continue
+
+            self.rank_columns[field] = GroupsModel.rank_column(field)
 
     def get_setup_db(self):
         return self.db
 
     def get_setup_tables(self):
-        return ["groups", "group_participants"]
+        return ["groups", "group_participants", "group_permissions"]
+
+    async def started(self, application):
+        await super(GroupsModel, self).started(application)
+        await add_missing_columns(self.db, "groups", GroupsModel.COLUMNS)
+        await add_missing_indexes(self.db, "groups", GroupsModel.INDEXES)
+
+        await add_missing_columns(self.db, "group_participants", GroupsModel.PARTICIPANT_COLUMNS)
+        IOLoop.current().spawn_callback(self.__backfill_permission_bits__)
+
+        await self.__setup_rank_columns__()
+        await self.__build_name_index__()
+        await self.__resume_disbanding__()
+
+        self.disband_sweep = PeriodicCallback(
+            self.__resume_disbanding__, GroupsModel.DISBAND_SWEEP_INTERVAL * 1000)
+        self.disband_sweep.start()
+
+    async def stopped(self):
+        if self.disband_sweep:
+            self.disband_sweep.stop()
+            self.disband_sweep = None
+
+        await self.profile_buffer.flush()
+        await super(GroupsModel, self).stopped()
+
+    async def __build_name_index__(self):
+        if self.name_index is None:
+            return
+
+        self.name_index.clear()
+        last_group_id = 0
+
+        try:
+            while True:
+                groups = await self.db.query(
+                    """
+                        SELECT `group_id`, `gamespace_id`, `group_name`
+                        FROM `groups`
+                        WHERE `group_id`>%s AND `group_name` IS NOT NULL AND `group_deleted`=0
+                        ORDER BY `group_id`
+                        LIMIT %s;
+                    """, last_group_id, GroupsModel.NAME_INDEX_BUILD_CHUNK)
+
+                if not groups:
+                    break
+
+                for group in groups:
+                    self.name_index.add(
+                        group["gamespace_id"], group["group_id"], group["group_name"], defer=True)
+
+                last_group_id = groups[-1]["group_id"]
+        except DatabaseError as e:
+            logging.error("Failed to build group name index, falling back to FULLTEXT search: " + str(e.args[1]))
+            return
+
+        self.name_index.sort()
+        self.name_index.ready = True
+        logging.info("Group name index built: {0} groups".format(self.name_index.size()))
+
+    @staticmethod
+    def rank_column(field):
+        """
+        :returns a name of the generated column of a rank field: readable, but unique to the field (like 'a.b'
+            and 'a_b', that only differ by the hash), and short enough for MySQL
+        """
+
+        digest = hashlib.md5(field.encode("utf-8")).hexdigest()[:8]
+        return "rank_{0}_{1}".format(re.sub(r"[^A-Za-z0-9_]", "_", field)[:48], digest)
+
+    async def __setup_rank_columns__(self):
+        """
+        Every rank field is mirrored into a virtual generated column with an index (gamespace_id, column),
+            so MySQL keeps it up to date on every profile update, and the top can be read straight from the index.
+        """
+
+        if not self.rank_columns:
+            return
+
+        fields = {}
+
+        for field, column in self.rank_columns.items():
+            if column in fields:
+                # one of them would be ranked by the data of the other one
+                raise GroupError(500, "Rank fields '{0}' and '{1}' have the same column '{2}'".format(
+                    fields[column], field, column))
+
+            fields[column] = field
+
+        columns = await self.db.query(
+            """
+                SHOW COLUMNS FROM `groups` LIKE %s;
+            """, "rank\\_%")
+
+        existing = set(column["Field"] for column in columns)
+
+        for field, column in self.rank_columns.items():
+            if column in existing:
+                continue
+
+            path = ProfilePatch.format_path(field.split("."))
+
+            try:
+                await self.db.execute(
+                    """
+                        ALTER TABLE `groups`
+                        ADD COLUMN `{0}` DOUBLE AS (
+                            IF(JSON_TYPE(JSON_EXTRACT(`group_profile`, '{1}'))
+                                IN ('INTEGER', 'UNSIGNED INTEGER', 'DOUBLE', 'DECIMAL'),
+                               JSON_EXTRACT(`group_profile`, '{1}'), NULL)) VIRTUAL,
+                        ADD INDEX `{0}` (`gamespace_id`, `{0}`);
+                    """.format(column, path))
+            except DatabaseError as e:
+                logging.error("Failed to create rank column for field '{0}': {1}".format(field, e.args[1]))
+            else:
+                logging.warning("Created rank column for field '{0}'".format(field))
 
     def has_delete_account_event(self):
         return True
 
-    async def accounts_deleted(self, gamespace, accounts, gamespace_only):
+    async def delete_accounts_chunk(self, gamespace, accounts, gamespace_only, limit):
         try:
             if gamespace_only:
-                await self.db.execute(
+                return await self.db.execute(
                     """
                         DELETE FROM `group_participants`
-                        WHERE `gamespace_id`=%s AND `account_id` IN %s;
-                    """, gamespace, accounts)
+                        WHERE `account_id` IN %s AND `gamespace_id`=%s
+                        LIMIT %s;
+                    """, accounts, gamespace, limit)
             else:
-                await self.db.execute(
+                return await self.db.execute(
                     """
                         DELETE FROM `group_participants`
-                        WHERE `account_id` IN %s;
-                    """, accounts)
+                        WHERE `account_id` IN %s
+                        LIMIT %s;
+                    """, accounts, limit)
         except DatabaseError as e:
             raise GroupError(500, "Failed to delete group participations: " + e.args[1])
 
+    async def accounts_deleted(self, gamespace, accounts, gamespace_only):
+        await delete_accounts(self, gamespace, accounts, gamespace_only)
+
     @validate(gamespace_id="int", group_profile="json_dict", group_flags=GroupFlags,
               group_join_method=GroupJoinMethod, max_members="int", account_id="int",
               participation_profile="json_dict", group_name="str")
@@ -308,8 +623,8 @@ class GroupsModel(Model):
                     """
                         INSERT INTO `group_participants`
                         (`gamespace_id`, `group_id`, `account_id`, `participation_role`, `participation_profile`,
-                            `participation_permissions`)
-                        VALUES (%s, %s, %s, %s, %s, %s);
+                            `participation_permissions`, `participation_permission_bits`)
+                        VALUES (%s, %s, %s, %s, %s, %s, 0);
                     """, gamespace_id, group_id, owner_account_id, GroupsModel.MAXIMUM_ROLE,
                     ujson.dumps(participation_profile), "")
             except DatabaseError as e:
@@ -334,16 +649,23 @@ class GroupsModel(Model):
 
                     raise GroupError(500, "Failed to create in-message group: " + str(e))
 
+        if group_name and self.name_index is not None:
+            self.name_index.add(gamespace_id, group_id, group_name)
+
         return group_id
 
     @validate(gamespace_id="int", group_id="int", group_profile="json_dict",
-              path="json_list_of_strings", merge="bool")
-    async def update_group_no_check(self, gamespace_id, group_id, group_profile, path=None, merge=True):
+              path="json_list_of_strings", merge="bool", server_side="bool")
+    async def update_group_no_check(self, gamespace_id, group_id, group_profile, path=None, merge=True,
+                                    server_side=False):
 
         profile = GroupProfile(self.db, gamespace_id, group_id)
 
         try:
-            result = await profile.set_data(group_profile, path=path, merge=merge)
+            if server_side:
+                result = await profile.patch_data(group_profile, path, merge=merge)
+            else:
+                result = await profile.set_data(group_profile, path=path, merge=merge)
         except NoDataError:
             raise GroupError(404, "No such group")
         except ProfileError as e:
@@ -351,29 +673,115 @@ class GroupsModel(Model):
 
         return result
 
-    @validate(gamespace_id="int", group_profiles="json_dict",
-              path="json_list_of_strings", merge="bool")
-    async def update_groups_no_check(self, gamespace_id, group_profiles, path=None, merge=True):
-
-        calls = {}
+    @validate(gamespace_id="int", group_id="int", operations="json_list")
+    async def update_group_counters_no_check(self, gamespace_id, group_id, operations):
 
-        for group_id, group_profile in group_profiles.items():
-            profile = GroupProfile(self.db, gamespace_id, group_id)
-            calls[group_id] = profile.set_data(group_profile, path=path, merge=merge)
+        profile = GroupProfile(self.db, gamespace_id, group_id)
 
         try:
-            result = await multi(calls)
+            result = await profile.update_counters(operations)
         except NoDataError:
-            raise GroupError(404, "No such group(s)")
+            raise GroupError(404, "No such group")
         except ProfileError as e:
             raise GroupError(409, "Failed to update group profile: " + e.message)
 
         return result
 
+    @validate(gamespace_id="int", group_id="int", account_id="int", operations="json_list",
+              notify="json_dict", authoritative="bool")
+    async def update_group_counters(self, gamespace_id, group_id, account_id, operations,
+                                    notify=None, authoritative=False):
+
+        has_participation = await self.get_group_participation(gamespace_id, group_id, account_id)
+        if not has_participation:
+            raise GroupError(404, "Player has not participated this group")
+
+        result = await self.update_group_counters_no_check(gamespace_id, group_id, operations)
+
+        if notify:
+            await self.__send_message__(
+                gamespace_id, GroupsModel.GROUP_CLASS, str(group_id), account_id,
+                GroupsModel.MESSAGE_GROUP_PROFILE_UPDATED, notify, authoritative=authoritative)
+
+        return result
+
+    @validate(gamespace_id="int", group_id="int", account_id="int", operations="json_list")
+    async def update_group_participation_counters_no_check(self, gamespace_id, group_id, account_id, operations):
+
+        profile = GroupParticipationProfile(self.db, gamespace_id, group_id, account_id)
+
+        try:
+            result = await profile.update_counters(operations)
+        except NoDataError:
+            raise NoSuchParticipation()
+        except ProfileError as e:
+            raise GroupError(409, "Failed to update participation profile: " + e.message)
+
+        return result
+
+    @validate(gamespace_id="int", group_id="int", updater_account_id="int",
+              participation_account_id="int", operations="json_list",
+              notify="json_dict", authoritative="bool")
+    async def update_group_participation_counters(self, gamespace_id, group_id, updater_account_id,
+                                                  participation_account_id, operations,
+                                                  notify=None, authoritative=False):
+
+        authorization = await self.get_group_authorization(
+            gamespace_id, group_id, updater_account_id, participation_account_id)
+
+        if not authorization.group.is_owner(updater_account_id):
+            if str(participation_account_id) != str(updater_account_id):
+                if not authorization.actor_role_higher():
+                    raise GroupError(406, "Your role should be higher to edit other player's participation profiles")
+
+        result = await self.update_group_participation_counters_no_check(
+            gamespace_id, group_id, participation_account_id, operations)
+
+        if notify:
+            await self.__send_message__(
+                gamespace_id, GroupsModel.GROUP_CLASS, str(group_id), updater_account_id,
+                GroupsModel.MESSAGE_PARTICIPATION_PROFILE_UPDATED, notify, authoritative=authoritative)
+
+        return result
+
+    @validate(gamespace_id="int", group_profiles="json_dict",
+              path="json_list_of_strings", merge="bool", server_side="bool")
+    async def update_groups_no_check(self, gamespace_id, group_profiles, path=None, merge=True, server_side=False):
+
+        """
+        Updates every group in its own transaction, concurrently.
+        :returns a tuple (updated, failed), same as update_groups
+        """
+
+        async def update(group_id, group_profile):
+            try:
+                result = await self.update_group_no_check(
+                    gamespace_id, group_id, group_profile, path=path, merge=merge, server_side=server_side)
+            except GroupError as e:
+                return None, {"code": e.code, "message": e.message}
+            else:
+                return result, None
+
+        results = await multi({
+            str(group_id): update(group_id, group_profile)
+            for group_id, group_profile in group_profiles.items()
+        })
+
+        updated = {}
+        failed = {}
+
+        for group_id, (result, error) in results.items():
+            if error:
+                failed[group_id] = error
+            else:
+                updated[group_id] = result
+
+        return updated, failed
+
     @validate(gamespace_id="int", group_id="int", account_id="int", group_profile="json_dict",
-              merge="bool", notify="json_dict", authoritative="bool")
+              merge="bool", notify="json_dict", authoritative="bool", server_side="bool")
     async def update_group(self, gamespace_id, group_id, account_id, group_profile, merge=True,
-                           notify=None, authoritative=False):
+                           notify=None, authoritative=False, server_side=False):
 
         has_participation = await self.get_group_participation(gamespace_id, group_id, account_id)
         if not has_participation:
@@ -382,7 +790,10 @@ class GroupsModel(Model):
         profile = GroupProfile(self.db, gamespace_id, group_id)
 
         try:
-            result = await profile.set_data(group_profile, None, merge=merge)
+            if server_side:
+                result = await profile.patch_data(group_profile, None, merge=merge)
+            else:
+                result = await profile.set_data(group_profile, None, merge=merge)
         except NoDataError:
             raise GroupError(404, "No such group")
         except ProfileError as e:
@@ -395,20 +806,148 @@ class GroupsModel(Model):
 
         return result
 
-    @validate(gamespace_id="int", group_profiles="json_dict_of_dicts", merge="bool")
-    async def update_groups(self, gamespace_id, group_profiles, merge=True):
+    @validate(gamespace_id="int", group_profiles="json_dict_of_dicts", merge="bool", atomic="bool")
+    async def update_groups(self, gamespace_id, group_profiles, merge=True, atomic=False):
+        """
+        Updates profiles of several groups, see apply_group_updates. One missing group (or a failed function)
+            does not fail the whole batch, unless @atomic is set: then all groups are updated in one transaction,
+            and nothing is written if any of them fails.
 
-        profiles = GroupBatchProfile(self.db, gamespace_id, list(group_profiles.keys()))
+        :returns a tuple (updated, failed), where updated is a dict group_id -> new profile, and failed is a dict
+            group_id -> {"code": ..., "message": ...}
+        """
 
-        try:
-            result = await profiles.set_data(group_profiles, None, merge=merge)
-        except NoDataError:
-            raise GroupError(404, "No such group")
-        except ProfileError as e:
-            raise GroupError(409, "Failed to update group profile: " + e.message)
+        results = await self.apply_group_updates(gamespace_id, {
+            group_id: [(group_profile, None, merge)]
+            for group_id, group_profile in group_profiles.items()
+        }, atomic=atomic)
+
+        updated = {}
+        failed = {}
+
+        for group_id, ((result, error),) in results.items():
+            if error:
+                failed[group_id] = error
+            else:
+                updated[group_id] = result
+
+        if atomic and failed:
+            # nothing has been written
+            return {}, failed
+
+        return updated, failed
+
+    @validate(gamespace_id="int", group_profiles="json_dict", path="json_list_of_strings", merge="bool")
+    async def update_groups_coalesced(self, gamespace_id, group_profiles, path=None, merge=True):
+        """
+        Same as update_groups, but the updates are put into a write-combining buffer, so several updates of the same
+            group that come within a short window result in a single write (see ProfileUpdateBuffer).
+            Returns once the updates are written.
+
+        :returns a tuple (updated, failed), same as update_groups
+        """
+
+        updated = {}
+        failed = {}
+        buffered = {}
+
+        # a bad update fails this call only, not the whole window it would be flushed with
+        for group_id, group_profile in group_profiles.items():
+            try:
+                key = int(group_id)
+            except (TypeError, ValueError):
+                failed[group_id] = {"code": 400, "message": "Bad group id"}
+                continue
+
+            if not isinstance(group_profile, dict):
+                failed[group_id] = {"code": 400, "message": "Group profile should be a dict"}
+                continue
+
+            buffered[group_id] = (key, group_profile)
+
+        results = await multi({
+            group_id: self.profile_buffer.update(gamespace_id, key, group_profile, path=path, merge=merge)
+            for group_id, (key, group_profile) in buffered.items()
+        })
+
+        for group_id, (result, error) in results.items():
+            if error:
+                failed[group_id] = error
+            else:
+                updated[group_id] = result
+
+        return updated, failed
+
+    @validate(gamespace_id="int", group_id="int", group_profile="json_dict", path="json_list_of_strings",
+              merge="bool")
+    async def update_group_coalesced(self, gamespace_id, group_id, group_profile, path=None, merge=True):
+
+        result, error = await self.profile_buffer.update(
+            gamespace_id, group_id, group_profile, path=path, merge=merge)
+
+        if error:
+            raise GroupError(error["code"], error["message"])
 
         return result
 
+    async def apply_group_updates(self, gamespace_id, updates, atomic=False):
+        """
+        Applies lists of profile updates to several groups, in chunks of BATCH_CHUNK_SIZE groups, each chunk in its
+            own transaction. Rows are locked in group_id order and a chunk is retried if it deadlocks anyway.
+
+        :param updates: a dict group_id -> list of (fields, path, merge) tuples
+        :param atomic: apply all of the updates in one transaction, and write nothing if any of them fails
+        :returns a dict group_id -> list of (result, error) tuples, see GroupBatchProfile.set_batch_updates
+        """
+
+        try:
+            group_ids = sorted(updates.keys(), key=int)
+        except ValueError:
+            raise GroupError(400, "Bad group id")
+
+        results = {}
+        chunk_size = max(len(group_ids), 1) if atomic else GroupsModel.BATCH_CHUNK_SIZE
+
+        for offset in range(0, len(group_ids), chunk_size):
+            chunk = {
+                group_id: updates[group_id]
+                for group_id in group_ids[offset:offset + chunk_size]
+            }
+
+            try:
+                chunk_results = await self.__update_groups_chunk__(gamespace_id, chunk, atomic=atomic)
+            except GroupError as e:
+                chunk_results = {
+                    str(group_id): [(None, {"code": e.code, "message": e.message}) for _ in group_updates]
+                    for group_id, group_updates in chunk.items()
+                }
+
+            results.update(chunk_results)
+
+        return results
+
+    async def __update_groups_chunk__(self, gamespace_id, updates, atomic=False):
+        delay = GroupsModel.BATCH_RETRY_DELAY
+
+        for attempt in range(0, GroupsModel.BATCH_MAX_ATTEMPTS):
+            profiles = GroupBatchProfile(self.db, gamespace_id, list(updates.keys()))
+
+            try:
+                return await profiles.set_batch_updates(updates, atomic=atomic)
+            except DatabaseError as e:
+                if e.args[0] not in GroupsModel.RETRY_ERRORS:
+                    raise GroupError(500, "Failed to update group profiles: " + str(e.args[1]))
+
+                logging.warning("Batch group profile update failed ({0}), attempt {1}".format(
+                    e.args[1], attempt + 1))
+            except ProfileError as e:
+                raise GroupError(409, "Failed to update group profile: " + e.message)
+
+            await sleep(delay * (1 + random.random()))
+            delay *= 2
+
+        raise GroupError(503, "Failed to update group profiles: too many concurrent updates")
+
     @validate(gamespace_id="int", group_id="int", account_id="int", name="str", notify="json_dict")
     async def rename_group(self, gamespace_id, group_id, account_id, name, notify=None):
 
@@ -420,10 +959,13 @@ class GroupsModel(Model):
             """
                 UPDATE `groups`
                 SET `group_name`=%s
-                WHERE `gamespace_id`=%s AND `group_id`=%s
+                WHERE `gamespace_id`=%s AND `group_id`=%s AND `group_deleted`=0
                 LIMIT 1;
             """, name, gamespace_id, group_id)
 
+        if self.name_index is not None:
+            self.name_index.add(gamespace_id, group_id, name)
+
         if notify:
             await self.__send_message__(
                 gamespace_id, GroupsModel.GROUP_CLASS, str(group_id), account_id,
@@ -459,10 +1001,13 @@ class GroupsModel(Model):
             u"""
                 UPDATE `groups`
                 SET {0}
-                WHERE `gamespace_id`=%s AND `group_id`=%s
+                WHERE `gamespace_id`=%s AND `group_id`=%s AND `group_deleted`=0
                 LIMIT 1;
             """.format(u", ".join(query)), *data)
 
+        if name and self.name_index is not None:
+            self.name_index.add(gamespace_id, group_id, name)
+
         if notify:
             await self.__send_message__(
                 gamespace_id, GroupsModel.GROUP_CLASS, str(group_id), account_id,
@@ -470,24 +1015,26 @@ class GroupsModel(Model):
 
     @validate(gamespace_id="int", group_id="int", updater_account_id="int",
               participation_account_id="int", participation_profile="json_dict",
-              merge="bool", notify="json_dict", authoritative="bool")
+              merge="bool", notify="json_dict", authoritative="bool", server_side="bool")
     async def update_group_participation(self, gamespace_id, group_id, updater_account_id, participation_account_id,
-                                         participation_profile, merge=True, notify=None, authoritative=False):
+                                         participation_profile, merge=True, notify=None, authoritative=False,
+                                         server_side=False):
 
-        group = await self.get_group(gamespace_id, group_id)
+        authorization = await self.get_group_authorization(
+            gamespace_id, group_id, updater_account_id, participation_account_id)
 
-        if not group.is_owner(updater_account_id):
+        if not authorization.group.is_owner(updater_account_id):
             if str(participation_account_id) != str(updater_account_id):
-                higher = await self.check_group_participation_role_higher(
-                    gamespace_id, group_id, updater_account_id, participation_account_id)
-
-                if not higher:
+                if not authorization.actor_role_higher():
                     raise GroupError(406, "Your role should be higher to edit other player's participation profiles")
 
         profile = GroupParticipationProfile(self.db, gamespace_id, group_id, participation_account_id)
 
         try:
-            result = await profile.set_data(participation_profile, None, merge=merge)
+            if server_side:
+                result = await profile.patch_data(participation_profile, None, merge=merge)
+            else:
+                result = await profile.set_data(participation_profile, None, merge=merge)
         except NoDataError:
             raise NoSuchParticipation()
         except ProfileError as e:
@@ -507,77 +1054,49 @@ class GroupsModel(Model):
             self, gamespace_id, group_id, updater_account_id, participation_account_id,
             participation_role, participation_permissions, notify=None, authoritative=False):
 
-        group = await self.get_group(gamespace_id, group_id)
-
-        if group.is_owner(updater_account_id):
-            await self.__internal_update_group_participation_permissions__(
-                gamespace_id, group_id, updater_account_id, participation_account_id,
-                participation_role, participation_permissions,
-                notify=notify, authoritative=authoritative)
-        else:
-
-            if str(updater_account_id) == str(participation_account_id):
-
-                # that makes sure you can only downgrade your own role but not upgrade
-                def check_increase(old):
-                    return old >= participation_role
-
-                await self.__internal_update_group_participation_permissions__(
-                    gamespace_id, group_id, updater_account_id, participation_account_id, participation_role,
-                    participation_permissions, role_callback=check_increase,
-                    notify=notify, authoritative=authoritative)
-            else:
-
-                my_participation = await self.get_group_participation(
-                    gamespace_id, group_id, updater_account_id)
-
-                my_role = my_participation.role
-
-                participation_permissions = list(set(participation_permissions) & my_participation.permissions)
+        async with self.db.acquire(auto_commit=False) as db:
+            try:
+                # the group and both participations are locked until the update is committed
+                authorization = await self.get_group_authorization(
+                    gamespace_id, group_id, updater_account_id, participation_account_id, lock=True, db=db)
 
-                if participation_role >= my_role:
-                    raise GroupError(406, "You cannot set a role >= than yours")
+                participation = authorization.target
 
-                # that makes sure you cannot edit roles of another player with role higher than yours
-                def check_roles(old):
-                    return my_role > old
+                if participation is None:
+                    raise NoSuchParticipation()
 
-                await self.__internal_update_group_participation_permissions__(
-                    gamespace_id, group_id, updater_account_id, participation_account_id,
-                    participation_role, participation_permissions, role_callback=check_roles,
-                    notify=notify, authoritative=authoritative)
+                if not authorization.group.is_owner(updater_account_id):
+                    if str(updater_account_id) == str(participation_account_id):
+                        # that makes sure you can only downgrade your own role but not upgrade
+                        if participation.role < participation_role:
+                            raise GroupError(409, "Cannot update role")
+                    else:
+                        my_participation = authorization.actor
 
-    async def __internal_update_group_participation_permissions__(
-            self, gamespace_id, group_id, updater_account_id, account_id, participation_role,
-            participation_permissions, role_callback=None, notify=None, authoritative=False):
+                        if my_participation is None:
+                            raise NoSuchParticipation()
 
-        async with self.db.acquire(auto_commit=False) as db:
-            try:
-                role = await db.get(
-                    """
-                        SELECT `participation_role`, `participation_permissions`
-                        FROM `group_participants`
-                        WHERE `account_id`=%s AND `group_id`=%s AND `gamespace_id`=%s
-                        LIMIT 1
-                        FOR UPDATE;
-                    """, account_id, group_id, gamespace_id)
+                        participation_permissions = my_participation.granted(
+                            participation_permissions, await self.__permission_registry__(gamespace_id))
 
-                if not role:
-                    raise NoSuchParticipation()
+                        if participation_role >= my_participation.role:
+                            raise GroupError(406, "You cannot set a role >= than yours")
 
-                if role_callback:
-                    old_role = role["participation_role"]
+                        # that makes sure you cannot edit roles of another player with role higher than yours
+                        if not authorization.actor_role_higher():
+                            raise GroupError(409, "Cannot update role")
 
-                    if not role_callback(old_role):
-                        raise GroupError(409, "Cannot update role")
+                permission_bits = await self.__permission_bits__(gamespace_id, participation_permissions)
 
                 await db.execute(
                     """
                         UPDATE `group_participants`
-                        SET `participation_role`=%s, `participation_permissions`=%s
+                        SET `participation_role`=%s, `participation_permissions`=%s,
+                            `participation_permission_bits`=%s
                         WHERE `account_id`=%s AND `group_id`=%s AND `gamespace_id`=%s
                         LIMIT 1;
-                    """, participation_role, ",".join(participation_permissions), account_id, group_id, gamespace_id
+                    """, participation_role, ",".join(participation_permissions), permission_bits,
+                    participation_account_id, group_id, gamespace_id
                 )
             except DatabaseError as e:
                 raise GroupError(500, "Failed to update role: " + str(e.args[1]))
@@ -602,6 +1121,68 @@ class GroupsModel(Model):
         except InternalError:
             pass  # well
 
+    async def __permission_bits__(self, gamespace_id, permissions):
+        try:
+            return await self.permissions.mask(gamespace_id, permissions)
+        except DatabaseError as e:
+            raise GroupError(500, "Failed to register group permissions: " + str(e.args[1]))
+
+    async def __permission_registry__(self, gamespace_id):
+        try:
+            return await self.permissions.get_bits(gamespace_id)
+        except DatabaseError as e:
+            raise GroupError(500, "Failed to get group permissions: " + str(e.args[1]))
+
+    async def __backfill_permission_bits__(self):
+        """
+        Fills participation_permission_bits of the participations made before the column existed, a range of
+            groups at a time. Does nothing once there are none left, so an interrupted backfill is resumed
+            on the next start.
+        """
+
+        try:
+            remaining = await self.db.get(
+                """
+                    SELECT MIN(`group_id`) AS `first_group_id`, MAX(`group_id`) AS `last_group_id`
+                    FROM `group_participants`
+                    WHERE `participation_permission_bits` IS NULL;
+                """)
+
+            if not remaining or remaining["first_group_id"] is None:
+                return
+
+            for first_group_id in range(remaining["first_group_id"], remaining["last_group_id"] + 1,
+                                        GroupsModel.PERMISSION_BITS_BACKFILL_GROUPS):
+
+                end_group_id = first_group_id + GroupsModel.PERMISSION_BITS_BACKFILL_GROUPS
+
+                # participations with the same permissions get the same bits, custom ones are registered as well
+                distinct = await self.db.query(
+                    """
+                        SELECT DISTINCT `gamespace_id`, `participation_permissions`
+                        FROM `group_participants`
+                        WHERE `group_id`>=%s AND `group_id`<%s AND `participation_permission_bits` IS NULL;
+                    """, first_group_id, end_group_id)
+
+                for permissions in distinct:
+                    gamespace_id = permissions["gamespace_id"]
+                    names = permissions["participation_permissions"]
+                    mask = await self.permissions.mask(gamespace_id, names.split(","))
+
+                    await self.db.execute(
+                        """
+                            UPDATE `group_participants`
+                            SET `participation_permission_bits`=%s
+                            WHERE `group_id`>=%s AND `group_id`<%s AND `gamespace_id`=%s
+                                AND `participation_permissions`=%s AND `participation_permission_bits` IS NULL;
+                        """, mask, first_group_id, end_group_id, gamespace_id, names)
+
+                await sleep(GroupsModel.PERMISSION_BITS_BACKFILL_PAUSE)
+        except DatabaseError as e:
+            logging.error("Failed to backfill participation permission bits: " + str(e.args[1]))
+        else:
+            logging.info("Participation permission bits have been backfilled")
+
     @validate(gamespace_id="int", group_id="int")
     async def get_group(self, gamespace_id, group_id, db=None):
         try:
@@ -609,7 +1190,7 @@ class GroupsModel(Model):
                 """
                     SELECT *
                     FROM `groups`
-                    WHERE `gamespace_id`=%s AND `group_id`=%s
+                    WHERE `gamespace_id`=%s AND `group_id`=%s AND `group_deleted`=0
                     LIMIT 1;
                 """, gamespace_id, group_id)
         except DatabaseError as e:
@@ -627,7 +1208,7 @@ class GroupsModel(Model):
                 """
                     SELECT *
                     FROM `groups`
-                    WHERE `gamespace_id`=%s AND `group_id` IN %s
+                    WHERE `gamespace_id`=%s AND `group_id` IN %s AND `group_deleted`=0
                     LIMIT %s;
                 """, gamespace_id, group_ids, len(group_ids))
         except DatabaseError as e:
@@ -635,6 +1216,28 @@ class GroupsModel(Model):
         else:
             return list(map(GroupAdapter, groups))
 
+    @validate(gamespace_id="int", group_ids="json_list_of_ints")
+    async def find_missing_groups(self, gamespace_id, group_ids, db=None):
+        """
+        :returns a sorted list of @group_ids that have no (not disbanded) group
+        """
+
+        if not group_ids:
+            return []
+
+        try:
+            existing = await (db or self.db).query(
+                """
+                    SELECT `group_id`
+                    FROM `groups`
+                    WHERE `gamespace_id`=%s AND `group_id` IN %s AND `group_deleted`=0;
+                """, gamespace_id, group_ids)
+        except DatabaseError as e:
+            raise GroupError(500, "Failed to check groups: " + str(e.args[1]))
+
+        existing = set(group["group_id"] for group in existing)
+        return sorted(set(group_ids) - existing)
+
     @validate(gamespace_id="int", group_id="int", account_id="int")
     async def is_group_owner(self, gamespace_id, group_id, account_id, db=None):
         try:
@@ -642,7 +1245,7 @@ class GroupsModel(Model):
                 """
                     SELECT COUNT(*) AS result
                     FROM `groups`
-                    WHERE `gamespace_id`=%s AND `group_id`=%s AND `group_owner`=%s
+                    WHERE `gamespace_id`=%s AND `group_id`=%s AND `group_owner`=%s AND `group_deleted`=0
                     LIMIT 1;
                 """, gamespace_id, group_id, account_id)
         except DatabaseError as e:
@@ -653,6 +1256,44 @@ class GroupsModel(Model):
 
             return data["result"] > 0
 
+    @validate(gamespace_id="int", group_id="int", account_id="int", target_account_id="int", lock="bool")
+    async def get_group_authorization(self, gamespace_id, group_id, account_id, target_account_id=None,
+                                      lock=False, db=None):
+        """
+        Fetches the group along with participations of both @account_id (the one who acts)
+            and @target_account_id (the one who is acted upon, optional) in one round trip.
+
+        :param lock: lock the group and the participations until the transaction (@db) is committed
+        :returns GroupAuthorizationAdapter
+        """
+
+        try:
+            data = await (db or self.db).get(
+                """
+                    SELECT g.`group_id`, g.`group_name`, g.`group_flags`, g.`group_free_members`,
+                        g.`group_join_method`, g.`group_owner`,
+                        a.`account_id` AS `actor_account_id`, a.`participation_role` AS `actor_role`,
+                        a.`participation_permissions` AS `actor_permissions`,
+                        a.`participation_permission_bits` AS `actor_permission_bits`,
+                        t.`account_id` AS `target_account_id`, t.`participation_role` AS `target_role`,
+                        t.`participation_permissions` AS `target_permissions`,
+                        t.`participation_permission_bits` AS `target_permission_bits`
+                    FROM `groups` AS g
+                    LEFT JOIN `group_participants` AS a
+                        ON a.`group_id`=g.`group_id` AND a.`gamespace_id`=g.`gamespace_id` AND a.`account_id`=%s
+                    LEFT JOIN `group_participants` AS t
+                        ON t.`group_id`=g.`group_id` AND t.`gamespace_id`=g.`gamespace_id` AND t.`account_id`=%s
+                    WHERE g.`gamespace_id`=%s AND g.`group_id`=%s AND g.`group_deleted`=0
+                    LIMIT 1{0};
+                """.format(" FOR UPDATE" if lock else ""), account_id, target_account_id, gamespace_id, group_id)
+        except DatabaseError as e:
+            raise GroupError(500, "Failed to get a group: " + str(e.args[1]))
+
+        if not data:
+            raise NoSuchGroup()
+
+        return GroupAuthorizationAdapter(data)
+
     @validate(gamespace_id="int", group_id="int", account_id="int")
     async def get_group_with_participants(self, gamespace_id, group_id, account_id=None):
         async with self.db.acquire() as db:
@@ -801,6 +1442,151 @@ class GroupsModel(Model):
         except DatabaseError as e:
             raise GroupError(500, "Failed to delete a group: " + str(e.args[1]))
 
+        if self.name_index is not None:
+            self.name_index.remove(gamespace_id, group_id)
+
+    @validate(gamespace_id="int", group_id="int", account_id="int", notify="json_dict", authoritative="bool")
+    async def disband_group(self, gamespace_id, group_id, account_id, notify=None, authoritative=False):
+        """
+        Disbands the group on behalf of its owner, see __mark_disbanded__
+        """
+
+        group = await self.get_group(gamespace_id, group_id)
+
+        if not group.is_owner(account_id):
+            raise GroupError(409, "You are not an owner of that group")
+
+        await self.__mark_disbanded__(gamespace_id, group, account_id, notify, authoritative)
+
+    @validate(gamespace_id="int", group_id="int", notify="json_dict")
+    async def disband_group_no_check(self, gamespace_id, group_id, notify=None):
+        group = await self.get_group(gamespace_id, group_id)
+        await self.__mark_disbanded__(gamespace_id, group, group.owner, notify, True)
+
+    async def __mark_disbanded__(self, gamespace_id, group, account_id, notify, authoritative):
+        """
+        The group is only flagged as deleted here, so it is gone for every read right away (no matter how many
+            participants and requests it has), and the members are notified with a single message to the group.
+            The rows are deleted later in the background, see __disband__.
+        """
+
+        group_id = group.group_id
+
+        try:
+            updated = await self.db.execute(
+                """
+                    UPDATE `groups`
+                    SET `group_deleted`=1
+                    WHERE `gamespace_id`=%s AND `group_id`=%s AND `group_owner`=%s AND `group_deleted`=0
+                    LIMIT 1;
+                """, gamespace_id, group_id, group.owner)
+        except DatabaseError as e:
+            raise GroupError(500, "Failed to disband a group: " + str(e.args[1]))
+
+        if not updated:
+            # disbanded (or transferred) in the meantime
+            raise NoSuchGroup()
+
+        if self.name_index is not None:
+            self.name_index.remove(gamespace_id, group_id)
+
+        message_support = GroupFlags.MESSAGE_SUPPORT in group.flags
+
+        if notify and message_support:
+            await self.__send_message__(
+                gamespace_id, GroupsModel.GROUP_CLASS, str(group_id), account_id,
+                GroupsModel.MESSAGE_GROUP_DISBANDED, notify, authoritative=authoritative)
+
+        IOLoop.current().spawn_callback(self.__disband__, gamespace_id, group_id, message_support)
+
+    async def __resume_disbanding__(self):
+        try:
+            groups = await self.db.query(
+                """
+                    SELECT `gamespace_id`, `group_id`, `group_flags`
+                    FROM `groups`
+                    WHERE `group_deleted`=1;
+                """)
+        except DatabaseError as e:
+            logging.error("Failed to list disbanded groups: " + str(e.args[1]))
+            return
+
+        for group in groups:
+            flags = GroupAdapter(group).flags
+            IOLoop.current().spawn_callback(
+                self.__disband__, group["gamespace_id"], group["group_id"], GroupFlags.MESSAGE_SUPPORT in flags)
+
+    async def __disband__(self, gamespace_id, group_id, message_support):
+        """
+        Deletes the participants and the requests of a disbanded group chunk by chunk, then the group itself.
+            A failed attempt is retried with a backoff, and the group stays flagged until it is deleted, so one that
+            still fails (or is interrupted by a restart) is picked up by the next sweep, see __resume_disbanding__.
+        """
+
+        key = (gamespace_id, group_id)
+
+        if key in self.disbanding:
+            return
+
+        self.disbanding.add(key)
+        delay = GroupsModel.DISBAND_RETRY_DELAY
+
+        try:
+            for attempt in range(1, GroupsModel.DISBAND_MAX_ATTEMPTS + 1):
+                try:
+                    await self.__delete_disbanded__(gamespace_id, group_id, message_support)
+                except (DatabaseError, GroupError, RequestError) as e:
+                    if attempt == GroupsModel.DISBAND_MAX_ATTEMPTS:
+                        logging.error("Failed to disband group {0}, it will be retried by the next sweep: {1}".format(
+                            group_id, e))
+                        return
+
+                    logging.warning("Failed to disband group {0} (attempt {1}), retrying: {2}".format(
+                        group_id, attempt, e))
+
+                    await sleep(delay * (1 + random.random()))
+                    delay *= 2
+                else:
+                    logging.info("Group {0} has been disbanded".format(group_id))
+                    return
+        finally:
+            self.disbanding.discard(key)
+
+    async def __delete_disbanded__(self, gamespace_id, group_id, message_support):
+        if message_support:
+            try:
+                await self.internal.request(
+                    "message", "delete_group",
+                    gamespace=gamespace_id, group_class=GroupsModel.GROUP_CLASS, group_key=str(group_id))
+            except InternalError as e:
+                if e.code != 404:
+                    logging.warning("Failed to delete message group of group {0}: {1}".format(group_id, e))
+
+        while await self.__delete_participants_chunk__(gamespace_id, group_id, GroupsModel.DISBAND_CHUNK_SIZE):
+            await sleep(GroupsModel.DISBAND_PAUSE)
+
+        while await self.requests.delete_object_requests_chunk(
+                gamespace_id, RequestType.GROUP, group_id, GroupsModel.DISBAND_CHUNK_SIZE):
+            await sleep(GroupsModel.DISBAND_PAUSE)
+
+        await self.db.execute(
+            """
+                DELETE FROM `groups`
+                WHERE `gamespace_id`=%s AND `group_id`=%s AND `group_deleted`=1
+                LIMIT 1;
+            """, gamespace_id, group_id)
+
+    async def __delete_participants_chunk__(self, gamespace_id, group_id, limit):
+        try:
+            return await self.db.execute(
+                """
+                    DELETE FROM `group_participants`
+                    WHERE `gamespace_id`=%s AND `group_id`=%s
+                    LIMIT %s;
+                """, gamespace_id, group_id, limit)
+        except DatabaseError as e:
+            raise GroupError(500, "Failed to delete group participants: " + str(e.args[1]))
+
     @validate(gamespace_id="int", group_id="int", account_id="int", participation_profile="json_dict",
               notify="json_dict", authoritative="bool")
     async def join_group_request(self, gamespace_id, group_id, account_id, participation_profile,
@@ -844,7 +1630,8 @@ class GroupsModel(Model):
     async def invite_to_group(self, gamespace_id, group_id, account_id,
                               invite_account_id, role, permissions, notify=None, authoritative=False):
 
-        group = await self.get_group(gamespace_id, group_id)
+        authorization = await self.get_group_authorization(gamespace_id, group_id, account_id)
+        group = authorization.group
 
         if group.free_members == 0:
             raise GroupError(410, "Group is full")
@@ -852,13 +1639,16 @@ class GroupsModel(Model):
         if group.join_method != GroupJoinMethod.INVITE:
             raise GroupError(409, "This group is not for invites, it is: {0}".format(str(group.join_method)))
 
-        participation = await self.get_group_participation(gamespace_id, group_id, account_id)
+        participation = authorization.actor
+
+        if participation is None:
+            raise NoSuchParticipation()
 
         if not group.is_owner(account_id):
             if not participation.has_permission(GroupsModel.PERMISSION_SEND_INVITE):
                 raise GroupError(406, "You have no permission to send invites")
 
-            permissions = list(set(permissions) & participation.permissions)
+            permissions = participation.granted(permissions, await self.__permission_registry__(gamespace_id))
 
             if role > participation.role:
                 raise GroupError(409, "Invited role cannot be higher than your role")
@@ -887,7 +1677,8 @@ class GroupsModel(Model):
     async def approve_join_group(self, gamespace_id, group_id, account_id, approve_account_id,
                                  role, key, permissions, notify=None, authoritative=False):
 
-        group = await self.get_group(gamespace_id, group_id)
+        authorization = await self.get_group_authorization(gamespace_id, group_id, account_id)
+        group = authorization.group
 
         if group.free_members == 0:
             raise GroupError(410, "Group is full")
@@ -896,13 +1687,16 @@ class GroupsModel(Model):
             raise GroupError(409, "This group is not approve-like, it is: {0}".format(str(group.join_method)))
 
         if not group.is_owner(account_id):
-            participation = await self.get_group_participation(gamespace_id, group_id, account_id)
+            participation = authorization.actor
+
+            if participation is None:
+                raise NoSuchParticipation()
 
             if not participation.has_permission(GroupsModel.PERMISSION_REQUEST_APPROVAL):
                 raise GroupError(406, "You have no permission to approve items")
 
             # limit permissions only to those the player has
-            permissions = list(set(permissions) & participation.permissions)
+            permissions = participation.granted(permissions, await self.__permission_registry__(gamespace_id))
 
             if role > participation.role:
                 raise GroupError(409, "Approved role cannot be higher than your role")
@@ -939,13 +1733,17 @@ class GroupsModel(Model):
     async def reject_join_group(self, gamespace_id, group_id, account_id, reject_account_id, key,
                                 notify=None, authoritative=False):
 
-        group = await self.get_group(gamespace_id, group_id)
+        authorization = await self.get_group_authorization(gamespace_id, group_id, account_id)
+        group = authorization.group
 
         if group.join_method != GroupJoinMethod.APPROVE:
             raise GroupError(409, "This group is not approve-like, it is: {0}".format(str(group.join_method)))
 
         if not group.is_owner(account_id):
-            participation = await self.get_group_participation(gamespace_id, group_id, account_id)
+            participation = authorization.actor
+
+            if participation is None:
+                raise NoSuchParticipation()
 
             if not participation.has_permission(GroupsModel.PERMISSION_REQUEST_APPROVAL):
                 raise GroupError(406, "You have no permission to reject items")
@@ -1072,19 +1870,24 @@ class GroupsModel(Model):
             participation_profile, permissions, message_support=True,
             notify=None, authoritative=False):
 
+        permission_bits = await self.__permission_bits__(gamespace_id, permissions)
+
         async with self.db.acquire(auto_commit=False) as db:
             try:
                 try:
                     group = await db.get(
                         """
                             SELECT `group_free_members` FROM `groups`
-                            WHERE `gamespace_id`=%s AND `group_id`=%s
+                            WHERE `gamespace_id`=%s AND `group_id`=%s AND `group_deleted`=0
                             LIMIT 1
                             FOR UPDATE;
                         """, gamespace_id, group_id)
                 except DatabaseError as e:
                     raise GroupError(500, "Failed to join to a group: " + str(e.args[1]))
 
+                if group is None:
+                    raise NoSuchGroup()
+
                 group_free_members = group["group_free_members"]
 
                 if group_free_members <= 0:
@@ -1109,10 +1912,10 @@ class GroupsModel(Model):
                         """
                             INSERT INTO `group_participants`
                             (`gamespace_id`, `group_id`, `account_id`, `participation_role`, 
-                                `participation_profile`, `participation_permissions`)
-                            VALUES (%s, %s, %s, %s, %s, %s);
+                                `participation_profile`, `participation_permissions`, `participation_permission_bits`)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s);
                         """, gamespace_id, group_id, account_id, participation_role,
-                        ujson.dumps(participation_profile), ",".join(permissions))
+                        ujson.dumps(participation_profile), ",".join(permissions), permission_bits)
                 except DuplicateError:
                     raise GroupError(409, "Account '{0}' has already jointed the group.".format(account_id))
                 except DatabaseError as e:
@@ -1147,11 +1950,14 @@ class GroupsModel(Model):
                     """
                         SELECT *
                         FROM `groups`
-                        WHERE `gamespace_id`=%s AND `group_id`=%s
+                        WHERE `gamespace_id`=%s AND `group_id`=%s AND `group_deleted`=0
                         LIMIT 1
                         FOR UPDATE;
                     """, gamespace_id, group_id)
 
+                if data is None:
+                    raise NoSuchGroup()
+
                 group = GroupAdapter(data)
 
                 if group.is_owner(account_id):
@@ -1194,22 +2000,24 @@ class GroupsModel(Model):
                               notify=None, authoritative=False):
 
         async with self.db.acquire() as db:
-            group = await self.get_group(gamespace_id, group_id, db=db)
+            authorization = await self.get_group_authorization(
+                gamespace_id, group_id, kicker_account_id, account_id, db=db)
+            group = authorization.group
 
             if group.is_owner(account_id):
                 raise GroupError(406, "You cannot kick an owner")
 
             if not group.is_owner(kicker_account_id):
-                participants = await self.get_group_participants(
-                    gamespace_id, group_id, [account_id, kicker_account_id], db=db)
+                kicker_permissions = authorization.actor
+                account_permissions = authorization.target
 
-                kicker_permissions = participants[kicker_account_id]
-                account_permissions = participants[account_id]
+                if kicker_permissions is None or account_permissions is None:
+                    raise NoSuchParticipation()
 
                 if not kicker_permissions.has_permission(GroupsModel.PERMISSION_KICK):
                     raise GroupError(406, "You have no permission to kick")
 
-                if account_permissions.role >= kicker_permissions.role:
+                if not authorization.actor_role_higher():
                     raise GroupError(406, "You cannot kick a player with a higher role")
 
             if notify:
@@ -1243,7 +2051,7 @@ class GroupsModel(Model):
                 """
                     UPDATE `groups`
                     SET `group_owner`=%s
-                    WHERE `gamespace_id`=%s AND `group_id`=%s
+                    WHERE `gamespace_id`=%s AND `group_id`=%s AND `group_deleted`=0
                     LIMIT 1;;
                 """, account_transfer_to, gamespace_id, group_id)
         except DatabaseError as e:
@@ -1255,9 +2063,9 @@ class GroupsModel(Model):
                 """
                     INSERT INTO `group_participants`
                     (`gamespace_id`, `group_id`, `account_id`, `participation_role`, `participation_profile`,
-                        `participation_permissions`)
-                    VALUES (%s, %s, %s, %s, '{}', ''),
-                    (%s, %s, %s, %s, '{}', '')
+                        `participation_permissions`, `participation_permission_bits`)
+                    VALUES (%s, %s, %s, %s, '{}', '', 0),
+                    (%s, %s, %s, %s, '{}', '', 0)
                     ON DUPLICATE KEY UPDATE 
                       `participation_role`=VALUES(`participation_role`);
                 """, gamespace_id, group_id, account_id, account_my_role,
@@ -1286,13 +2094,118 @@ class GroupsModel(Model):
 
         return list(map(GroupParticipationAdapter, participants))
 
-    @validate(gamespace_id="int", query="str")
-    async def search_groups(self, gamespace_id, query, db=None):
+    @validate(gamespace_id="int", field="str_name", limit="int", offset="int", cursor="str")
+    async def list_top_groups(self, gamespace_id, field, limit=20, offset=0, cursor=None, db=None):
+        """
+        Lists groups with the highest value of a rank field (see group_rank_fields option). Groups without
+            that field are not listed.
 
-        words = re.findall(r'[^\s]+', query)
+        For deep paging, pass the cursor of the last group (RankedGroupAdapter.cursor) instead of an offset,
+            then the page is read from the index at O(log n) regardless of how deep it is.
 
-        if not words:
-            return []
+        :returns a list of RankedGroupAdapter
+        """
+
+        column = self.rank_columns.get(field)
+
+        if column is None:
+            raise GroupError(404, "Groups cannot be ranked by '{0}'".format(field))
+
+        limit = max(1, min(limit, GroupsModel.MAX_TOP_LIMIT))
+
+        conditions = ["`gamespace_id`=%s", "`group_deleted`=0", "`{0}` IS NOT NULL".format(column)]
+        args = [gamespace_id]
+
+        if cursor:
+            try:
+                score, group_id = cursor.split(":")
+                score = float(score)
+                group_id = int(group_id)
+            except ValueError:
+                raise GroupError(400, "Bad cursor")
+
+            conditions.append("(`{0}`, `group_id`) < (%s, %s)".format(column))
+            args.extend([score, group_id])
+            offset = 0
+
+        args.extend([limit, max(offset, 0)])
+
+        try:
+            groups = await (db or self.db).query(
+                """
+                    SELECT `group_id`, `group_name`, `group_profile`, `group_flags`, `group_free_members`,
+                        `group_join_method`, `group_owner`, `{0}` AS `rank_score`
+                    FROM `groups`
+                    WHERE {1}
+                    ORDER BY `{0}` DESC, `group_id` DESC
+                    LIMIT %s OFFSET %s;
+                """.format(column, " AND ".join(conditions)), *args)
+        except DatabaseError as e:
+            raise GroupError(500, "Failed to list top groups: " + str(e.args[1]))
+
+        return list(map(RankedGroupAdapter, groups))
+
+    @validate(gamespace_id="int", query="str", limit="int", offset="int", join_method=GroupJoinMethod,
+              has_free_members="bool", name_prefix="str", with_profile="bool")
+    async def search_groups(self, gamespace_id, query, limit=DEFAULT_SEARCH_LIMIT, offset=0, join_method=None,
+                            has_free_members=False, name_prefix=None, with_profile=True, db=None):
+        """
+        Searches groups by name, most relevant first (ties are broken by group_id, so pages are stable).
+
+        If the group name index is enabled (see group_name_index option) and built, names are looked up in memory
+            (see NameIndex), this handles short and partial words too. Otherwise, a FULLTEXT search is made,
+            where each word of three characters or longer is matched as a prefix.
+
+        :param query: words to search for
+        :param limit: page size, at most MAX_SEARCH_LIMIT
+        :param offset: number of groups to skip
+        :param join_method: only return groups with this join method
+        :param has_free_members: only return groups that are not full
+        :param name_prefix: only return groups which names start with this prefix
+        :param with_profile: if False, group profiles are not fetched
+        :returns a list of GroupAdapter
+        """
+
+        limit = max(1, min(limit, GroupsModel.MAX_SEARCH_LIMIT))
+        offset = max(offset, 0)
+
+        columns = ["`group_id`", "`group_name`", "`group_flags`", "`group_free_members`",
+                   "`group_join_method`", "`group_owner`"]
+        conditions = ["`gamespace_id`=%s", "`group_deleted`=0"]
+        condition_args = [gamespace_id]
+
+        if with_profile:
+            columns.append("`group_profile`")
+
+        if join_method:
+            conditions.append("`group_join_method`=%s")
+            condition_args.append(str(join_method))
+
+        if has_free_members:
+            conditions.append("`group_free_members`>0")
+
+        if name_prefix:
+            escaped = name_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append("`group_name` LIKE %s")
+            condition_args.append(escaped + "%")
+
+        if self.name_index is not None and self.name_index.ready:
+            groups = await self.__search_groups_indexed__(
+                gamespace_id, query, name_prefix, limit, offset, columns, conditions, condition_args,
+                filtered=bool(join_method or has_free_members or name_prefix), db=db)
+        else:
+            groups = await self.__search_groups_fulltext__(
+                query, name_prefix, limit, offset, columns, conditions, condition_args, db=db)
+
+        return list(map(GroupAdapter, groups))
+
+    async def __search_groups_fulltext__(self, query, name_prefix, limit, offset,
+                                         columns, conditions, condition_args, db=None):
+
+        words = [
+            GroupsModel.SEARCH_SPECIAL_CHARACTERS.sub("", word)
+            for word in re.findall(r'[^\s]+', query or "")
+        ]
 
         if len(words) > 32:
             # too many words
@@ -1300,14 +2213,98 @@ class GroupsModel(Model):
 
         compiled = u" ".join(u"+" + word + u"*" for word in words if len(word) > 2)
 
+        if not compiled and not name_prefix:
+            return []
+
+        columns = list(columns)
+        conditions = list(conditions)
+        args = condition_args + [limit, offset]
+
+        if compiled:
+            columns.append("MATCH(`group_name`) AGAINST (%s IN BOOLEAN MODE) AS `relevance`")
+            conditions.append("MATCH(`group_name`) AGAINST (%s IN BOOLEAN MODE)")
+            args = [compiled] + condition_args + [compiled, limit, offset]
+            order = "`relevance` DESC, `group_id` DESC"
+        else:
+            order = "`group_name`, `group_id`"
+
         try:
-            groups = await (db or self.db).query(
+            return await (db or self.db).query(
                 u"""
-                    SELECT *
+                    SELECT {0}
                     FROM `groups`
-                    WHERE `gamespace_id`=%s AND MATCH(`group_name`) AGAINST (%s IN BOOLEAN MODE);
-                """, gamespace_id, compiled)
+                    WHERE {1}
+                    ORDER BY {2}
+                    LIMIT %s OFFSET %s;
+                """.format(", ".join(columns), " AND ".join(conditions), order), *args)
         except DatabaseError as e:
-            raise GroupError(500, "Failed to list group participants: " + str(e.args[1]))
+            raise GroupError(500, "Failed to search groups: " + str(e.args[1]))
+
+    async def __search_groups_indexed__(self, gamespace_id, query, name_prefix, limit, offset,
+                                        columns, conditions, condition_args, filtered, db=None):
+        """
+        The index only knows of the groups changed by this instance, so the groups found are checked against
+            the database (and the index is corrected with what's there), and a page that is not full is completed
+            with a FULLTEXT search for the groups created or renamed by other instances. Pages are cut
+            from the results up to the one requested, so they stay consistent with each other.
+        """
+
+        index_query = (query or "").strip() or name_prefix or ""
+        wanted = offset + limit
+
+        if filtered:
+            # the filters are applied by the database, so take enough candidates to fill the page after that
+            group_ids = self.name_index.search(gamespace_id, index_query, GroupsModel.MAX_NAME_INDEX_CANDIDATES)
+        else:
+            group_ids = self.name_index.search(gamespace_id, index_query, wanted)
 
-        return list(map(GroupAdapter, groups))
+        groups = []
+
+        if group_ids:
+            try:
+                found = await (db or self.db).query(
+                    u"""
+                        SELECT {0}
+                        FROM `groups`
+                        WHERE {1} AND `group_id` IN %s;
+                    """.format(", ".join(columns), " AND ".join(conditions)), *(condition_args + [group_ids]))
+            except DatabaseError as e:
+                raise GroupError(500, "Failed to search groups: " + str(e.args[1]))
+
+            current = {group["group_id"]: group for group in found}
+
+            for group_id in group_ids:
+                group = current.get(group_id)
+
+                if group is None:
+                    if not filtered:
+                        # disbanded by another instance
+                        self.name_index.remove(gamespace_id, group_id)
+                    continue
+
+                if not NameIndex.matches(group["group_name"] or "", index_query):
+                    # renamed by another instance
+                    self.name_index.add(gamespace_id, group_id, group["group_name"])
+                    continue
+
+                groups.append(group)
+
+                if len(groups) >= wanted:
+                    break
+
+        if len(groups) < wanted:
+            known = set(group["group_id"] for group in groups)
+
+            for group in await self.__search_groups_fulltext__(
+                    query, name_prefix, wanted, 0, columns, conditions, condition_args, db=db):
+
+                if group["group_id"] in known or not NameIndex.matches(group["group_name"] or "", index_query):
+                    continue
+
+                self.name_index.add(gamespace_id, group["group_id"], group["group_name"])
+                groups.append(group)
+
+                if len(groups) >= wanted:
+                    break
+
+        return groups[offset:wanted]
@@ -0,0 +1,212 @@
+import bisect
+import heapq
+import re
+
+
+class NameIndexBucket(object):
+    """
+    Names of one bucket (for example, one gamespace).
+
+    Every name is split into lowercase words. Words of three characters or longer are looked up
+        with a trigram index (this matches them anywhere inside a name). Shorter words are looked up as
+        prefixes of name words, in a sorted list of (word, id).
+    """
+
+    def __init__(self):
+        # id -> lowercase name
+        self.names = {}
+        # trigram -> set of ids
+        self.trigrams = {}
+        # sorted list of (word, id)
+        self.words = []
+        self.words_sorted = True
+
+    def sort(self):
+        if not self.words_sorted:
+            self.words.sort()
+            self.words_sorted = True
+
+    def add(self, object_id, name, defer=False):
+        self.remove(object_id)
+
+        name = name.lower()
+        self.names[object_id] = name
+
+        for trigram in NameIndex.trigrams(name):
+            self.trigrams.setdefault(trigram, set()).add(object_id)
+
+        if defer:
+            # bulk load, the words are sorted once afterwards (see NameIndex.sort)
+            self.words.extend((word, object_id) for word in set(NameIndex.split(name)))
+            self.words_sorted = False
+            return
+
+        self.sort()
+
+        for word in set(NameIndex.split(name)):
+            bisect.insort(self.words, (word, object_id))
+
+    def remove(self, object_id):
+        name = self.names.pop(object_id, None)
+
+        if name is None:
+            return False
+
+        for trigram in NameIndex.trigrams(name):
+            ids = self.trigrams.get(trigram)
+            if ids is None:
+                continue
+            ids.discard(object_id)
+            if not ids:
+                self.trigrams.pop(trigram)
+
+        self.sort()
+
+        for word in set(NameIndex.split(name)):
+            position = bisect.bisect_left(self.words, (word, object_id))
+            if position < len(self.words) and self.words[position] == (word, object_id):
+                del self.words[position]
+
+        return True
+
+    def __match_word__(self, word):
+        if len(word) >= 3:
+            trigrams = sorted((self.trigrams.get(trigram, set()) for trigram in NameIndex.trigrams(word)), key=len)
+            candidates = set.intersection(*trigrams) if trigrams else set()
+            return set(object_id for object_id in candidates if word in self.names[object_id])
+
+        self.sort()
+
+        result = set()
+        position = bisect.bisect_left(self.words, (word,))
+
+        while position < len(self.words):
+            found, object_id = self.words[position]
+            if not found.startswith(word):
+                break
+            result.add(object_id)
+            position += 1
+
+        return result
+
+    def search(self, query, count):
+        words = NameIndex.split(query.lower())
+
+        if not words:
+            return []
+
+        # look up the rarest words first, so the intersection gets small quickly
+        matches = None
+
+        for word in sorted(set(words), key=len, reverse=True):
+            found = self.__match_word__(word)
+            matches = found if matches is None else (matches & found)
+            if not matches:
+                return []
+
+        phrase = " ".join(words)
+
+        def rank(object_id):
+            name = self.names[object_id]
+            return not name.startswith(phrase), phrase not in name, len(name), name, object_id
+
+        return heapq.nsmallest(count, matches, key=rank)
+
+
+class NameIndex(object):
+    """
+    In-process search index of short names (group names, nicknames etc), split into buckets.
+
+    Serves prefix and infix queries from memory: every word of a query has to match (as a prefix of a name word
+        if the query word is shorter than three characters, anywhere inside the name otherwise). Results are ranked:
+        names starting with the query go first, then names containing the query as a whole, then shorter names.
+
+    The index is only as current as the calls to add/remove of this process, so it should be rebuilt on startup,
+        and the owner should fall back to the database while it is not ready. Names changed by other processes
+        are not seen either: the owner should check the names it finds with NameIndex.matches against the database,
+        and look for the ones it may be missing there.
+    """
+
+    WORD_PATTERN = re.compile(r"[^\s]+")
+
+    def __init__(self):
+        self.buckets = {}
+        self.ready = False
+
+    @staticmethod
+    def split(name):
+        return NameIndex.WORD_PATTERN.findall(name)
+
+    @staticmethod
+    def trigrams(text):
+        return set(text[i:i + 3] for i in range(0, len(text) - 2))
+
+    @staticmethod
+    def matches(name, query):
+        """
+        :returns whether the name matches the query the way search does it
+        """
+
+        name = name.lower()
+        words = NameIndex.split(name)
+        query_words = NameIndex.split(query.lower())
+
+        if not query_words:
+            return False
+
+        return all(
+            (word in name) if len(word) >= 3 else any(found.startswith(word) for found in words)
+            for word in query_words)
+
+    def add(self, bucket, object_id, name, defer=False):
+        """
+        Adds (or renames) an object. With @defer, the index is not usable until NameIndex.sort is called,
+            which makes loading lots of names at once much faster.
+        """
+
+        if not name:
+            self.remove(bucket, object_id)
+            return
+
+        existing = self.buckets.get(bucket)
+
+        if existing is None:
+            existing = NameIndexBucket()
+            self.buckets[bucket] = existing
+
+        existing.add(object_id, name, defer=defer)
+
+    def sort(self):
+        for existing in self.buckets.values():
+            existing.sort()
+
+    def remove(self, bucket, object_id):
+        existing = self.buckets.get(bucket)
+
+        if existing is None:
+            return False
+
+        return existing.remove(object_id)
+
+    def clear(self):
+        self.buckets = {}
+        self.ready = False
+
+    def search(self, bucket, query, limit, offset=0):
+        """
+        :returns a list of object ids, best matches first
+        """
+
+        existing = self.buckets.get(bucket)
+
+        if existing is None:
+            return []
+
+        return existing.search(query, offset + limit)[offset:]
+
+    def size(self, bucket=None):
+        if bucket is not None:
+            existing = self.buckets.get(bucket)
+            return len(existing.names) if existing else 0
+
+        return sum(len(existing.names) for existing in self.buckets.values())
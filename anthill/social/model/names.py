@@ -3,10 +3,15 @@ from anthill.common.validate import validate
 from anthill.common.model import Model
 from anthill.common.database import DatabaseError, DuplicateError
 from anthill.common.internal import Internal, InternalError
-from anthill.common import cached
 
+from .nameindex import NameIndex
+from .bloom import NamesBloomFilter
+from .profile import AccountProfilesCache
+from .deletion import delete_accounts
+
+import logging
+import random
 import re
-import hashlib
 
 
 class NamesModelError(Exception):
@@ -30,10 +35,25 @@ class NameAdapter(object):
 
 
 class NamesModel(Model):
-    def __init__(self, db, cache):
+    DEFAULT_SEARCH_LIMIT = 100
+    MAX_SEARCH_LIMIT = 100
+    INDEX_BUILD_CHUNK = 10000
+
+    MAX_CHECK_NAMES = 100
+    MAX_SUGGEST_COUNT = 20
+    SUGGEST_ROUNDS = 3
+    MAX_NAME_LENGTH = 255
+    PROFILES_CACHE_TTL = 20
+
+    def __init__(self, db, cache, name_index=False, bloom_filter_bits=0):
         self.db = db
         self.cache = cache
         self.internal = Internal()
+        self.profiles = AccountProfilesCache(cache, ttl=NamesModel.PROFILES_CACHE_TTL)
+        # (gamespace_id, kind) -> names, see search_names
+        self.name_index = NameIndex() if name_index else None
+        # taken names, see check_name
+        self.bloom_filter = NamesBloomFilter(cache, db, bits=bloom_filter_bits) if bloom_filter_bits else None
 
     def get_setup_db(self):
         return self.db
@@ -44,25 +64,110 @@ class NamesModel(Model):
     def has_delete_account_event(self):
         return True
 
-    async def accounts_deleted(self, gamespace, accounts, gamespace_only):
+    async def started(self, application):
+        await super(NamesModel, self).started(application)
+        await self.__build_name_index__()
+
+    async def __are_free__(self, gamespace_id, kind, names):
+        """
+        :returns a list of booleans, True for names that are definitely free according to the bloom filter
+        """
+
+        if self.bloom_filter is None:
+            return [False] * len(names)
+
+        try:
+            return await self.bloom_filter.are_free(gamespace_id, kind, names)
+        except Exception as e:
+            logging.warning("Failed to check names against the bloom filter: " + str(e))
+            return [False] * len(names)
+
+    async def __build_name_index__(self):
+        if self.name_index is None:
+            return
+
+        self.name_index.clear()
+        last_key = (0, 0, "")
+
+        try:
+            while True:
+                names = await self.db.query(
+                    """
+                        SELECT `gamespace_id`, `account_id`, `kind`, `name`
+                        FROM `unique_names`
+                        WHERE (`gamespace_id`, `account_id`, `kind`) > (%s, %s, %s)
+                        ORDER BY `gamespace_id`, `account_id`, `kind`
+                        LIMIT %s;
+                    """, *(last_key + (NamesModel.INDEX_BUILD_CHUNK,)))
+
+                if not names:
+                    break
+
+                for name in names:
+                    self.name_index.add(
+                        (name["gamespace_id"], name["kind"]), name["account_id"], name["name"], defer=True)
+
+                last = names[-1]
+                last_key = (last["gamespace_id"], last["account_id"], last["kind"])
+        except DatabaseError as e:
+            logging.error("Failed to build unique names index, falling back to FULLTEXT search: " + str(e.args[1]))
+            return
+
+        self.name_index.sort()
+        self.name_index.ready = True
+        logging.info("Unique names index built: {0} names".format(self.name_index.size()))
+
+    async def delete_accounts_chunk(self, gamespace, accounts, gamespace_only, limit):
         try:
             if gamespace_only:
-                await self.db.execute(
+                deleted = await self.db.execute(
                     """
                         DELETE FROM `unique_names`
-                        WHERE `gamespace_id`=%s AND `account_id` IN %s;
-                    """, gamespace, accounts)
+                        WHERE `gamespace_id`=%s AND `account_id` IN %s
+                        LIMIT %s;
+                    """, gamespace, accounts, limit)
             else:
-                await self.db.execute(
+                deleted = await self.db.execute(
                     """
                         DELETE FROM `unique_names`
-                        WHERE `account_id` IN %s;
-                    """, accounts)
+                        WHERE `account_id` IN %s
+                        LIMIT %s;
+                    """, accounts, limit)
         except DatabaseError as e:
             raise NamesModelError(500, "Failed to delete unique names: " + e.args[1])
 
-    @validate(gamespace_id="int", kind="str_name", query="str", profile_fields="json_list_of_strings")
-    async def search_names(self, gamespace_id, kind, query, profile_fields=None, db=None):
+        if not deleted and self.name_index is not None:
+            # all of the names are gone
+            for bucket in list(self.name_index.buckets.keys()):
+                if gamespace_only and bucket[0] != gamespace:
+                    continue
+                for account_id in accounts:
+                    self.name_index.remove(bucket, int(account_id))
+
+        return deleted
+
+    async def accounts_deleted(self, gamespace, accounts, gamespace_only):
+        await delete_accounts(self, gamespace, accounts, gamespace_only)
+
+    @validate(gamespace_id="int", kind="str_name", query="str", profile_fields="json_list_of_strings",
+              limit="int", offset="int")
+    async def search_names(self, gamespace_id, kind, query, profile_fields=None,
+                           limit=DEFAULT_SEARCH_LIMIT, offset=0, db=None):
+        """
+        Searches names of given kind, best matches first.
+
+        If the names index is enabled (see names_index option), names are looked up in memory (see NameIndex):
+            short words are matched as prefixes and longer ones anywhere inside a name. The names found are checked
+            against the database, and a page that is not full is completed with a FULLTEXT search, so names changed
+            by other instances are found too. Otherwise, a FULLTEXT search is made, where each word of three
+            characters or longer is matched as a prefix.
+
+        :param limit: page size, at most MAX_SEARCH_LIMIT
+        :param offset: number of names to skip
+        """
+
+        limit = max(1, min(limit, NamesModel.MAX_SEARCH_LIMIT))
+        offset = max(offset, 0)
 
         words = re.findall(r'[^\s]+', query)
 
@@ -73,56 +178,107 @@ class NamesModel(Model):
             # too many words
             words = words[:32]
 
+        if self.name_index is not None and self.name_index.ready:
+            names = await self.__search_names_indexed__(gamespace_id, kind, words, limit, offset, db=db)
+        else:
+            names = await self.__search_names_fulltext__(gamespace_id, kind, words, limit, offset, db=db)
+
+        names = list(map(NameAdapter, names))
+
+        if profile_fields is not None:
+            try:
+                profiles = await self.profiles.get(
+                    gamespace_id, [name.account_id for name in names], profile_fields)
+            except InternalError as e:
+                raise NamesModelError(e.code, str(e))
+
+            for name in names:
+                name.profile = profiles.get(str(name.account_id))
+
+        return names
+
+    async def __search_names_fulltext__(self, gamespace_id, kind, words, limit, offset, db=None):
         compiled = u" ".join(u"+" + word + u"*" for word in words if len(word) > 2)
 
+        if not compiled:
+            return []
+
         try:
-            names = await (db or self.db).query(
+            return await (db or self.db).query(
                 u"""
                     SELECT `account_id`, `name`
                     FROM `unique_names`
                     WHERE `gamespace_id`=%s AND `kind`=%s AND MATCH(`name`) AGAINST (%s IN BOOLEAN MODE)
-                    LIMIT 100;
-                """, gamespace_id, kind, compiled)
+                    ORDER BY MATCH(`name`) AGAINST (%s IN BOOLEAN MODE) DESC, `account_id`
+                    LIMIT %s OFFSET %s;
+                """, gamespace_id, kind, compiled, compiled, limit, offset)
         except DatabaseError as e:
             raise NamesModelError(500, e.args[1])
 
-        names = map(NameAdapter, names)
+    async def __search_names_indexed__(self, gamespace_id, kind, words, limit, offset, db=None):
+        """
+        The index only knows of the names changed by this instance, so the names found are checked against
+            the database (and the index is corrected with what's there), and a page that is not full is completed
+            with a FULLTEXT search for the names acquired by other instances. Pages are cut from the results
+            up to the one requested, so they stay consistent with each other.
+        """
+
+        bucket = (gamespace_id, kind)
+        query = u" ".join(words)
+        wanted = offset + limit
+        account_ids = self.name_index.search(bucket, query, wanted)
+        names = []
+
+        if account_ids:
+            try:
+                found = await (db or self.db).query(
+                    u"""
+                        SELECT `account_id`, `name`
+                        FROM `unique_names`
+                        WHERE `gamespace_id`=%s AND `account_id` IN %s AND `kind`=%s;
+                    """, gamespace_id, account_ids, kind)
+            except DatabaseError as e:
+                raise NamesModelError(500, e.args[1])
 
-        if profile_fields is not None:
-            account_ids = [str(name.account_id) for name in names]
-
-            def _hash():
-                h = hashlib.sha256()
-                for s in profile_fields:
-                    h.update(s + ",")
-                for s in account_ids:
-                    h.update(s + ",")
-                return h.hexdigest()
-
-            @cached(kv=self.cache,
-                    h=lambda: "names:" + str(gamespace_id) + ":" + str(kind) + ":" + _hash(),
-                    ttl=20,
-                    json=True)
-            def do_request():
-                return self.internal.request(
-                    "profile", "mass_profiles",
-                    accounts=list(set(account_ids)),
-                    gamespace=gamespace_id,
-                    action="get_public",
-                    profile_fields=profile_fields)
+            current = {name["account_id"]: name for name in found}
 
-            try:
-                profiles = await do_request()
-            except InternalError as e:
-                raise NamesModelError(e.code, str(e))
+            for account_id in account_ids:
+                name = current.get(account_id)
 
-            for name in names:
-                name.profile = profiles.get(str(name.account_id))
+                if name is None:
+                    # released by another instance
+                    self.name_index.remove(bucket, account_id)
+                    continue
 
-        return names
+                if not NameIndex.matches(name["name"], query):
+                    # renamed by another instance
+                    self.name_index.add(bucket, account_id, name["name"])
+                    continue
+
+                names.append(name)
+
+        if len(names) < wanted:
+            known = set(name["account_id"] for name in names)
+
+            for name in await self.__search_names_fulltext__(gamespace_id, kind, words, wanted, 0, db=db):
+                if name["account_id"] in known or not NameIndex.matches(name["name"], query):
+                    continue
+
+                self.name_index.add(bucket, name["account_id"], name["name"])
+                names.append(name)
+
+                if len(names) >= wanted:
+                    break
+
+        return names[offset:wanted]
 
     @validate(gamespace_id="int", kind="str_name", name="str")
     async def check_name(self, gamespace_id, kind, name):
+        free = await self.__are_free__(gamespace_id, kind, [name])
+
+        if free[0]:
+            return None
+
         try:
             busy = await self.db.get(
                 """
@@ -138,8 +294,103 @@ class NamesModel(Model):
 
         return busy["account_id"]
 
+    @staticmethod
+    def __name_key__(name):
+        # an approximation of the column collation (case-insensitive, trailing spaces ignored)
+        return name.rstrip(" ").lower()
+
+    @validate(gamespace_id="int", kind="str_name", names="json_list_of_strings")
+    async def check_names(self, gamespace_id, kind, names):
+        """
+        Checks a list of names at once, with one query at most.
+        :returns a dict name -> account_id of the owner, or None if the name is free
+        """
+
+        if len(names) > NamesModel.MAX_CHECK_NAMES:
+            raise NamesModelError(400, "Too many names to check")
+
+        names = list(set(names))
+        result = {name: None for name in names}
+
+        free = await self.__are_free__(gamespace_id, kind, names)
+        check = [name for name, name_free in zip(names, free) if not name_free]
+
+        if not check:
+            return result
+
+        try:
+            busy = await self.db.query(
+                """
+                SELECT `account_id`, `name` FROM `unique_names`
+                WHERE `gamespace_id`=%s AND `kind`=%s AND `name` IN %s;
+                """, gamespace_id, kind, check)
+        except DatabaseError as e:
+            raise NamesModelError(500, e.args[1])
+
+        owners = {NamesModel.__name_key__(row["name"]): row["account_id"] for row in busy}
+
+        for name in check:
+            result[name] = owners.get(NamesModel.__name_key__(name))
+
+        return result
+
+    @staticmethod
+    def __suggest_candidates__(base, count, attempt):
+        # the first round tries short suffixes, next ones go for longer (less likely taken) ones
+        digits = 2 + attempt * 2
+        candidates = [base] if attempt == 0 else []
+
+        while len(candidates) < count * 4:
+            suffix = str(random.randint(10 ** (digits - 1), 10 ** digits - 1))
+            candidates.append(base[:NamesModel.MAX_NAME_LENGTH - len(suffix)] + suffix)
+
+        return candidates
+
+    @validate(gamespace_id="int", kind="str_name", base="str", count="int")
+    async def suggest_name(self, gamespace_id, kind, base, count=5):
+        """
+        Generates free names based on @base (the base itself, if it is free, or the base with a numeric suffix).
+        Every round of candidates is checked with a single query (see check_names).
+
+        :returns a list of up to @count free names, acquire_name still has to be called to take one
+        """
+
+        base = base.strip()
+
+        if not base:
+            raise NamesModelError(400, "Base name is empty")
+
+        count = max(1, min(count, NamesModel.MAX_SUGGEST_COUNT))
+        suggested = []
+        seen = set()
+
+        for attempt in range(0, NamesModel.SUGGEST_ROUNDS):
+            candidates = []
+
+            for candidate in NamesModel.__suggest_candidates__(base, count, attempt):
+                key = NamesModel.__name_key__(candidate)
+                if key not in seen:
+                    seen.add(key)
+                    candidates.append(candidate)
+
+            checked = await self.check_names(gamespace_id, kind, candidates)
+
+            suggested.extend(candidate for candidate in candidates if checked[candidate] is None)
+
+            if len(suggested) >= count:
+                break
+
+        return suggested[:count]
+
     @validate(gamespace_id="int", account_id="int", kind="str_name", name="str")
     async def acquire_name(self, gamespace_id, account_id, kind, name):
+        if self.bloom_filter is not None:
+            # the name is added before it is taken, so the filter never calls a taken name free
+            try:
+                await self.bloom_filter.add(gamespace_id, kind, name)
+            except Exception as e:
+                raise NamesModelError(503, "Failed to update the names bloom filter: " + str(e))
+
         try:
             updated = await self.db.execute(
                 """
@@ -155,6 +406,9 @@ class NamesModel(Model):
         if not updated:
             raise NameIsBusyError()
 
+        if self.name_index is not None:
+            self.name_index.add((gamespace_id, kind), account_id, name)
+
     @validate(gamespace_id="int", account_id="int", kind="str_name")
     async def release_name(self, gamespace_id, account_id, kind):
         try:
@@ -166,5 +420,8 @@ class NamesModel(Model):
                 """, gamespace_id, account_id, kind)
         except DatabaseError as e:
             raise NamesModelError(500, e.args[1])
-        else:
-            return bool(released)
+
+        if released and self.name_index is not None:
+            self.name_index.remove((gamespace_id, kind), account_id)
+
+        return bool(released)
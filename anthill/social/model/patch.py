@@ -0,0 +1,289 @@
+from anthill.common.database import DatabaseError
+from anthill.common.profile import DatabaseProfile, NoDataError, ProfileError
+
+import ujson
+
+
+class ProfilePatch(object):
+    """
+    Translates a profile update into a single MySQL expression, so the update can be applied in place
+        (without reading the profile first and holding a row lock across the merge in Python).
+
+    Merge updates become JSON_MERGE_PATCH: nested objects are merged, and a None value removes the field,
+        like DatabaseProfile.set_data does. Non-merge updates become a chain of JSON_SET/JSON_REMOVE calls.
+
+    Updates that contain '@func' objects cannot be expressed that way, see ProfilePatch.supports.
+    """
+
+    def __init__(self, fields, path=None, merge=True):
+        self.fields = fields
+        self.path = path or []
+        self.merge = merge
+
+    @staticmethod
+    def has_functions(value):
+        if isinstance(value, dict):
+            if "@func" in value:
+                return True
+            return any(ProfilePatch.has_functions(child) for child in value.values())
+        return False
+
+    @staticmethod
+    def supports(fields):
+        return isinstance(fields, dict) and not ProfilePatch.has_functions(fields)
+
+    @staticmethod
+    def format_path(path):
+        return "$" + "".join(".\"{0}\"".format(str(key).replace("\"", "\\\"")) for key in path)
+
+    @staticmethod
+    def wrap(path, value):
+        for key in reversed(path):
+            value = {key: value}
+        return value
+
+    def compile(self, column):
+        """
+        :returns a tuple (expression, args) that evaluates to the updated value of the column
+        """
+
+        if self.merge:
+            return "JSON_MERGE_PATCH(`{0}`, CAST(%s AS JSON))".format(column), [
+                ujson.dumps(ProfilePatch.wrap(self.path, self.fields))
+            ]
+
+        expression = "`{0}`".format(column)
+        args = []
+
+        if self.path:
+            # make sure the whole path exists, JSON_SET does not create intermediate objects
+            expression = "JSON_MERGE_PATCH({0}, CAST(%s AS JSON))".format(expression)
+            args.append(ujson.dumps(ProfilePatch.wrap(self.path, {})))
+
+        for key, value in self.fields.items():
+            key_path = ProfilePatch.format_path(self.path + [key])
+            if value is None:
+                expression = "JSON_REMOVE({0}, %s)".format(expression)
+                args.append(key_path)
+            else:
+                expression = "JSON_SET({0}, %s, CAST(%s AS JSON))".format(expression)
+                args.extend([key_path, ujson.dumps(value)])
+
+        return expression, args
+
+    def result(self, updated):
+        if isinstance(updated, str):
+            updated = ujson.loads(updated)
+
+        for key in self.path:
+            if not isinstance(updated, dict):
+                return None
+            updated = updated.get(key)
+
+        return updated
+
+
+class ProfileCounters(object):
+    """
+    A set of numeric operations applied atomically to a profile, in a single UPDATE statement.
+
+    Each operation is a dict:
+
+    {
+        "path": ["scores", "total"],
+        "op": "increment",
+        "value": 10
+    }
+
+    Supported operations are "increment", "decrement", "min" (keep the smallest of the current value
+        and @value) and "max" (keep the biggest). A missing field is treated as 0 for increment/decrement and as
+        the @value itself for min/max. Integer values keep an integer field an integer, a float field stays a float.
+    """
+
+    INCREMENT = "increment"
+    DECREMENT = "decrement"
+    MIN = "min"
+    MAX = "max"
+
+    ALL = {
+        INCREMENT, DECREMENT, MIN, MAX
+    }
+
+    MAX_OPERATIONS = 64
+
+    def __init__(self, operations):
+        if not isinstance(operations, list) or not operations:
+            raise ProfileError("Operations should be a non-empty list")
+
+        if len(operations) > ProfileCounters.MAX_OPERATIONS:
+            raise ProfileError("Too many operations")
+
+        self.operations = []
+
+        for operation in operations:
+            if not isinstance(operation, dict):
+                raise ProfileError("Operation should be a dict")
+
+            path = operation.get("path")
+            op = operation.get("op")
+            value = operation.get("value")
+
+            if not isinstance(path, list) or not path or not all(isinstance(key, str) for key in path):
+                raise ProfileError("Operation path should be a non-empty list of strings")
+
+            if op not in ProfileCounters.ALL:
+                raise ProfileError("No such operation: " + str(op))
+
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ProfileError("Operation value should be a number")
+
+            self.operations.append((path, op, value))
+
+        paths = [path for path, op, value in self.operations]
+
+        for a in paths:
+            for b in paths:
+                if a is not b and b[:len(a)] == a:
+                    raise ProfileError("Operation paths overlap: " + ".".join(b))
+
+    @staticmethod
+    def __operation__(op, current, key_path, value):
+        """
+        :returns a tuple (expression, args) of the operation applied to the @current value expression
+        """
+
+        if op == ProfileCounters.INCREMENT:
+            return "COALESCE({0}, 0) + %s".format(current), [key_path, value]
+
+        if op == ProfileCounters.DECREMENT:
+            return "COALESCE({0}, 0) - %s".format(current), [key_path, value]
+
+        if op == ProfileCounters.MIN:
+            return "LEAST(COALESCE({0}, %s), %s)".format(current), [key_path, value, value]
+
+        return "GREATEST(COALESCE({0}, %s), %s)".format(current), [key_path, value, value]
+
+    def compile(self, column):
+        """
+        :returns a tuple (expression, args) that evaluates to the updated value of the column
+        """
+
+        expression = "`{0}`".format(column)
+        args = []
+
+        # make sure parent objects exist, JSON_SET does not create them
+        parents = {}
+        for path, op, value in self.operations:
+            parent = parents
+            for key in path[:-1]:
+                parent = parent.setdefault(key, {})
+
+        if parents:
+            expression = "JSON_MERGE_PATCH({0}, CAST(%s AS JSON))".format(expression)
+            args.append(ujson.dumps(parents))
+
+        values = []
+
+        for path, op, value in self.operations:
+            key_path = ProfilePatch.format_path(path)
+            stored = "JSON_EXTRACT(`{0}`, %s)".format(column)
+
+            if not isinstance(value, int):
+                operation, operation_args = ProfileCounters.__operation__(op, stored, key_path, value)
+                values.append("%s, " + operation)
+                args.append(key_path)
+                args.extend(operation_args)
+                continue
+
+            # an integer keeps the field an integer, unless it holds a float already
+            integer, integer_args = ProfileCounters.__operation__(
+                op, "CAST({0} AS SIGNED)".format(stored), key_path, value)
+            double, double_args = ProfileCounters.__operation__(op, stored, key_path, value)
+
+            values.append("%s, IF(JSON_TYPE({0}) = 'DOUBLE', CAST({1} AS JSON), CAST({2} AS JSON))".format(
+                stored, double, integer))
+            args.extend([key_path, key_path])
+            args.extend(double_args)
+            args.extend(integer_args)
+
+        expression = "JSON_SET({0}, {1})".format(expression, ", ".join(values))
+        return expression, args
+
+
+class PatchableProfile(DatabaseProfile):
+    """
+    A DatabaseProfile that can apply updates server-side with ProfilePatch.
+
+    Counter operations (see ProfileCounters) are applied the same way with update_counters.
+
+    Implementations should define get_patch_target, that returns a tuple (table, column, condition, args),
+        where condition is a WHERE clause matching exactly one row.
+    """
+
+    def get_patch_target(self):
+        raise NotImplementedError()
+
+    async def patch_data(self, fields, path, merge=True):
+        """
+        Same as set_data, but the update is done by a single UPDATE statement when possible.
+        Falls back to set_data if the update contains functions.
+        """
+
+        if path is not None and not isinstance(path, list):
+            path = list(path)
+
+        if not ProfilePatch.supports(fields):
+            return await self.set_data(fields, path, merge=merge)
+
+        patch = ProfilePatch(fields, path=path, merge=merge)
+        expression, args = patch.compile(self.get_patch_target()[1])
+
+        updated = await self.__apply__(expression, args)
+        return patch.result(updated)
+
+    async def update_counters(self, operations):
+        """
+        Atomically applies counter operations (see ProfileCounters) in one statement.
+        :returns the updated profile
+        """
+
+        counters = ProfileCounters(operations)
+        expression, args = counters.compile(self.get_patch_target()[1])
+
+        updated = await self.__apply__(expression, args)
+
+        if isinstance(updated, str):
+            updated = ujson.loads(updated)
+
+        return updated
+
+    async def __apply__(self, expression, args):
+        table, column, condition, condition_args = self.get_patch_target()
+
+        async with self.db.acquire(auto_commit=False) as db:
+            try:
+                await db.execute(
+                    """
+                        UPDATE `{0}`
+                        SET `{1}`={2}
+                        WHERE {3}
+                        LIMIT 1;
+                    """.format(table, column, expression, condition), *(args + condition_args))
+
+                # the row is still locked by the update above, so this is exactly what we have written
+                updated = await db.get(
+                    """
+                        SELECT `{1}`
+                        FROM `{0}`
+                        WHERE {2}
+                        LIMIT 1;
+                    """.format(table, column, condition), *condition_args)
+            except DatabaseError as e:
+                raise ProfileError(str(e.args[1]))
+            finally:
+                await db.commit()
+
+        if not updated:
+            raise NoDataError()
+
+        return updated[column]
@@ -0,0 +1,131 @@
+from anthill.common.database import DuplicateError
+
+import logging
+
+
+class GroupPermissions(object):
+    """
+    Maps group permission names to bits, so the permissions of a participation are stored as a single integer
+        (`participation_permission_bits`), and can be checked right in the query that fetches the participation:
+        (`participation_permission_bits` & mask) = mask.
+
+    Built-in permissions have fixed bits (BUILTIN). Custom ones are registered per gamespace (the group_permissions
+        table) the first time they are granted, and get the next free bit. Once all of MAX_BITS are taken, new custom
+        permissions (as well as too long ones) are only kept by name (`participation_permissions`),
+        see GroupParticipationAdapter.has_permission.
+
+    A registered bit never changes, so the registry is cached as is: a permission missing from the cache
+        is only looked up again when it's granted.
+
+    Database errors are passed to the caller as is.
+    """
+
+    BUILTIN = ["request_approval", "send_invite", "kick"]
+    BUILTIN_BITS = {permission: bit for bit, permission in enumerate(BUILTIN)}
+    MAX_BITS = 64
+    MAX_NAME_LENGTH = 64
+    REGISTER_ATTEMPTS = 4
+
+    def __init__(self, db):
+        self.db = db
+        # gamespace_id -> permission name -> bit
+        self.gamespaces = {}
+
+    async def __load__(self, gamespace_id):
+        registered = await self.db.query(
+            """
+                SELECT `permission_name`, `permission_bit`
+                FROM `group_permissions`
+                WHERE `gamespace_id`=%s;
+            """, gamespace_id)
+
+        bits = dict(GroupPermissions.BUILTIN_BITS)
+
+        bits.update({
+            permission["permission_name"]: permission["permission_bit"]
+            for permission in registered
+        })
+
+        self.gamespaces[gamespace_id] = bits
+        return bits
+
+    async def __register__(self, gamespace_id, permissions, bits):
+        for attempt in range(0, GroupPermissions.REGISTER_ATTEMPTS):
+            if attempt:
+                # other instances have registered some of these (or taken the bits) in the meantime
+                bits = await self.__load__(gamespace_id)
+
+            missing = sorted(permission for permission in permissions if permission not in bits)
+            if not missing:
+                return bits
+
+            taken = set(bits.values())
+            free = [bit for bit in range(0, GroupPermissions.MAX_BITS) if bit not in taken]
+
+            if len(free) < len(missing):
+                logging.warning("No free permission bits left in gamespace {0}, permissions {1} are kept "
+                                "by name only".format(gamespace_id, ", ".join(missing[len(free):])))
+                missing = missing[:len(free)]
+
+                if not missing:
+                    return bits
+
+            values = []
+            args = []
+
+            for permission, bit in zip(missing, free):
+                values.append("(%s, %s, %s)")
+                args.extend([gamespace_id, permission, bit])
+
+            try:
+                await self.db.execute(
+                    """
+                        INSERT INTO `group_permissions`
+                        (`gamespace_id`, `permission_name`, `permission_bit`)
+                        VALUES {0};
+                    """.format(", ".join(values)), *args)
+            except DuplicateError:
+                continue
+
+        return await self.__load__(gamespace_id)
+
+    async def mask(self, gamespace_id, permissions):
+        """
+        :returns a bitmask of the permissions, registering the custom ones that are not known yet
+        """
+
+        permissions = set(permission for permission in permissions if permission)
+
+        if not permissions:
+            return 0
+
+        bits = await self.get_bits(gamespace_id)
+
+        # too long ones never get a bit, so they are not worth looking up
+        missing = set(
+            permission for permission in permissions
+            if permission not in bits and len(permission) <= GroupPermissions.MAX_NAME_LENGTH)
+
+        if missing and len(bits) < GroupPermissions.MAX_BITS:
+            bits = await self.__register__(gamespace_id, missing, bits)
+
+        mask = 0
+
+        for permission in permissions:
+            bit = bits.get(permission)
+            if bit is not None:
+                mask |= 1 << bit
+
+        return mask
+
+    async def get_bits(self, gamespace_id):
+        """
+        :returns a dict permission name -> bit of the gamespace
+        """
+
+        bits = self.gamespaces.get(gamespace_id)
+
+        if bits is None:
+            bits = await self.__load__(gamespace_id)
+
+        return bits
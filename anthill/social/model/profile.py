@@ -3,12 +3,102 @@ from anthill.common import cached
 from anthill.common.internal import Internal, InternalError
 from anthill.common.model import Model
 
+import hashlib
+import logging
+import ujson
+
 
 class ProfileRequestError(Exception):
     def __init__(self, message):
         self.message = message
 
 
+class AccountProfilesCache(object):
+    """
+    Public profiles of accounts, cached one account per key, so lists that share some accounts
+        (search results of different users, request lists etc) reuse each other's entries.
+
+    Accounts missing from the cache are fetched with a single mass_profiles request. Accounts that have
+        no profile are cached too, so they are not requested again until the entry expires.
+    """
+
+    def __init__(self, cache, ttl=60):
+        self.cache = cache
+        self.ttl = ttl
+        self.internal = Internal()
+
+    @staticmethod
+    def __cache_key__(gamespace_id, account_id, fields_hash):
+        return "account_profile:" + str(gamespace_id) + ":" + str(account_id) + ":" + fields_hash
+
+    @staticmethod
+    def __fields_hash__(profile_fields):
+        h = hashlib.sha1()
+        for field in sorted(set(profile_fields)):
+            h.update(field.encode("utf-8") + b",")
+        return h.hexdigest()
+
+    async def get(self, gamespace_id, account_ids, profile_fields):
+        """
+        :returns a dict account_id (as a string) -> profile (None if the account has no profile)
+        :raises InternalError if profiles could not be requested
+        """
+
+        account_ids = list(set(str(account_id) for account_id in account_ids))
+
+        if not account_ids:
+            return {}
+
+        fields_hash = AccountProfilesCache.__fields_hash__(profile_fields)
+        keys = [
+            AccountProfilesCache.__cache_key__(gamespace_id, account_id, fields_hash)
+            for account_id in account_ids
+        ]
+
+        result = {}
+
+        try:
+            async with self.cache.acquire() as db:
+                cached_profiles = await db.mget(*keys)
+        except Exception as e:
+            logging.warning("Failed to get cached profiles: " + str(e))
+            cached_profiles = [None] * len(keys)
+
+        missing = []
+
+        for account_id, cached_profile in zip(account_ids, cached_profiles):
+            if cached_profile is None:
+                missing.append(account_id)
+            else:
+                result[account_id] = ujson.loads(cached_profile)
+
+        if not missing:
+            return result
+
+        profiles = await self.internal.request(
+            "profile", "mass_profiles",
+            accounts=missing,
+            gamespace=gamespace_id,
+            action="get_public",
+            profile_fields=profile_fields)
+
+        try:
+            async with self.cache.acquire() as db:
+                pipe = db.pipeline()
+                for account_id in missing:
+                    profile = profiles.get(account_id)
+                    result[account_id] = profile
+                    pipe.set(AccountProfilesCache.__cache_key__(gamespace_id, account_id, fields_hash),
+                             ujson.dumps(profile), expire=self.ttl)
+                await pipe.execute()
+        except Exception as e:
+            logging.warning("Failed to cache profiles: " + str(e))
+            for account_id in missing:
+                result[account_id] = profiles.get(account_id)
+
+        return result
+
+
 class ProfilesModel(Model):
     @staticmethod
     def __cache_hash__(account_id, data):
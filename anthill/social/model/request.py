@@ -5,8 +5,13 @@ from anthill.common.database import DatabaseError, DuplicateError
 from anthill.common.internal import Internal, InternalError
 
 from . import profile
+from . schema import add_missing_indexes
+from . deletion import delete_accounts
+
+from tornado.gen import multi
 
 import datetime
+import heapq
 import uuid
 import ujson
 
@@ -34,7 +39,7 @@ class RequestAdapter(object):
         self.key = data.get("request_key")
         self.payload = data.get("request_payload")
 
-        # apparently, mysql returns LONGTEXT field type instead of JSON in case of union calls
+        # depending on the query and the driver, JSON fields may come as text
         if isinstance(self.payload, str):
             self.payload = ujson.loads(self.payload)
 
@@ -96,10 +101,21 @@ class RequestsModel(profile.ProfilesModel):
 
     # a week
     REQUEST_EXPIRE_IN = 604800
+    PROFILES_CACHE_TTL = 60
+    MAX_TOTAL_LIMIT = 1000
+    CURSOR_TIME_FORMAT = "%Y%m%d%H%M%S"
+
+    # see list_total_account_requests, also declared in sql/requests.sql
+    INDEXES = [
+        ("incoming", "(`gamespace_id`, `request_type`, `request_object`, `request_time`, `account_id`)"),
+        ("outgoing", "(`gamespace_id`, `account_id`, `request_time`, `request_type`, `request_object`)"),
+        ("request_object", "(`request_type`, `request_object`)")
+    ]
 
     def __init__(self, db, cache):
         super(RequestsModel, self).__init__(db, cache)
         self.internal = Internal()
+        self.profiles = profile.AccountProfilesCache(cache, ttl=RequestsModel.PROFILES_CACHE_TTL)
 
     def get_setup_db(self):
         return self.db
@@ -113,34 +129,62 @@ class RequestsModel(profile.ProfilesModel):
     def has_delete_account_event(self):
         return True
 
-    async def accounts_deleted(self, gamespace, accounts, gamespace_only):
+    async def started(self, application):
+        await super(RequestsModel, self).started(application)
+        await add_missing_indexes(self.db, "requests", RequestsModel.INDEXES)
+
+    async def delete_accounts_chunk(self, gamespace, accounts, gamespace_only, limit):
         try:
-            async with self.db.acquire() as db:
-                if gamespace_only:
-                    await db.execute(
-                        """
-                            DELETE FROM `requests`
-                            WHERE `gamespace_id`=%s AND `account_id` IN %s;
-                        """, gamespace, accounts)
-                    await db.execute(
-                        """
-                            DELETE FROM `requests`
-                            WHERE `gamespace_id`=%s AND `request_type`=%s AND `request_object` IN %s;
-                        """, gamespace, RequestType.ACCOUNT, accounts)
-                else:
-                    await db.execute(
-                        """
-                            DELETE FROM `requests`
-                            WHERE `account_id` IN %s;
-                        """, accounts)
-                    await db.execute(
-                        """
-                            DELETE FROM `requests`
-                            WHERE `request_type`=%s AND `request_object` IN %s;
-                        """, RequestType.ACCOUNT, accounts)
+            if gamespace_only:
+                deleted = await self.db.execute(
+                    """
+                        DELETE FROM `requests`
+                        WHERE `account_id` IN %s AND `gamespace_id`=%s
+                        LIMIT %s;
+                    """, accounts, gamespace, limit)
+                deleted += await self.db.execute(
+                    """
+                        DELETE FROM `requests`
+                        WHERE `gamespace_id`=%s AND `request_type`=%s AND `request_object` IN %s
+                        LIMIT %s;
+                    """, gamespace, RequestType.ACCOUNT, accounts, limit)
+            else:
+                deleted = await self.db.execute(
+                    """
+                        DELETE FROM `requests`
+                        WHERE `account_id` IN %s
+                        LIMIT %s;
+                    """, accounts, limit)
+                deleted += await self.db.execute(
+                    """
+                        DELETE FROM `requests`
+                        WHERE `request_type`=%s AND `request_object` IN %s
+                        LIMIT %s;
+                    """, RequestType.ACCOUNT, accounts, limit)
         except DatabaseError as e:
             raise RequestError(500, "Failed to delete requests: " + e.args[1])
 
+        return deleted
+
+    async def accounts_deleted(self, gamespace, accounts, gamespace_only):
+        await delete_accounts(self, gamespace, accounts, gamespace_only)
+
+    async def delete_object_requests_chunk(self, gamespace_id, request_type, request_object, limit):
+        """
+        Deletes at most @limit requests to the object (for example, of a group being disbanded)
+        :returns the number of requests deleted
+        """
+
+        try:
+            return await self.db.execute(
+                """
+                    DELETE FROM `requests`
+                    WHERE `gamespace_id`=%s AND `request_type`=%s AND `request_object`=%s
+                    LIMIT %s;
+                """, gamespace_id, str(request_type), request_object, limit)
+        except DatabaseError as e:
+            raise RequestError(500, "Failed to delete requests: " + str(e.args[1]))
+
     @validate(gamespace_id="int", account_id="int", request_type='str_name', request_object="int",
               request_payload="json")
     async def create_request(self, gamespace_id, account_id, request_type, request_object, request_payload=None):
@@ -186,13 +230,38 @@ class RequestsModel(profile.ProfilesModel):
         except DatabaseError as e:
             raise RequestError(500, "Failed to delete requests: " + str(e.args[1]))
 
-    def __fetch_profile__(self, gamespace_id, account_ids, profile_fields):
-        return self.internal.request(
-            "profile", "mass_profiles",
-            accounts=list(set(account_ids)),
-            gamespace=gamespace_id,
-            action="get_public",
-            profile_fields=profile_fields)
+    async def __attach_profiles__(self, gamespace_id, requests, profile_fields, remote_account):
+        """
+        Attaches public profiles to a (materialized) list of requests, with a single profile batch at most.
+        :param remote_account: a function that returns the account id of the request to attach the profile of
+        """
+
+        if profile_fields is None:
+            return
+
+        # requests without a remote account have no profile to attach, and are not looked up
+        accounts = [(r, RequestsModel.__account_id__(remote_account(r))) for r in requests]
+        account_ids = set(account for r, account in accounts if account is not None)
+
+        if not account_ids:
+            return
+
+        try:
+            profiles = await self.profiles.get(gamespace_id, account_ids, profile_fields)
+        except InternalError as e:
+            raise RequestError(e.code, str(e))
+
+        for r, account in accounts:
+            if account is not None:
+                r.profile = profiles.get(str(account), None)
+
+    @staticmethod
+    def __account_id__(account):
+        # ids of RequestAdapter are strings, so a missing one may be "None" as well
+        if not account or str(account) in ("0", "None"):
+            return None
+
+        return account
 
     @validate(gamespace_id="int", account_id="int", profile_fields="json_list_of_strings")
     async def list_outgoing_account_requests(self, gamespace_id, account_id, profile_fields=None):
@@ -206,19 +275,8 @@ class RequestsModel(profile.ProfilesModel):
         except DatabaseError as e:
             raise RequestError(500, "Failed to list requests: " + str(e.args[1]))
 
-        requests = map(RequestAdapterMapper(account_id), data)
-
-        if profile_fields is not None:
-            account_ids = [r.object for r in requests]
-
-            try:
-                profiles = await self.__fetch_profile__(gamespace_id, account_ids, profile_fields)
-            except InternalError as e:
-                raise RequestError(e.code, str(e))
-
-            for r in requests:
-                r.profile = profiles.get(str(r.object), None)
-
+        requests = list(map(RequestAdapterMapper(account_id), data))
+        await self.__attach_profiles__(gamespace_id, requests, profile_fields, lambda r: r.object)
         return requests
 
     @validate(gamespace_id="int", account_id="int", profile_fields="json_list_of_strings")
@@ -233,52 +291,108 @@ class RequestsModel(profile.ProfilesModel):
         except DatabaseError as e:
             raise RequestError(500, "Failed to list requests: " + str(e.args[1]))
 
-        requests = map(RequestAdapterMapper(account_id), data)
-
-        if profile_fields is not None:
-            account_ids = [r.account for r in requests]
-
-            try:
-                profiles = await self.__fetch_profile__(gamespace_id, account_ids, profile_fields)
-            except InternalError as e:
-                raise RequestError(e.code, str(e))
-
-            for r in requests:
-                r.profile = profiles.get(str(r.account), None)
-
+        requests = list(map(RequestAdapterMapper(account_id), data))
+        await self.__attach_profiles__(gamespace_id, requests, profile_fields, lambda r: r.account)
         return requests
 
-    @validate(gamespace_id="int", account_id="int", profile_fields="json_list_of_strings")
-    async def list_total_account_requests(self, gamespace_id, account_id, profile_fields=None):
+    @staticmethod
+    def __total_order__(data):
+        return data["request_time"], data["account_id"], str(data["request_type"]), data["request_object"]
+
+    @staticmethod
+    def __parse_cursor__(cursor):
         try:
-            data = await self.db.query("""
-                SELECT `account_id`, `request_type`, `request_object`, `request_time`, `request_key`, `request_payload`
-                FROM `requests`
-                WHERE `gamespace_id`=%s AND `request_type`=%s AND `request_object`=%s
-                
-                UNION
-                
-                SELECT `account_id`, `request_type`, `request_object`, `request_time`, `request_key`, `request_payload`
-                FROM `requests`
-                WHERE `gamespace_id`=%s AND `account_id`=%s;
-            """, gamespace_id, RequestType.ACCOUNT, account_id, gamespace_id, account_id)
+            request_time, account, request_type, request_object = cursor.split(":")
+            request_time = datetime.datetime.strptime(request_time, RequestsModel.CURSOR_TIME_FORMAT)
+            account, request_object = int(account), int(request_object)
+        except ValueError:
+            raise RequestError(400, "Bad cursor")
+
+        if request_type not in RequestType.ALL:
+            raise RequestError(400, "Bad cursor")
+
+        return request_time, account, request_type, request_object
+
+    @staticmethod
+    def cursor(request):
+        """
+        :returns a cursor to pass to list_total_account_requests to get requests that go after this one
+        """
+        return "{0}:{1}:{2}:{3}".format(
+            request.time.strftime(RequestsModel.CURSOR_TIME_FORMAT), request.account, request.type, request.object)
+
+    @validate(gamespace_id="int", account_id="int", profile_fields="json_list_of_strings", limit="int",
+              cursor="str")
+    async def list_total_account_requests(self, gamespace_id, account_id, profile_fields=None, limit=None,
+                                          cursor=None):
+        """
+        Lists both incoming and outgoing requests of the account, newest first.
+
+        Incoming and outgoing requests are queried separately (and concurrently), each one using its own index
+            in the same order, and then merged. This is cheaper than a UNION, which needs a temporary table,
+            a sort to remove duplicates, and turns the payload into text.
+
+        :param limit: maximum number of requests to return (all requests if None)
+        :param cursor: only return requests after this one (see RequestsModel.cursor)
+        """
+
+        conditions = ""
+        page = ""
+        condition_args = []
+        page_args = []
+
+        if cursor:
+            conditions = " AND (`request_time`, `account_id`, `request_type`, `request_object`) < (%s, %s, %s, %s)"
+            request_time, account, request_type, request_object = RequestsModel.__parse_cursor__(cursor)
+            condition_args = [request_time, account, request_type, request_object]
+
+        if limit is not None:
+            limit = max(1, min(limit, RequestsModel.MAX_TOTAL_LIMIT))
+            page = " LIMIT %s"
+            page_args = [limit]
+
+        order = " ORDER BY `request_time` DESC, `account_id` DESC, `request_type` DESC, `request_object` DESC"
 
+        try:
+            incoming, outgoing = await multi([
+                self.db.query(
+                    """
+                        SELECT `account_id`, `request_type`, `request_object`, `request_time`,
+                            `request_key`, `request_payload`
+                        FROM `requests`
+                        WHERE `gamespace_id`=%s AND `request_type`=%s AND `request_object`=%s
+                    """ + conditions + order + page + ";",
+                    gamespace_id, RequestType.ACCOUNT, account_id, *(condition_args + page_args)),
+                self.db.query(
+                    """
+                        SELECT `account_id`, `request_type`, `request_object`, `request_time`,
+                            `request_key`, `request_payload`
+                        FROM `requests`
+                        WHERE `gamespace_id`=%s AND `account_id`=%s
+                    """ + conditions + order + page + ";",
+                    gamespace_id, account_id, *(condition_args + page_args))
+            ])
         except DatabaseError as e:
             raise RequestError(500, "Failed to list requests: " + str(e.args[1]))
 
-        requests = map(RequestAdapterMapper(account_id), data)
+        data = []
+        seen = set()
 
-        if profile_fields is not None:
-            account_ids = [r.remote_object for r in requests if r.remote_object]
+        for request in heapq.merge(incoming, outgoing, key=RequestsModel.__total_order__, reverse=True):
+            key = (request["account_id"], str(request["request_type"]), request["request_object"])
 
-            try:
-                profiles = await self.__fetch_profile__(gamespace_id, account_ids, profile_fields)
-            except InternalError as e:
-                raise RequestError(e.code, str(e))
+            # a request to oneself is both incoming and outgoing
+            if key in seen:
+                continue
+
+            seen.add(key)
+            data.append(request)
 
-            for r in requests:
-                r.profile = profiles.get(str(r.remote_object), None)
+            if limit is not None and len(data) >= limit:
+                break
 
+        requests = list(map(RequestAdapterMapper(account_id), data))
+        await self.__attach_profiles__(gamespace_id, requests, profile_fields, lambda r: r.remote_object)
         return requests
 
     @validate(gamespace_id="int", account_id="int", request_type=RequestType, request_object="int")
@@ -0,0 +1,75 @@
+from anthill.common.database import DatabaseError
+
+import logging
+
+
+async def add_missing_indexes(db, table, indexes):
+    """
+    Adds indexes that were introduced after the table has been created (sql/*.sql files only apply
+        to new tables).
+
+    :param indexes: a list of (name, definition) tuples, for example ("outgoing", "(`account_id`, `time`)")
+    """
+
+    try:
+        existing = await db.query(
+            """
+                SHOW INDEX FROM `{0}`;
+            """.format(table))
+    except DatabaseError as e:
+        logging.error("Failed to list indexes of '{0}': {1}".format(table, e.args[1]))
+        return
+
+    existing = set(index["Key_name"] for index in existing)
+
+    for name, definition in indexes:
+        if name in existing:
+            continue
+
+        try:
+            await db.execute(
+                """
+                    ALTER TABLE `{0}` ADD INDEX `{1}` {2};
+                """.format(table, name, definition))
+        except DatabaseError as e:
+            logging.error("Failed to add index '{0}' to '{1}': {2}".format(name, table, e.args[1]))
+        else:
+            logging.warning("Added index '{0}' to '{1}'".format(name, table))
+
+
+async def add_missing_columns(db, table, columns):
+    """
+    Adds columns that were introduced after the table has been created.
+
+    :param columns: a list of (name, definition) tuples, for example ("deleted", "tinyint(1) NOT NULL DEFAULT '0'")
+    :returns a list of names of the columns that have been added
+    """
+
+    try:
+        existing = await db.query(
+            """
+                SHOW COLUMNS FROM `{0}`;
+            """.format(table))
+    except DatabaseError as e:
+        logging.error("Failed to list columns of '{0}': {1}".format(table, e.args[1]))
+        return []
+
+    existing = set(column["Field"] for column in existing)
+    added = []
+
+    for name, definition in columns:
+        if name in existing:
+            continue
+
+        try:
+            await db.execute(
+                """
+                    ALTER TABLE `{0}` ADD COLUMN `{1}` {2};
+                """.format(table, name, definition))
+        except DatabaseError as e:
+            logging.error("Failed to add column '{0}' to '{1}': {2}".format(name, table, e.args[1]))
+        else:
+            logging.warning("Added column '{0}' to '{1}'".format(name, table))
+            added.append(name)
+
+    return added
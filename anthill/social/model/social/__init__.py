@@ -121,12 +121,12 @@ class SocialAPIModel(object):
                 except SocialTokensError as e2:
                     raise APIError(500, e2.message)
 
-                account_ids = credentials_to_accounts.values()
+                account_ids = list(credentials_to_accounts.values())
             else:
                 credentials_to_accounts = {}
                 account_ids = []
 
-            internal_connections = await self.connections.list_connections(account_id)
+            internal_connections = await self.connections.list_connections(gamespace, account_id)
 
             account_ids.extend(internal_connections)
 
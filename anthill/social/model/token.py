@@ -2,6 +2,9 @@
 from anthill.common.database import DatabaseError
 from anthill.common.model import Model
 
+from .deletion import delete_accounts
+from .schema import add_missing_indexes
+
 import ujson
 
 
@@ -44,23 +47,32 @@ class SocialTokensModel(Model):
     def has_delete_account_event(self):
         return True
 
-    async def accounts_deleted(self, gamespace, accounts, gamespace_only):
+    async def started(self, application):
+        await super(SocialTokensModel, self).started(application)
+        await add_missing_indexes(self.db, "credential_tokens", [("account_id", "(`account_id`)")])
+
+    async def delete_accounts_chunk(self, gamespace, accounts, gamespace_only, limit):
         try:
             if gamespace_only:
-                await self.db.execute(
+                return await self.db.execute(
                     """
                         DELETE FROM `credential_tokens`
-                        WHERE `gamespace_id`=%s AND `account_id` IN %s;
-                    """, gamespace, accounts)
+                        WHERE `account_id` IN %s AND `gamespace_id`=%s
+                        LIMIT %s;
+                    """, accounts, gamespace, limit)
             else:
-                await self.db.execute(
+                return await self.db.execute(
                     """
                         DELETE FROM `credential_tokens`
-                        WHERE `account_id` IN %s;
-                    """, accounts)
+                        WHERE `account_id` IN %s
+                        LIMIT %s;
+                    """, accounts, limit)
         except DatabaseError as e:
             raise SocialTokensError("Failed to delete saved tokens: " + e.args[1])
 
+    async def accounts_deleted(self, gamespace, accounts, gamespace_only):
+        await delete_accounts(self, gamespace, accounts, gamespace_only)
+
     async def attach(self, gamespace_id, credential, username, account):
         try:
             merged = str(credential) + ":" + str(username)
@@ -40,6 +40,126 @@ define("db_name",
        type=str,
        help="MySQL database name")
 
+define("db_replica_hosts",
+       default="",
+       type=str,
+       help="Comma-separated list of MySQL read replicas of db_host (with the same database and credentials) "
+            "reads of read-only model methods are made on. Empty to read everything from db_host.")
+
+define("db_replica_max_lag",
+       default=5,
+       type=int,
+       help="Number of seconds a replica may lag behind db_host and still be read from.")
+
+define("db_replica_check_interval",
+       default=1000,
+       type=int,
+       help="Number of milliseconds between checks of the replicas' health and lag.")
+
+# Groups
+
+define("group_profile_coalesce_window",
+       default=100,
+       help="Number of milliseconds coalesced group profile updates are collected for before being written.",
+       group="groups",
+       type=int)
+
+define("group_rank_fields",
+       default="",
+       help="Comma-separated list of numeric group profile fields (dot-separated for nested ones) "
+            "groups can be ranked by, see /groups/top.",
+       group="groups",
+       type=str)
+
+define("group_name_index",
+       default=False,
+       help="Keep an in-memory index of group names to search groups by (instead of MySQL FULLTEXT search). "
+            "Groups changed by other instances are not in the index of this one until it restarts, search results "
+            "are checked against MySQL and completed with a FULLTEXT search to make up for that.",
+       group="groups",
+       type=bool)
+
+# Connections
+
+define("connections_legacy_gamespace",
+       default=-1,
+       help="Gamespace connections created before they were scoped by gamespace are moved into on upgrade. "
+            "Has to be set to upgrade a table that has connections, the service does not start otherwise.",
+       group="connections",
+       type=int)
+
+# Names
+
+define("names_index",
+       default=False,
+       help="Keep an in-memory index of unique names to search them by (instead of MySQL FULLTEXT search). "
+            "Names changed by other instances are not in the index of this one until it restarts, search results "
+            "are checked against MySQL and completed with a FULLTEXT search to make up for that.",
+       group="names",
+       type=bool)
+
+define("names_bloom_filter_bits",
+       default=0,
+       help="Size (in bits) of a bloom filter of taken names per gamespace and kind, kept in the cache, "
+            "that lets check_name answer without a database query for free names. 0 to disable.",
+       group="names",
+       type=int)
+
+# Account deletion
+
+define("account_deletion_chunk_size",
+       default=1000,
+       help="Maximum number of rows deleted by one statement when data of deleted accounts is removed.",
+       group="deletion",
+       type=int)
+
+define("account_deletion_pause",
+       default=50,
+       help="Number of milliseconds to wait between deletion chunks, to leave room for live traffic.",
+       group="deletion",
+       type=int)
+
+define("account_deletion_concurrency",
+       default=2,
+       help="Maximum number of models deleting account data at the same time.",
+       group="deletion",
+       type=int)
+
+# Metrics
+
+define("metrics",
+       default=True,
+       help="Collect timers and counters of handlers, model methods, database, cache and internal requests, "
+            "see /metrics and the admin page.",
+       group="metrics",
+       type=bool)
+
+define("trace_threshold",
+       default=1000,
+       help="Keep a trace (model methods, database statements, cache commands and requests to other services "
+            "made, with timings) of every request that took longer than that, in milliseconds. "
+            "0 to turn tracing off. Requires 'metrics'.",
+       group="metrics",
+       type=int)
+
+define("trace_sample_rate",
+       default=1.0,
+       help="A share of requests to trace, from 0 to 1.",
+       group="metrics",
+       type=float)
+
+define("trace_buffer_size",
+       default=100,
+       help="How many recent slow traces to keep in memory (see the admin page).",
+       group="metrics",
+       type=int)
+
+define("trace_file",
+       default="",
+       help="A file to append slow traces to, one JSON object per line. Empty not to.",
+       group="metrics",
+       type=str)
+
 # Regular cache
 
 define("cache_host",
@@ -0,0 +1,285 @@
+"""
+Routing of reads to MySQL replicas (see the 'db_replica_hosts' option).
+
+Only reads of the model methods known to be read-only (see READ_ONLY) go to the replicas, and only when such a method
+    is the outermost one being called: a read made on behalf of a method that writes (like get_group called by
+    join_group) goes to the primary, as it has to be up to date. Statements made on acquired connections
+    (transactions, mostly) go to the primary as well.
+
+Replicas are checked every `check_interval`: a replica that can't be reached, has its replication stopped, or lags
+    behind by more than `max_lag` is not read from until it catches up. When there's no replica to read from, or a
+    read from a replica fails to connect, the read is made on the primary.
+
+A request (or an incoming internal call) that has written something reads from the primary from that point on, so
+    it always sees its own writes, see `begin`.
+"""
+
+from tornado.gen import multi
+from tornado.ioloop import PeriodicCallback
+
+from anthill.common.database import DatabaseError, ConnectionError
+
+from .metrics import operation
+
+import contextvars
+import inspect
+import logging
+
+
+# model -> methods that only read, which reads may go to the replicas
+READ_ONLY = {
+    "GroupsModel": ["get_group", "list_groups", "list_group_participants", "search_groups"],
+    "ConnectionsModel": ["list_connections"],
+    "NamesModel": ["search_names"],
+    "RequestsModel": ["list_incoming_account_requests", "list_outgoing_account_requests",
+                      "list_total_account_requests"]
+}
+
+REPLICA = "replica"
+PRIMARY = "primary"
+
+# where reads of the model method being executed go (REPLICA or PRIMARY), None outside of model methods
+route = contextvars.ContextVar("route", default=None)
+# a Session of the request being handled, if any
+session = contextvars.ContextVar("replica_session", default=None)
+
+
+class Session(object):
+    def __init__(self):
+        self.wrote = False
+
+
+def begin():
+    """
+    Starts a new session in the current context, reads of read-only methods made after a write in it
+        go to the primary
+
+    :returns a token to pass to `session.reset` if the context has to be restored afterwards
+    """
+
+    return session.set(Session())
+
+
+def wrote():
+    current = session.get()
+
+    if current is not None:
+        current.wrote = True
+
+
+def routed_method(method, read_only):
+    """
+    Wraps a model method so reads it makes go where the outermost model method being called says
+    """
+
+    async def routed(awaitable):
+        if route.get() is not None:
+            return await awaitable
+
+        token = route.set(REPLICA if read_only else PRIMARY)
+
+        try:
+            return await awaitable
+        finally:
+            route.reset(token)
+
+    def wrapper(*args, **kwargs):
+        result = method(*args, **kwargs)
+
+        if not inspect.isawaitable(result):
+            return result
+
+        return routed(result)
+
+    wrapper.__wrapped__ = method
+    return wrapper
+
+
+def route_model(model):
+    read_only = READ_ONLY.get(model.__class__.__name__, [])
+
+    for name, _ in inspect.getmembers(model.__class__, predicate=inspect.isfunction):
+        if name.startswith("_"):
+            continue
+
+        setattr(model, name, routed_method(getattr(model, name), name in read_only))
+
+
+class Replica(object):
+    def __init__(self, host, db):
+        self.host = host
+        self.db = db
+        # nothing is read from a replica until it's checked
+        self.healthy = False
+        # seconds behind the primary, as of the last check
+        self.lag = None
+        self.error = "Not checked yet"
+
+
+class PrimaryConnection(object):
+    """
+    A DatabaseConnection (see Database.acquire) of the primary that tells the session about writes
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def __aenter__(self):
+        await self.connection.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return await self.connection.__aexit__(*exc_info)
+
+    async def init(self):
+        await self.connection.init()
+        return self
+
+    def __getattr__(self, item):
+        return getattr(self.connection, item)
+
+    def execute(self, query, *args, **kwargs):
+        wrote()
+        return self.connection.execute(query, *args, **kwargs)
+
+    def insert(self, query, *args, **kwargs):
+        wrote()
+        return self.connection.insert(query, *args, **kwargs)
+
+
+class ReplicatedDatabase(object):
+    """
+    A Database that makes reads of read-only model methods (see route_model) on healthy replicas, in turns,
+        and everything else on the primary
+    """
+
+    def __init__(self, primary, replicas, max_lag, check_interval, metrics=None):
+        """
+        :param primary: a Database to write to
+        :param replicas: a list of (host, Database) of its replicas
+        :param max_lag: how far behind the primary (in seconds) a replica may be to be read from
+        :param check_interval: seconds between replica checks
+        """
+
+        self.primary = primary
+        self.replicas = [Replica(host, db) for host, db in replicas]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.metrics = metrics
+        self.next = 0
+        self.check_callback = None
+
+    def __getattr__(self, item):
+        return getattr(self.primary, item)
+
+    def __inc__(self, name, **labels):
+        if self.metrics is not None:
+            self.metrics.inc(name, operation=operation.get(), **labels)
+
+    async def start(self):
+        await self.check()
+
+        self.check_callback = PeriodicCallback(self.check, self.check_interval * 1000)
+        self.check_callback.start()
+
+    def stop(self):
+        if self.check_callback:
+            self.check_callback.stop()
+            self.check_callback = None
+
+    async def check(self):
+        await multi([self.__check__(replica) for replica in self.replicas])
+
+    async def __check__(self, replica):
+        try:
+            status = await replica.db.get("SHOW SLAVE STATUS;")
+        except DatabaseError as e:
+            self.__unhealthy__(replica, "Failed to check: " + str(e))
+            return
+
+        if not status:
+            # not replicating by itself (like a proxy in front of replicas), there's nothing to wait for
+            lag = 0
+        else:
+            lag = status.get("Seconds_Behind_Master")
+
+            if lag is None:
+                self.__unhealthy__(replica, "Replication is not running")
+                return
+
+        replica.lag = lag
+
+        if lag > self.max_lag:
+            self.__unhealthy__(replica, "Lags behind by {0}s".format(lag))
+            return
+
+        if not replica.healthy:
+            logging.info("Replica {0} is back, reading from it".format(replica.host))
+
+        replica.healthy = True
+        replica.error = None
+
+    @staticmethod
+    def __unhealthy__(replica, error):
+        if replica.healthy:
+            logging.warning("Replica {0} is not read from: {1}".format(replica.host, error))
+
+        replica.healthy = False
+        replica.error = error
+
+    def replica(self):
+        """
+        :returns a Replica to make a read on, or None if it has to be made on the primary
+        """
+
+        if route.get() != REPLICA:
+            return None
+
+        current = session.get()
+
+        if current is not None and current.wrote:
+            self.__inc__("db_replica_fallbacks_total", reason="wrote")
+            return None
+
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(self.next + i) % len(self.replicas)]
+
+            if replica.healthy:
+                self.next = (self.next + i + 1) % len(self.replicas)
+                return replica
+
+        self.__inc__("db_replica_fallbacks_total", reason="unavailable")
+        return None
+
+    async def __read__(self, statement, query, args, kwargs):
+        replica = self.replica()
+
+        if replica is not None:
+            try:
+                result = await getattr(replica.db, statement)(query, *args, **kwargs)
+            except ConnectionError as e:
+                # it's checked again later on, the read is still made
+                self.__unhealthy__(replica, "Failed to read: " + str(e))
+                self.__inc__("db_replica_fallbacks_total", reason="failed")
+            else:
+                self.__inc__("db_replica_reads_total", replica=replica.host)
+                return result
+
+        return await getattr(self.primary, statement)(query, *args, **kwargs)
+
+    def get(self, query, *args, **kwargs):
+        return self.__read__("get", query, args, kwargs)
+
+    def query(self, query, *args, **kwargs):
+        return self.__read__("query", query, args, kwargs)
+
+    def execute(self, query, *args, **kwargs):
+        wrote()
+        return self.primary.execute(query, *args, **kwargs)
+
+    def insert(self, query, *args, **kwargs):
+        wrote()
+        return self.primary.insert(query, *args, **kwargs)
+
+    def acquire(self, *args, **kwargs):
+        return PrimaryConnection(self.primary.acquire(*args, **kwargs))
@@ -1,6 +1,8 @@
 
 from anthill.common.options import options
 from anthill.common import server, database, access, sign, keyvalue
+from anthill.common.internal import Internal
+from anthill.common.validate import validate_value, ValidationError
 
 from . model.connection import ConnectionsModel
 from . model.request import RequestsModel
@@ -8,6 +10,11 @@ from . model.social import SocialAPIModel
 from . model.token import SocialTokensModel
 from . model.group import GroupsModel
 from . model.names import NamesModel
+from . model.deletion import AccountDeletionsModel
+from . metrics import Metrics, InstrumentedDatabase, InstrumentedKeyValueStorage
+from . metrics import instrument_model, instrument_internal, instrument_social_api
+from . tracing import Tracer, current_span
+from . replicas import ReplicatedDatabase, route_model, begin, session
 from . import handler as h
 from . import options as _opts
 from . import admin
@@ -18,6 +25,14 @@ class SocialServer(server.Server):
     def __init__(self, db=None):
         super(SocialServer, self).__init__()
 
+        self.tracer = Tracer(
+            threshold=options.trace_threshold / 1000.0,
+            sample_rate=options.trace_sample_rate,
+            buffer_size=options.trace_buffer_size,
+            path=options.trace_file or None) if options.metrics and options.trace_threshold > 0 else None
+
+        self.metrics = Metrics(self.tracer) if options.metrics else None
+
         self.db = db or database.Database(
             host=options.db_host,
             database=options.db_name,
@@ -30,19 +45,155 @@ class SocialServer(server.Server):
             db=options.cache_db,
             max_connections=options.cache_max_connections)
 
+        if self.metrics is not None:
+            self.db = InstrumentedDatabase(self.db, self.metrics)
+            self.cache = InstrumentedKeyValueStorage(self.cache, self.metrics)
+
+        replica_hosts = [host.strip() for host in options.db_replica_hosts.split(",") if host.strip()]
+
+        self.replicas = ReplicatedDatabase(
+            self.db, [(host, self.create_replica_db(host)) for host in replica_hosts],
+            max_lag=options.db_replica_max_lag,
+            check_interval=options.db_replica_check_interval / 1000.0,
+            metrics=self.metrics) if replica_hosts else None
+
+        if self.replicas is not None:
+            self.db = self.replicas
+
         self.tokens = SocialTokensModel(self.db)
         self.requests = RequestsModel(self.db, self.cache)
-        self.connections = ConnectionsModel(self.db, self.cache, self.requests)
+        self.connections = ConnectionsModel(
+            self.db, self.cache, self.requests,
+            legacy_gamespace=options.connections_legacy_gamespace)
         self.social = SocialAPIModel(self, self.tokens, self.connections, self.cache)
-        self.groups = GroupsModel(self.db, self.requests)
-        self.names = NamesModel(self.db, self.cache)
+        self.groups = GroupsModel(
+            self.db, self.requests,
+            coalesce_window=options.group_profile_coalesce_window / 1000.0,
+            rank_fields=[field.strip() for field in options.group_rank_fields.split(",") if field.strip()],
+            name_index=options.group_name_index)
+        self.names = NamesModel(
+            self.db, self.cache,
+            name_index=options.names_index,
+            bloom_filter_bits=options.names_bloom_filter_bits)
+        self.deletions = AccountDeletionsModel(
+            self.db, [self.tokens, self.requests, self.connections, self.groups, self.names],
+            chunk_size=options.account_deletion_chunk_size,
+            pause=options.account_deletion_pause / 1000.0,
+            concurrency=options.account_deletion_concurrency)
+
+        if self.metrics is not None:
+            self.__instrument__()
+
+        if self.replicas is not None:
+            for model in self.get_models():
+                route_model(model)
+
+    def create_replica_db(self, host):
+        db = database.Database(
+            host=host,
+            database=options.db_name,
+            user=options.db_username,
+            password=options.db_password)
+
+        if self.metrics is not None:
+            db = InstrumentedDatabase(db, self.metrics)
+
+        return db
+
+    def __instrument__(self):
+        for model in self.get_models():
+            instrument_model(model, self.metrics)
+
+        for api in self.social.apis.values():
+            instrument_social_api(api, self.metrics)
+
+        instrument_internal(Internal(), self.metrics)
 
     def get_models(self):
-        return [self.tokens, self.requests, self.connections, self.groups, self.names]
+        return [self.tokens, self.requests, self.connections, self.groups, self.names, self.deletions]
+
+    async def started(self):
+        if self.replicas is not None:
+            await self.replicas.start()
+
+        await super(SocialServer, self).started()
+
+    async def process_shutdown(self):
+        await super(SocialServer, self).process_shutdown()
+
+        if self.replicas is not None:
+            self.replicas.stop()
+
+    def find_handler(self, request, **kwargs):
+        # reads made after the request writes something go to the primary
+        if self.replicas is not None:
+            begin()
+
+        # a trace is started as soon as the request is routed, so the handler (and everything it does) runs in it
+        if self.tracer is not None:
+            self.tracer.start(request.method + " " + request.path)
+
+        return super(SocialServer, self).find_handler(request, **kwargs)
+
+    def log_request(self, request_handler):
+        super(SocialServer, self).log_request(request_handler)
+
+        status = request_handler.get_status()
+
+        if self.metrics is not None:
+            self.metrics.observe(
+                "http_request_duration_seconds", request_handler.request.request_time(), error=status >= 500,
+                handler=request_handler.__class__.__name__, method=request_handler.request.method, code=status)
+
+        if self.tracer is not None:
+            self.tracer.finish(
+                request_handler.request.request_time(), error=status >= 500,
+                handler=request_handler.__class__.__name__, code=status)
+
+    async def __on_internal_receive__(self, context, method, *args, **kwargs):
+        if self.tracer is None and self.replicas is None:
+            return await super(SocialServer, self).__on_internal_receive__(context, method, *args, **kwargs)
+
+        session_token = begin() if self.replicas is not None else None
+        trace_token = self.tracer.start("internal " + str(method)) if self.tracer is not None else None
+        error = False
+
+        try:
+            return await super(SocialServer, self).__on_internal_receive__(context, method, *args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            if trace_token is not None:
+                self.tracer.finish(error=error)
+                current_span.reset(trace_token)
+
+            if session_token is not None:
+                session.reset(session_token)
+
+    async def __account_deleted_callback__(self, data):
+        """
+        Account data is deleted in the background by AccountDeletionsModel, in throttled chunks,
+            instead of every model deleting everything at once
+        """
+
+        try:
+            accounts = validate_value(data["accounts"], "json_list_of_ints")
+            gamespace_id = data["gamespace"]
+            gamespace_only = data["gamespace_only"]
+        except (KeyError, ValidationError):
+            return
+
+        if not accounts:
+            return
+
+        await self.deletions.enqueue(gamespace_id, accounts, gamespace_only)
 
     def get_admin(self):
         return {
-            "index": admin.RootAdminController
+            "index": admin.RootAdminController,
+            "traces": admin.TracesAdminController,
+            "trace": admin.TraceAdminController
         }
 
     def get_handlers(self):
@@ -58,11 +209,14 @@ class SocialServer(server.Server):
 
             (r"/groups/create", h.CreateGroupHandler),
             (r"/groups/search", h.SearchGroupsHandler),
+            (r"/groups/top", h.TopGroupsHandler),
             (r"/groups/profiles", h.GroupBatchProfilesHandler),
             (r"/group/([0-9]+)/participation/(.+)/permissions", h.GroupParticipationPermissionsHandler),
+            (r"/group/([0-9]+)/participation/(.+)/counters", h.GroupParticipationCountersHandler),
             (r"/group/([0-9]+)/participation/(.+)", h.GroupParticipationHandler),
             (r"/group/([0-9]+)/join", h.GroupJoinHandler),
             (r"/group/([0-9]+)/leave", h.GroupLeaveHandler),
+            (r"/group/([0-9]+)/profile/counters", h.GroupProfileCountersHandler),
             (r"/group/([0-9]+)/profile", h.GroupProfileHandler),
             (r"/group/([0-9]+)/ownership", h.GroupOwnershipHandler),
             (r"/group/([0-9]+)/request", h.GroupRequestJoinHandler),
@@ -75,7 +229,9 @@ class SocialServer(server.Server):
 
             (r"/names/acquire/(.*)", h.UniqueNamesAcquireHandler),
             (r"/names/delete/(.*)", h.UniqueNamesDeleteHandler),
-            (r"/names/search/(.*)", h.UniqueNamesSearchHandler)
+            (r"/names/search/(.*)", h.UniqueNamesSearchHandler),
+
+            (r"/metrics", h.MetricsHandler)
         ]
 
     def get_metadata(self):
@@ -1,7 +1,8 @@
 CREATE TABLE `account_connections` (
+  `gamespace_id` int(11) unsigned NOT NULL,
   `account_id` int(11) unsigned NOT NULL,
   `account_connection` int(11) unsigned NOT NULL,
-  UNIQUE KEY `account_id` (`account_id`,`account_connection`),
-  KEY `account_id_2` (`account_id`),
-  KEY `account_connection` (`account_connection`)
-) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
+  PRIMARY KEY (`gamespace_id`,`account_id`,`account_connection`),
+  KEY `account_connection` (`gamespace_id`,`account_connection`),
+  KEY `account_id` (`account_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
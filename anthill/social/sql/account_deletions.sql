@@ -0,0 +1,15 @@
+CREATE TABLE `account_deletions` (
+  `deletion_id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `deletion_key` varchar(64) NOT NULL,
+  `gamespace_id` int(11) unsigned NOT NULL,
+  `gamespace_only` tinyint(1) NOT NULL DEFAULT '1',
+  `deletion_accounts` json NOT NULL,
+  `deletion_progress` json NOT NULL,
+  `deletion_status` enum('pending','done','failed') NOT NULL DEFAULT 'pending',
+  `deletion_attempts` int(11) unsigned NOT NULL DEFAULT '0',
+  `deletion_lease` datetime DEFAULT NULL,
+  `deletion_created` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`deletion_id`),
+  UNIQUE KEY `deletion_key` (`deletion_key`),
+  KEY `deletion_status` (`deletion_status`,`deletion_lease`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
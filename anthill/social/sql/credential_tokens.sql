@@ -8,5 +8,6 @@ CREATE TABLE `credential_tokens` (
   `payload` json NOT NULL,
   `merged_credential` varchar(512) NOT NULL DEFAULT '',
   UNIQUE KEY `credential_unique` (`gamespace_id`,`credential`,`username`),
-  KEY `gamespace_id` (`gamespace_id`,`merged_credential`)
+  KEY `gamespace_id` (`gamespace_id`,`merged_credential`),
+  KEY `account_id` (`account_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
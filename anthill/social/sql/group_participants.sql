@@ -4,6 +4,7 @@ CREATE TABLE `group_participants` (
   `account_id` int(11) NOT NULL,
   `participation_role` int(11) NOT NULL,
   `participation_permissions` varchar(255) NOT NULL,
+  `participation_permission_bits` bigint(20) unsigned DEFAULT NULL,
   `participation_profile` json NOT NULL,
   UNIQUE KEY `group_id` (`group_id`,`gamespace_id`,`account_id`),
   KEY `account_id` (`account_id`),
@@ -0,0 +1,7 @@
+CREATE TABLE `group_permissions` (
+  `gamespace_id` int(11) NOT NULL,
+  `permission_name` varchar(64) NOT NULL,
+  `permission_bit` tinyint(3) unsigned NOT NULL,
+  PRIMARY KEY (`gamespace_id`,`permission_name`),
+  UNIQUE KEY `permission_bit` (`gamespace_id`,`permission_bit`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -7,6 +7,9 @@ CREATE TABLE `groups` (
   `group_free_members` int(11) unsigned NOT NULL DEFAULT '50',
   `group_join_method` enum('free','invite','approve') NOT NULL DEFAULT 'free',
   `group_owner` int(11) NOT NULL,
+  `group_deleted` tinyint(1) NOT NULL DEFAULT '0',
   PRIMARY KEY (`group_id`),
+  KEY `gamespace_name` (`gamespace_id`,`group_name`),
+  KEY `group_deleted` (`group_deleted`),
   FULLTEXT KEY `group_name` (`group_name`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
@@ -9,5 +9,8 @@ CREATE TABLE `requests` (
   `request_payload` json DEFAULT NULL,
   UNIQUE KEY `account_id` (`account_id`,`gamespace_id`,`request_type`,`request_object`),
   KEY `account_id_2` (`account_id`),
-  KEY `request_key` (`request_key`)
+  KEY `request_key` (`request_key`),
+  KEY `incoming` (`gamespace_id`,`request_type`,`request_object`,`request_time`,`account_id`),
+  KEY `outgoing` (`gamespace_id`,`account_id`,`request_time`,`request_type`,`request_object`),
+  KEY `request_object` (`request_type`,`request_object`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
\ No newline at end of file
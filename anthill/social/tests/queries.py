@@ -0,0 +1,199 @@
+"""
+Counting of database statements made by model methods, to keep the number of round trips of the hot paths in check.
+
+    recorder = QueryRecorder()
+    application = SocialServer(recorder.wrap(db))
+    recorder.instrument(application.groups, application.requests, application.connections)
+
+    with recorder.expect(queries=4, commits=1):
+        await application.groups.join_group(...)
+
+A call of a public method of an instrumented model is a logical operation: statements and commits it makes
+    (including the ones made by other model methods it calls) are recorded under its name, see `report`.
+"""
+
+from anthill.common.model import Model
+
+import contextlib
+import contextvars
+import inspect
+
+
+# Recordings being made in the current context
+recordings = contextvars.ContextVar("recordings", default=())
+
+
+class Recording(object):
+    def __init__(self, operation=None):
+        # a name of the model method, None for a block of code (see QueryRecorder.expect)
+        self.operation = operation
+        # (statement, query)
+        self.statements = []
+        self.commits = 0
+        # anything spawned by the operation that runs after it is not a part of it
+        self.closed = False
+
+    @property
+    def queries(self):
+        return len(self.statements)
+
+    def describe(self):
+        return "\n".join(
+            "    {0}: {1}".format(statement, " ".join(query.split()))
+            for statement, query in self.statements)
+
+
+def record(statement, query):
+    for recording in recordings.get():
+        if not recording.closed:
+            recording.statements.append((statement, query))
+
+
+def record_commit():
+    for recording in recordings.get():
+        if not recording.closed:
+            recording.commits += 1
+
+
+class RecordingConnection(object):
+    """
+    A DatabaseConnection (see Database.acquire) that records every statement
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def __aenter__(self):
+        await self.connection.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return await self.connection.__aexit__(*exc_info)
+
+    def __getattr__(self, item):
+        return getattr(self.connection, item)
+
+    def execute(self, query, *args, **kwargs):
+        record("execute", query)
+        return self.connection.execute(query, *args, **kwargs)
+
+    def get(self, query, *args, **kwargs):
+        record("get", query)
+        return self.connection.get(query, *args, **kwargs)
+
+    def insert(self, query, *args, **kwargs):
+        record("insert", query)
+        return self.connection.insert(query, *args, **kwargs)
+
+    def query(self, query, *args, **kwargs):
+        record("query", query)
+        return self.connection.query(query, *args, **kwargs)
+
+    def commit(self):
+        record_commit()
+        return self.connection.commit()
+
+
+class RecordingDatabase(RecordingConnection):
+    def __init__(self, db):
+        super(RecordingDatabase, self).__init__(db)
+        self.db = db
+
+    def acquire(self, *args, **kwargs):
+        return RecordingConnection(self.db.acquire(*args, **kwargs))
+
+
+def public_methods(model):
+    """
+    :returns names of the public methods of the model, except for the ones every Model has
+    """
+
+    return [
+        name for name, _ in inspect.getmembers(model.__class__, predicate=inspect.isfunction)
+        if not name.startswith("_") and not hasattr(Model, name)
+    ]
+
+
+class QueryRecorder(object):
+    def __init__(self):
+        # operation -> a list of Recordings, one per call
+        self.operations = {}
+
+    @staticmethod
+    def wrap(db):
+        return RecordingDatabase(db)
+
+    def instrument(self, *models):
+        for model in models:
+            for name in public_methods(model):
+                setattr(model, name, self.__operation__(
+                    model.__class__.__name__ + "." + name, getattr(model, name)))
+
+    def __operation__(self, name, method):
+        async def recorded(awaitable):
+            recording = Recording(name)
+            token = recordings.set(recordings.get() + (recording,))
+
+            try:
+                return await awaitable
+            finally:
+                recording.closed = True
+                recordings.reset(token)
+                self.operations.setdefault(name, []).append(recording)
+
+        def wrapper(*args, **kwargs):
+            result = method(*args, **kwargs)
+
+            if not inspect.isawaitable(result):
+                return result
+
+            # model methods called by other model methods are a part of the outer operation
+            if any(recording.operation is not None for recording in recordings.get()):
+                return result
+
+            return recorded(result)
+
+        return wrapper
+
+    @contextlib.contextmanager
+    def expect(self, queries, commits=0):
+        """
+        Fails if the code in the block makes more than @queries statements or more than @commits commits
+        """
+
+        recording = Recording()
+        token = recordings.set(recordings.get() + (recording,))
+
+        try:
+            yield recording
+        finally:
+            recording.closed = True
+            recordings.reset(token)
+
+        if recording.queries > queries or recording.commits > commits:
+            raise AssertionError(
+                "Expected at most {0} statements and {1} commits, got {2} and {3}:\n{4}".format(
+                    queries, commits, recording.queries, recording.commits, recording.describe()))
+
+    def report(self, *models):
+        """
+        :returns a table of public methods of the models with the most statements and commits a call has made,
+            methods that have not been called are listed too
+        """
+
+        lines = ["{0:<60} {1:>6} {2:>8} {3:>8}".format("operation", "calls", "queries", "commits")]
+
+        for model in models:
+            for name in public_methods(model):
+                operation = model.__class__.__name__ + "." + name
+                calls = self.operations.get(operation)
+
+                if not calls:
+                    lines.append("{0:<60} {1:>6} {2:>8} {3:>8}".format(operation, 0, "-", "-"))
+                    continue
+
+                lines.append("{0:<60} {1:>6} {2:>8} {3:>8}".format(
+                    operation, len(calls),
+                    max(call.queries for call in calls), max(call.commits for call in calls)))
+
+        return "\n".join(lines)
@@ -0,0 +1,200 @@
+from tornado.gen import sleep
+from tornado.testing import gen_test
+
+from .. server import SocialServer
+from .. model.connection import ConnectionError, migrate_gamespace
+from .. model.deletion import AccountDeletionsModel
+
+from anthill.common import testing
+from .. import options as _opts
+
+
+class ConnectionsTestCase(testing.ServerTestCase):
+    GAMESPACE_ID = 1
+    OTHER_GAMESPACE_ID = 2
+    ACCOUNT_A = 1
+    ACCOUNT_B = 2
+    ACCOUNT_C = 3
+
+    @classmethod
+    def need_test_db(cls):
+        return True
+
+    @classmethod
+    def get_server_instance(cls, db=None):
+        return SocialServer(db)
+
+    @gen_test
+    async def test_connection_checks(self):
+        connections = self.application.connections
+
+        await connections.create(ConnectionsTestCase.GAMESPACE_ID,
+                                 ConnectionsTestCase.ACCOUNT_A, ConnectionsTestCase.ACCOUNT_B)
+
+        self.assertTrue(await connections.are_connected(
+            ConnectionsTestCase.GAMESPACE_ID, ConnectionsTestCase.ACCOUNT_B, ConnectionsTestCase.ACCOUNT_A))
+        self.assertFalse(await connections.are_connected(
+            ConnectionsTestCase.OTHER_GAMESPACE_ID, ConnectionsTestCase.ACCOUNT_B, ConnectionsTestCase.ACCOUNT_A))
+
+        connected = await connections.are_connected_many(
+            ConnectionsTestCase.GAMESPACE_ID, ConnectionsTestCase.ACCOUNT_A,
+            [ConnectionsTestCase.ACCOUNT_B, ConnectionsTestCase.ACCOUNT_C])
+
+        self.assertEqual(connected, {ConnectionsTestCase.ACCOUNT_B: True, ConnectionsTestCase.ACCOUNT_C: False})
+        self.assertEqual(await connections.count_connections(
+            ConnectionsTestCase.GAMESPACE_ID, ConnectionsTestCase.ACCOUNT_A), 1)
+
+    @gen_test(timeout=60)
+    async def test_bulk_connections(self):
+        connections = self.application.connections
+        hub = 100
+
+        # duplicated, reversed and self connections are all fine
+        pairs = [[hub, account] for account in range(1000, 2200)]
+        pairs += [[account, hub] for account in range(1000, 1100)]
+        pairs += [[hub, hub]]
+
+        created = await connections.create_many(ConnectionsTestCase.GAMESPACE_ID, pairs)
+        self.assertEqual(created, 1200)
+
+        # again, nothing new
+        created = await connections.create_many(ConnectionsTestCase.GAMESPACE_ID, pairs)
+        self.assertEqual(created, 0)
+
+        self.assertEqual(await connections.count_connections(ConnectionsTestCase.GAMESPACE_ID, hub), 1200)
+        self.assertTrue(await connections.are_connected(ConnectionsTestCase.GAMESPACE_ID, 2199, hub))
+
+        deleted = await connections.delete_many(
+            ConnectionsTestCase.GAMESPACE_ID, [[account, hub] for account in range(1000, 1500)])
+        self.assertEqual(deleted, 500)
+
+        self.assertEqual(await connections.count_connections(ConnectionsTestCase.GAMESPACE_ID, hub), 700)
+        self.assertEqual(await connections.count_connections(ConnectionsTestCase.GAMESPACE_ID, 1000), 0)
+
+        # a pair with one direction only is still one connection, either way
+        async with self.application.db.acquire() as db:
+            await db.execute(
+                """
+                    INSERT INTO `account_connections` (`gamespace_id`, `account_id`, `account_connection`)
+                    VALUES (%s, %s, %s), (%s, %s, %s);
+                """, ConnectionsTestCase.GAMESPACE_ID, hub, 3000, ConnectionsTestCase.GAMESPACE_ID, 3001, hub)
+
+        created = await connections.create_many(
+            ConnectionsTestCase.GAMESPACE_ID, [[hub, 3000], [hub, 3001], [hub, 3002]])
+        self.assertEqual(created, 3)
+        self.assertTrue(await connections.are_connected(ConnectionsTestCase.GAMESPACE_ID, 3000, hub))
+
+        await connections.delete_many(ConnectionsTestCase.GAMESPACE_ID, [[hub, 3002]])
+
+        async with self.application.db.acquire() as db:
+            await db.execute(
+                """
+                    DELETE FROM `account_connections`
+                    WHERE `gamespace_id`=%s AND `account_id`=%s AND `account_connection`=%s;
+                """, ConnectionsTestCase.GAMESPACE_ID, 3001, hub)
+
+        deleted = await connections.delete_many(
+            ConnectionsTestCase.GAMESPACE_ID, [[hub, 3000], [hub, 3001], [hub, 3002]])
+        self.assertEqual(deleted, 2)
+
+        with self.assertRaises(ConnectionError) as e:
+            await connections.create_many(ConnectionsTestCase.GAMESPACE_ID, [[1, 2, 3]])
+
+        self.assertEqual(e.exception.code, 400)
+
+    @gen_test(timeout=60)
+    async def test_accounts_deleted(self):
+        connections = self.application.connections
+        deletions = self.application.deletions
+        hub = 200
+
+        await connections.create_many(
+            ConnectionsTestCase.GAMESPACE_ID, [[hub, account] for account in range(3000, 5500)])
+        await connections.create_many(ConnectionsTestCase.OTHER_GAMESPACE_ID, [[hub, 3000]])
+
+        deletion_id = await deletions.enqueue(ConnectionsTestCase.GAMESPACE_ID, [hub], True)
+
+        # the deletion is processed in the background
+        for i in range(0, 100):
+            deletion = await deletions.get_deletion(deletion_id)
+            if deletion.status != AccountDeletionsModel.STATUS_PENDING:
+                break
+            await sleep(0.1)
+
+        self.assertEqual(deletion.status, AccountDeletionsModel.STATUS_DONE)
+        self.assertEqual(await connections.count_connections(ConnectionsTestCase.GAMESPACE_ID, hub), 0)
+        self.assertEqual(await connections.count_connections(ConnectionsTestCase.GAMESPACE_ID, 5499), 0)
+        self.assertTrue(await connections.are_connected(ConnectionsTestCase.OTHER_GAMESPACE_ID, 3000, hub))
+
+    @gen_test
+    async def test_migrate_gamespace(self):
+        db = self.application.db
+        table = "account_connections_legacy"
+
+        await db.execute("DROP TABLE IF EXISTS `{0}`;".format(table))
+        # as the table used to be, before connections were scoped by gamespace
+        await db.execute(
+            """
+                CREATE TABLE `{0}` (
+                  `account_id` int(11) unsigned NOT NULL,
+                  `account_connection` int(11) unsigned NOT NULL,
+                  UNIQUE KEY `account_id` (`account_id`,`account_connection`),
+                  KEY `account_id_2` (`account_id`),
+                  KEY `account_connection` (`account_connection`)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+            """.format(table))
+
+        try:
+            await db.execute(
+                """
+                    INSERT INTO `{0}` (`account_id`, `account_connection`) VALUES (1, 2), (2, 1);
+                """.format(table))
+
+            # existing connections are not moved anywhere unless told where
+            with self.assertRaises(ConnectionError):
+                await migrate_gamespace(db, table, -1)
+
+            self.assertFalse(await db.query("SHOW COLUMNS FROM `{0}` LIKE 'gamespace_id';".format(table)))
+
+            await migrate_gamespace(db, table, ConnectionsTestCase.OTHER_GAMESPACE_ID)
+
+            rows = await db.query(
+                """
+                    SELECT `gamespace_id`, `account_id`, `account_connection`
+                    FROM `{0}`
+                    ORDER BY `account_id`;
+                """.format(table))
+
+            self.assertEqual([(row["gamespace_id"], row["account_id"], row["account_connection"]) for row in rows], [
+                (ConnectionsTestCase.OTHER_GAMESPACE_ID, 1, 2),
+                (ConnectionsTestCase.OTHER_GAMESPACE_ID, 2, 1)
+            ])
+
+            # done once
+            await migrate_gamespace(db, table, -1)
+        finally:
+            await db.execute("DROP TABLE IF EXISTS `{0}`;".format(table))
+
+    @gen_test
+    async def test_migrate_gamespace_failed(self):
+        db = self.application.db
+        table = "account_connections_broken"
+
+        await db.execute("DROP TABLE IF EXISTS `{0}`;".format(table))
+        # no gamespace_id, but not the layout the migration expects either (no indexes to drop)
+        await db.execute(
+            """
+                CREATE TABLE `{0}` (
+                  `account_id` int(11) unsigned NOT NULL,
+                  `account_connection` int(11) unsigned NOT NULL
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+            """.format(table))
+
+        try:
+            # the model cannot work with such a table, so it should not start
+            with self.assertRaises(ConnectionError) as e:
+                await migrate_gamespace(db, table, ConnectionsTestCase.OTHER_GAMESPACE_ID)
+
+            self.assertEqual(e.exception.code, 500)
+        finally:
+            await db.execute("DROP TABLE IF EXISTS `{0}`;".format(table))
@@ -1,12 +1,16 @@
 
-from tornado.gen import multi
+from tornado.gen import multi, sleep
 from tornado.testing import gen_test
 
 from .. server import SocialServer
-from .. model.group import GroupFlags, GroupJoinMethod, GroupError, GroupsModel
-from .. model.request import NoSuchRequest
+from .. handler import InternalHandler
+from .. model.group import GroupFlags, GroupJoinMethod, GroupError, GroupsModel, NoSuchGroup
+from .. model.request import NoSuchRequest, RequestType
+from .. model.permissions import GroupPermissions
 
 from anthill.common import testing
+from anthill.common.internal import InternalError
+from anthill.common.options import options
 from .. import options as _opts
 
 
@@ -23,7 +27,13 @@ class GroupsTestCase(testing.ServerTestCase):
 
     @classmethod
     def get_server_instance(cls, db=None):
-        return SocialServer(db)
+        rank_fields = options.group_rank_fields
+        options.group_rank_fields = "score, stats.level"
+
+        try:
+            return SocialServer(db)
+        finally:
+            options.group_rank_fields = rank_fields
 
     @gen_test
     async def test_group_create(self):
@@ -126,6 +136,193 @@ class GroupsTestCase(testing.ServerTestCase):
 
         self.assertEquals(updated_group_participation.profile, {"value": 90})
 
+    @gen_test
+    async def test_server_side_group_profile(self):
+        group_id = await self.application.groups.create_group(
+            GroupsTestCase.GAMESPACE_ID, {"a": {"b": 1, "c": 2}, "d": 3}, GroupFlags([]),
+            GroupJoinMethod(GroupJoinMethod.FREE), 50, GroupsTestCase.ACCOUNT_A, {"test": "a"})
+
+        result = await self.application.groups.update_group(
+            GroupsTestCase.GAMESPACE_ID, group_id, GroupsTestCase.ACCOUNT_A,
+            {"a": {"b": 5, "c": None}, "e": [1, 2]}, server_side=True)
+
+        self.assertEquals(result, {"a": {"b": 5}, "d": 3, "e": [1, 2]})
+
+        result = await self.application.groups.update_group_no_check(
+            GroupsTestCase.GAMESPACE_ID, group_id, {"x": 1, "d": None},
+            path=["f", "g"], merge=False, server_side=True)
+
+        self.assertEquals(result, {"x": 1})
+
+        # functions are still applied the regular way
+        await multi([self.application.groups.update_group(
+            GroupsTestCase.GAMESPACE_ID, group_id,
+            GroupsTestCase.ACCOUNT_A, {"d": {"@func": "++", "@value": 1}}, server_side=True
+        ) for x in range(0, 10)])
+
+        updated_group = await self.application.groups.get_group(GroupsTestCase.GAMESPACE_ID, group_id)
+        self.assertEquals(updated_group.profile, {"a": {"b": 5}, "d": 13, "e": [1, 2], "f": {"g": {"x": 1}}})
+
+        with self.assertRaises(GroupError) as e:
+            await self.application.groups.update_group_no_check(
+                GroupsTestCase.GAMESPACE_ID, 999999999, {"x": 1}, server_side=True)
+
+        self.assertEqual(e.exception.code, 404)
+
+    @gen_test
+    async def test_group_counters(self):
+        group_id = await self.application.groups.create_group(
+            GroupsTestCase.GAMESPACE_ID, {"score": 10}, GroupFlags([]),
+            GroupJoinMethod(GroupJoinMethod.FREE), 50, GroupsTestCase.ACCOUNT_A, {"kills": 1})
+
+        await multi([self.application.groups.update_group_counters_no_check(
+            GroupsTestCase.GAMESPACE_ID, group_id, [
+                {"path": ["score"], "op": "increment", "value": 2},
+                {"path": ["stats", "best"], "op": "max", "value": x}
+            ]
+        ) for x in range(0, 10)])
+
+        updated_group = await self.application.groups.get_group(GroupsTestCase.GAMESPACE_ID, group_id)
+        self.assertEquals(updated_group.profile, {"score": 30, "stats": {"best": 9}})
+
+        result = await self.application.groups.update_group_participation_counters(
+            GroupsTestCase.GAMESPACE_ID, group_id, GroupsTestCase.ACCOUNT_A, GroupsTestCase.ACCOUNT_A, [
+                {"path": ["kills"], "op": "decrement", "value": 3},
+                {"path": ["fastest"], "op": "min", "value": 1.5}
+            ])
+
+        self.assertEquals(result, {"kills": -2, "fastest": 1.5})
+
+        # an integer added to a float field does not truncate it
+        result = await self.application.groups.update_group_participation_counters(
+            GroupsTestCase.GAMESPACE_ID, group_id, GroupsTestCase.ACCOUNT_A, GroupsTestCase.ACCOUNT_A, [
+                {"path": ["kills"], "op": "increment", "value": 1},
+                {"path": ["fastest"], "op": "increment", "value": 1}
+            ])
+
+        self.assertEquals(result, {"kills": -1, "fastest": 2.5})
+        self.assertIsInstance(result["kills"], int)
+
+        with self.assertRaises(GroupError) as e:
+            await self.application.groups.update_group_counters_no_check(
+                GroupsTestCase.GAMESPACE_ID, group_id, [
+                    {"path": ["score"], "op": "increment", "value": 1},
+                    {"path": ["score", "a"], "op": "increment", "value": 1}
+                ])
+
+        self.assertEqual(e.exception.code, 409)
+
+    @gen_test
+    async def test_batch_group_profiles(self):
+        group_ids = [
+            str(await self.application.groups.create_group(
+                GroupsTestCase.GAMESPACE_ID, {"value": 0}, GroupFlags([]),
+                GroupJoinMethod(GroupJoinMethod.FREE), 50, GroupsTestCase.ACCOUNT_A, {}))
+            for x in range(0, 5)
+        ]
+
+        # overlapping batches in different order should not deadlock each other
+        results = await multi([self.application.groups.update_groups(
+            GroupsTestCase.GAMESPACE_ID, {
+                group_id: {"value": {"@func": "++", "@value": 1}}
+                for group_id in (group_ids if x % 2 else list(reversed(group_ids)))
+            }) for x in range(0, 10)])
+
+        for updated, failed in results:
+            self.assertEquals(failed, {})
+
+        groups = await self.application.groups.list_groups(GroupsTestCase.GAMESPACE_ID, group_ids)
+        for group in groups:
+            self.assertEquals(group.profile, {"value": 10})
+
+        updated, failed = await self.application.groups.update_groups(
+            GroupsTestCase.GAMESPACE_ID, {
+                group_ids[0]: {"value": 20},
+                "999999999": {"value": 20}
+            })
+
+        self.assertEquals(updated, {group_ids[0]: {"value": 20}})
+        self.assertEquals(failed["999999999"]["code"], 404)
+
+        # the internal call fails as a whole, unless asked to report the failures
+        internal_handler = InternalHandler(self.application)
+
+        for synced in (False, True):
+            with self.assertRaises(InternalError) as e:
+                await internal_handler.update_group_profiles(
+                    GroupsTestCase.GAMESPACE_ID, {group_ids[0]: {"value": 30}, "999999999": {"value": 30}},
+                    synced=synced)
+
+            self.assertEqual(e.exception.code, 404)
+
+            # and writes nothing
+            group = await self.application.groups.get_group(GroupsTestCase.GAMESPACE_ID, group_ids[0])
+            self.assertEquals(group.profile, {"value": 20})
+
+        # same for a group that exists, but cannot be updated
+        with self.assertRaises(InternalError) as e:
+            await internal_handler.update_group_profiles(
+                GroupsTestCase.GAMESPACE_ID, {
+                    group_ids[0]: {"value": 30},
+                    group_ids[1]: {"value": {"@func": "bad"}}
+                }, synced=True)
+
+        self.assertEqual(e.exception.code, 409)
+
+        group = await self.application.groups.get_group(GroupsTestCase.GAMESPACE_ID, group_ids[0])
+        self.assertEquals(group.profile, {"value": 20})
+
+        result = await internal_handler.update_group_profiles(
+            GroupsTestCase.GAMESPACE_ID, {group_ids[0]: {"value": 40}, "999999999": {"value": 40}},
+            report_failures=True)
+
+        self.assertEquals(result["groups"], {group_ids[0]: {"value": 40}})
+        self.assertEquals(list(result["failed"].keys()), ["999999999"])
+
+    @gen_test
+    async def test_coalesced_group_profiles(self):
+        group_id = str(await self.application.groups.create_group(
+            GroupsTestCase.GAMESPACE_ID, {"value": 0}, GroupFlags([]),
+            GroupJoinMethod(GroupJoinMethod.FREE), 50, GroupsTestCase.ACCOUNT_A, {}))
+
+        results = await multi([self.application.groups.update_groups_coalesced(
+            GroupsTestCase.GAMESPACE_ID, {
+                group_id: {"value": {"@func": "++", "@value": 1}},
+                "999999999": {"value": 1}
+            }) for x in range(0, 10)])
+
+        values = []
+
+        for updated, failed in results:
+            self.assertEquals(failed["999999999"]["code"], 404)
+            values.append(updated[group_id]["value"])
+
+        # every update should see its own result, even if they are written at once
+        self.assertEquals(sorted(values), list(range(1, 11)))
+
+        updated_group = await self.application.groups.get_group(GroupsTestCase.GAMESPACE_ID, group_id)
+        self.assertEquals(updated_group.profile, {"value": 10})
+
+        # a bad update fails only the call it came with, and a failed one leaves nothing behind
+        (bad, bad_failed), (failing, failing_failed), (good, good_failed) = await multi([
+            self.application.groups.update_groups_coalesced(
+                GroupsTestCase.GAMESPACE_ID, {"abc": {"value": 1}, group_id: [1]}),
+            self.application.groups.update_groups_coalesced(
+                GroupsTestCase.GAMESPACE_ID, {group_id: {"stats": {"a": 1, "b": {"@func": "++", "@value": "x"}}}}),
+            self.application.groups.update_groups_coalesced(
+                GroupsTestCase.GAMESPACE_ID, {group_id: {"value": {"@func": "++", "@value": 1}}})
+        ])
+
+        self.assertEquals(bad, {})
+        self.assertEquals(bad_failed["abc"]["code"], 400)
+        self.assertEquals(bad_failed[group_id]["code"], 400)
+        self.assertEquals(failing_failed[group_id]["code"], 409)
+        self.assertEquals(good_failed, {})
+        self.assertEquals(good[group_id], {"value": 11})
+
+        updated_group = await self.application.groups.get_group(GroupsTestCase.GAMESPACE_ID, group_id)
+        self.assertEquals(updated_group.profile, {"value": 11})
+
     @gen_test
     async def test_roles(self):
         group_id = await self.application.groups.create_group(
@@ -249,6 +446,79 @@ class GroupsTestCase(testing.ServerTestCase):
         self.assertEqual(updated_group_participation.permissions, {"cat"},
                          "Permissions of account D should be cat")
 
+        # custom permissions are registered in the gamespace and stored as bits too
+        self.assertEqual(updated_group_participation.permission_bits, await self.application.groups.permissions.mask(
+            GroupsTestCase.GAMESPACE_ID, ["cat"]))
+        self.assertGreaterEqual(updated_group_participation.permission_bits, 1 << len(GroupPermissions.BUILTIN))
+
+        # and checked by these bits once registered
+        bits = await self.application.groups.permissions.get_bits(GroupsTestCase.GAMESPACE_ID)
+        self.assertTrue(updated_group_participation.has_permission("cat", bits))
+        self.assertFalse(updated_group_participation.has_permission("cow", bits))
+
+        updated_group_participation.permission_bits = 0
+        self.assertFalse(updated_group_participation.has_permission("cat", bits))
+
+    @gen_test
+    async def test_permission_bits_backfill(self):
+        groups = self.application.groups
+        group_id = await groups.create_group(
+            GroupsTestCase.GAMESPACE_ID, {}, GroupFlags([]),
+            GroupJoinMethod(GroupJoinMethod.FREE), 50, GroupsTestCase.ACCOUNT_A, {})
+
+        await groups.join_group(GroupsTestCase.GAMESPACE_ID, group_id, GroupsTestCase.ACCOUNT_B, {})
+
+        # a participation made before the bits, with a custom permission nobody has been granted yet
+        await self.application.db.execute(
+            """
+                UPDATE `group_participants`
+                SET `participation_permissions`=%s, `participation_permission_bits`=NULL
+                WHERE `gamespace_id`=%s AND `group_id`=%s AND `account_id`=%s;
+            """, "kick,backfilled", GroupsTestCase.GAMESPACE_ID, group_id, GroupsTestCase.ACCOUNT_B)
+
+        await groups.__backfill_permission_bits__()
+
+        participation = await groups.get_group_participation(
+            GroupsTestCase.GAMESPACE_ID, group_id, GroupsTestCase.ACCOUNT_B)
+
+        self.assertEqual(participation.permission_bits, await groups.permissions.mask(
+            GroupsTestCase.GAMESPACE_ID, ["kick", "backfilled"]))
+
+        bits = await groups.permissions.get_bits(GroupsTestCase.GAMESPACE_ID)
+        self.assertIn("backfilled", bits)
+        self.assertTrue(participation.has_permission("backfilled", bits))
+        self.assertTrue(participation.has_permission(GroupsModel.PERMISSION_KICK))
+        self.assertFalse(participation.has_permission(GroupsModel.PERMISSION_SEND_INVITE))
+
+    @gen_test
+    async def test_group_authorization(self):
+        groups = self.application.groups
+        group_id = await groups.create_group(
+            GroupsTestCase.GAMESPACE_ID, {}, GroupFlags([]),
+            GroupJoinMethod(GroupJoinMethod.FREE), 50, GroupsTestCase.ACCOUNT_A, {})
+
+        await groups.join_group(GroupsTestCase.GAMESPACE_ID, group_id, GroupsTestCase.ACCOUNT_B, {})
+        await groups.update_group_participation_permissions(
+            GroupsTestCase.GAMESPACE_ID, group_id, GroupsTestCase.ACCOUNT_A, GroupsTestCase.ACCOUNT_B,
+            100, [GroupsModel.PERMISSION_KICK])
+
+        authorization = await groups.get_group_authorization(
+            GroupsTestCase.GAMESPACE_ID, group_id, GroupsTestCase.ACCOUNT_B, GroupsTestCase.ACCOUNT_A)
+
+        self.assertTrue(authorization.group.is_owner(GroupsTestCase.ACCOUNT_A))
+        self.assertEqual(authorization.group.join_method, GroupJoinMethod.FREE)
+        self.assertEqual(authorization.actor.role, 100)
+        self.assertTrue(authorization.actor.has_permission(GroupsModel.PERMISSION_KICK))
+        self.assertFalse(authorization.actor.has_permission(GroupsModel.PERMISSION_SEND_INVITE))
+        self.assertEqual(authorization.target.role, GroupsModel.MAXIMUM_ROLE)
+        self.assertFalse(authorization.actor_role_higher())
+
+        authorization = await groups.get_group_authorization(
+            GroupsTestCase.GAMESPACE_ID, group_id, GroupsTestCase.ACCOUNT_C)
+
+        self.assertIsNone(authorization.actor)
+        self.assertIsNone(authorization.target)
+
     @gen_test
     async def test_kick(self):
         group_id = await self.application.groups.create_group(
@@ -468,3 +738,182 @@ class GroupsTestCase(testing.ServerTestCase):
 
         result_3 = await self.application.groups.search_groups(GroupsTestCase.GAMESPACE_ID, "including same text")
         self.assertEquals(len(result_3), 2)
+
+    @gen_test
+    async def test_top_groups(self):
+        group_ids = [
+            await self.application.groups.create_group(
+                GroupsTestCase.GAMESPACE_ID, {"score": score}, GroupFlags([]),
+                GroupJoinMethod(GroupJoinMethod.FREE), 50, GroupsTestCase.ACCOUNT_A, {})
+            for score in [1000001, 1000003, 1000002, 1000003]
+        ]
+
+        top = await self.application.groups.list_top_groups(GroupsTestCase.GAMESPACE_ID, "score", limit=3)
+        self.assertEquals([group.group_id for group in top], [group_ids[3], group_ids[1], group_ids[2]])
+
+        # the index follows profile updates
+        await self.application.groups.update_group_counters_no_check(
+            GroupsTestCase.GAMESPACE_ID, group_ids[0], [{"path": ["score"], "op": "increment", "value": 10}])
+
+        top = await self.application.groups.list_top_groups(GroupsTestCase.GAMESPACE_ID, "score", limit=2)
+        self.assertEquals([group.group_id for group in top], [group_ids[0], group_ids[3]])
+        self.assertEquals(top[0].score, 1000011)
+
+        next_page = await self.application.groups.list_top_groups(
+            GroupsTestCase.GAMESPACE_ID, "score", limit=2, cursor=top[-1].cursor())
+        self.assertEquals([group.group_id for group in next_page], [group_ids[1], group_ids[2]])
+
+        with self.assertRaises(GroupError) as e:
+            await self.application.groups.list_top_groups(GroupsTestCase.GAMESPACE_ID, "level")
+
+        self.assertEqual(e.exception.code, 404)
+
+        # nested fields are ranked by their own column
+        level_group_id = await self.application.groups.create_group(
+            GroupsTestCase.GAMESPACE_ID, {"stats": {"level": 7}, "stats_level": 100}, GroupFlags([]),
+            GroupJoinMethod(GroupJoinMethod.FREE), 50, GroupsTestCase.ACCOUNT_A, {})
+
+        top = await self.application.groups.list_top_groups(GroupsTestCase.GAMESPACE_ID, "stats.level", limit=1)
+        self.assertEquals([(group.group_id, group.score) for group in top], [(level_group_id, 7)])
+
+    @gen_test
+    async def test_rank_columns(self):
+        self.assertNotEqual(GroupsModel.rank_column("a.b"), GroupsModel.rank_column("a_b"))
+        self.assertLessEqual(len(GroupsModel.rank_column("a" * 200)), 64)
+
+        groups = GroupsModel(self.application.db, self.application.requests, rank_fields=["a.b", "a_b"])
+        self.assertEqual(len(set(groups.rank_columns.values())), 2)
+
+        # fields that end up in the same column are refused
+        groups.rank_columns["a_b"] = groups.rank_columns["a.b"]
+
+        with self.assertRaises(GroupError) as e:
+            await groups.__setup_rank_columns__()
+
+        self.assertEqual(e.exception.code, 500)
+
+    @gen_test
+    async def test_search_filters(self):
+        await self.application.groups.create_group(
+            GroupsTestCase.GAMESPACE_ID, {}, GroupFlags([]),
+            GroupJoinMethod(GroupJoinMethod.FREE), 2, GroupsTestCase.ACCOUNT_A, {},
+            group_name="Zebra crossing guild")
+
+        full_group = await self.application.groups.create_group(
+            GroupsTestCase.GAMESPACE_ID, {}, GroupFlags([]),
+            GroupJoinMethod(GroupJoinMethod.FREE), 2, GroupsTestCase.ACCOUNT_A, {},
+            group_name="Zebra crossing team")
+
+        await self.application.groups.join_group(GroupsTestCase.GAMESPACE_ID, full_group,
+                                                 GroupsTestCase.ACCOUNT_B, {})
+
+        await self.application.groups.create_group(
+            GroupsTestCase.GAMESPACE_ID, {}, GroupFlags([]),
+            GroupJoinMethod(GroupJoinMethod.INVITE), 50, GroupsTestCase.ACCOUNT_A, {},
+            group_name="Zebra crossing clan")
+
+        result = await self.application.groups.search_groups(GroupsTestCase.GAMESPACE_ID, "zebra crossing")
+        self.assertEquals(len(result), 3)
+
+        result = await self.application.groups.search_groups(
+            GroupsTestCase.GAMESPACE_ID, "zebra crossing", limit=2)
+        self.assertEquals(len(result), 2)
+
+        next_page = await self.application.groups.search_groups(
+            GroupsTestCase.GAMESPACE_ID, "zebra crossing", limit=2, offset=2)
+        self.assertEquals(len(next_page), 1)
+        self.assertNotIn(next_page[0].group_id, [group.group_id for group in result])
+
+        result = await self.application.groups.search_groups(
+            GroupsTestCase.GAMESPACE_ID, "zebra crossing", has_free_members=True,
+            join_method=GroupJoinMethod(GroupJoinMethod.FREE), with_profile=False)
+        self.assertEquals([group.name for group in result], ["Zebra crossing guild"])
+
+        result = await self.application.groups.search_groups(
+            GroupsTestCase.GAMESPACE_ID, "", name_prefix="Zebra crossing t")
+        self.assertEquals([group.group_id for group in result], [full_group])
+
+    @gen_test
+    async def test_name_index_of_another_instance(self):
+        groups = self.application.groups
+        gamespace_id = 7
+
+        # another instance of the service, with an index of its own
+        other = GroupsModel(self.application.db, self.application.requests, name_index=True)
+        other.name_index.ready = True
+
+        group_id = await groups.create_group(
+            gamespace_id, {}, GroupFlags([]),
+            GroupJoinMethod(GroupJoinMethod.FREE), 50, GroupsTestCase.ACCOUNT_A, {},
+            group_name="Moonshadow riders")
+
+        # created elsewhere, so not in the index, but found anyway
+        result = await other.search_groups(gamespace_id, "moonsh")
+        self.assertEqual([group.group_id for group in result], [group_id])
+
+        result = await other.search_groups(gamespace_id, "", name_prefix="Moon", has_free_members=True)
+        self.assertEqual([group.group_id for group in result], [group_id])
+
+        # renamed elsewhere, the old name is not found anymore
+        await groups.update_group_summary(gamespace_id, group_id, GroupsTestCase.ACCOUNT_A, name="Sunfire riders")
+
+        self.assertEqual(await other.search_groups(gamespace_id, "moonsh"), [])
+
+        result = await other.search_groups(gamespace_id, "sunfire")
+        self.assertEqual([group.name for group in result], ["Sunfire riders"])
+
+        # disbanded elsewhere
+        await groups.disband_group(gamespace_id, group_id, GroupsTestCase.ACCOUNT_A)
+
+        self.assertEqual(await other.search_groups(gamespace_id, "riders"), [])
+        self.assertEqual(other.name_index.size(gamespace_id), 0)
+
+    @gen_test(timeout=60)
+    async def test_disband(self):
+        groups = self.application.groups
+        group_id = await groups.create_group(
+            GroupsTestCase.GAMESPACE_ID, {}, GroupFlags([]),
+            GroupJoinMethod(GroupJoinMethod.FREE), 1000, GroupsTestCase.ACCOUNT_A, {},
+            group_name="Disbanded band")
+
+        await multi([
+            groups.join_group(GroupsTestCase.GAMESPACE_ID, group_id, account, {})
+            for account in range(1000, 1600)
+        ])
+
+        await multi([
+            self.application.requests.create_request(
+                GroupsTestCase.GAMESPACE_ID, account, RequestType.GROUP, group_id, {})
+            for account in range(2000, 2100)
+        ])
+
+        with self.assertRaises(GroupError) as e:
+            await groups.disband_group(GroupsTestCase.GAMESPACE_ID, group_id, 1000)
+        self.assertEqual(e.exception.code, 409)
+
+        await groups.disband_group(GroupsTestCase.GAMESPACE_ID, group_id, GroupsTestCase.ACCOUNT_A)
+
+        # gone right away
+        with self.assertRaises(NoSuchGroup):
+            await groups.get_group(GroupsTestCase.GAMESPACE_ID, group_id)
+        with self.assertRaises(NoSuchGroup):
+            await groups.leave_group(GroupsTestCase.GAMESPACE_ID, group_id, 1000)
+
+        self.assertEqual(await groups.search_groups(GroupsTestCase.GAMESPACE_ID, "Disbanded band"), [])
+
+        # the rest is deleted in the background, the group row goes last
+        for i in range(0, 100):
+            row = await self.application.db.get(
+                """
+                    SELECT `group_id` FROM `groups`
+                    WHERE `gamespace_id`=%s AND `group_id`=%s;
+                """, GroupsTestCase.GAMESPACE_ID, group_id)
+            if row is None:
+                break
+            await sleep(0.1)
+
+        self.assertIsNone(row)
+
+        self.assertEqual(await groups.list_group_participants(GroupsTestCase.GAMESPACE_ID, group_id), [])
+        self.assertEqual(await self.application.requests.delete_object_requests_chunk(
+            GroupsTestCase.GAMESPACE_ID, RequestType.GROUP, group_id, 1), 0)
@@ -0,0 +1,85 @@
+from tornado.testing import gen_test
+
+from .. server import SocialServer
+from .. model.group import GroupFlags, GroupJoinMethod
+from .. tracing import Tracer, current_span
+
+from anthill.common import testing
+from .. import options as _opts
+
+
+class MetricsTestCase(testing.ServerTestCase):
+    GAMESPACE_ID = 1
+    ACCOUNT_A = 1
+
+    @classmethod
+    def need_test_db(cls):
+        return True
+
+    @classmethod
+    def get_server_instance(cls, db=None):
+        return SocialServer(db)
+
+    @gen_test
+    async def test_model_metrics(self):
+        metrics = self.application.metrics
+
+        group_id = await self.application.groups.create_group(
+            MetricsTestCase.GAMESPACE_ID, {}, GroupFlags([]),
+            GroupJoinMethod(GroupJoinMethod.FREE), 50, MetricsTestCase.ACCOUNT_A, {})
+
+        await self.application.groups.get_group(MetricsTestCase.GAMESPACE_ID, group_id)
+
+        operations = {
+            dict(labels)["operation"]: histogram
+            for labels, histogram in metrics.histograms["model_method_duration_seconds"].items()
+        }
+
+        self.assertEqual(operations["GroupsModel.get_group"].count, 1)
+
+        # statements are labeled with the model method they were made by
+        statements = [
+            dict(labels) for labels in metrics.histograms["db_statement_duration_seconds"]
+        ]
+
+        self.assertIn({"operation": "GroupsModel.get_group", "statement": "get"}, statements)
+        self.assertIn({"operation": "GroupsModel.create_group", "statement": "insert"}, statements)
+
+        rendered = metrics.render()
+        self.assertIn('anthill_social_db_statement_duration_seconds_count'
+                      '{operation="GroupsModel.get_group",statement="get"} 1', rendered)
+
+    @gen_test
+    async def test_tracing(self):
+        metrics = self.application.metrics
+        tracer = metrics.tracer = Tracer(threshold=0)
+
+        try:
+            token = tracer.start("test")
+
+            group_id = await self.application.groups.create_group(
+                MetricsTestCase.GAMESPACE_ID, {}, GroupFlags([]),
+                GroupJoinMethod(GroupJoinMethod.FREE), 50, MetricsTestCase.ACCOUNT_A, {})
+
+            await self.application.groups.get_group(MetricsTestCase.GAMESPACE_ID, group_id)
+
+            tracer.finish()
+            current_span.reset(token)
+        finally:
+            metrics.tracer = self.application.tracer
+
+        trace, = tracer.recent()
+        create_group, get_group = trace["root"]["children"]
+
+        self.assertEqual(create_group["name"], "GroupsModel.create_group")
+        self.assertEqual(get_group["name"], "GroupsModel.get_group")
+
+        # statements are children of the model method that made them, with the query
+        statement = get_group["children"][0]
+        self.assertEqual(statement["name"], "db.get")
+        self.assertIn("FROM `groups`", statement["tags"]["query"])
+        self.assertGreaterEqual(get_group["duration"], statement["duration"])
+
+        # nothing is traced outside of a trace
+        await self.application.groups.get_group(MetricsTestCase.GAMESPACE_ID, group_id)
+        self.assertEqual(len(tracer.recent()), 1)
@@ -0,0 +1,97 @@
+from unittest import TestCase
+
+from .. model.nameindex import NameIndex
+
+
+class NameIndexTestCase(TestCase):
+    def test_add_remove_rename(self):
+        index = NameIndex()
+        index.add(1, 10, "Red Dragons")
+        index.add(1, 11, "Blue Dragons")
+
+        self.assertEqual(sorted(index.search(1, "dragons", 10)), [10, 11])
+
+        # adding an object again renames it
+        index.add(1, 10, "Green Giants")
+
+        self.assertEqual(index.search(1, "dragons", 10), [11])
+        self.assertEqual(index.search(1, "giant", 10), [10])
+        self.assertEqual(index.search(1, "re", 10), [])
+
+        self.assertTrue(index.remove(1, 11))
+        self.assertFalse(index.remove(1, 11))
+        self.assertEqual(index.search(1, "dragons", 10), [])
+
+        # an empty name removes the object too
+        index.add(1, 10, "")
+        self.assertEqual(index.search(1, "giants", 10), [])
+        self.assertEqual(index.size(1), 0)
+
+    def test_prefix_and_substring(self):
+        index = NameIndex()
+        index.add(1, 1, "The Knights")
+        index.add(1, 2, "Nightwatch")
+
+        # words shorter than three characters match name words by prefix only
+        self.assertEqual(index.search(1, "kn", 10), [1])
+        self.assertEqual(index.search(1, "ni", 10), [2])
+
+        # longer ones match anywhere inside a name, names that start with the query go first, then shorter ones
+        self.assertEqual(index.search(1, "nig", 10), [2, 1])
+        self.assertEqual(index.search(1, "ght", 10), [2, 1])
+
+        # every word has to match, regardless of case
+        self.assertEqual(index.search(1, "th kni", 10), [1])
+        self.assertEqual(index.search(1, "KNIGHTS", 10), [1])
+        self.assertEqual(index.search(1, "knights watch", 10), [])
+        self.assertEqual(index.search(1, "   ", 10), [])
+
+    def test_limit_offset(self):
+        index = NameIndex()
+
+        for i in range(0, 10):
+            index.add(1, i, "Team {0:02d}".format(i))
+
+        self.assertEqual(index.search(1, "team", 3), [0, 1, 2])
+        self.assertEqual(index.search(1, "team", 3, offset=3), [3, 4, 5])
+        self.assertEqual(index.search(1, "team", 3, offset=9), [9])
+        self.assertEqual(index.search(1, "team", 3, offset=10), [])
+
+    def test_buckets(self):
+        index = NameIndex()
+        index.add((1, "nickname"), 1, "Alice")
+        index.add((2, "nickname"), 1, "Alicia")
+
+        self.assertEqual(index.search((1, "nickname"), "alic", 10), [1])
+        self.assertEqual(index.search((2, "nickname"), "alici", 10), [1])
+        self.assertEqual(index.search((1, "nickname"), "alici", 10), [])
+        self.assertEqual(index.search((3, "nickname"), "alic", 10), [])
+
+        index.remove((1, "nickname"), 1)
+
+        self.assertEqual(index.search((1, "nickname"), "alic", 10), [])
+        self.assertEqual(index.search((2, "nickname"), "alic", 10), [1])
+        self.assertEqual(index.size(), 1)
+
+    def test_deferred(self):
+        index = NameIndex()
+        index.add(1, 1, "Zebra Crossing", defer=True)
+        index.add(1, 3, "Crossroads", defer=True)
+        index.add(1, 2, "Zebra", defer=True)
+        index.sort()
+
+        self.assertEqual(index.search(1, "ze", 10), [2, 1])
+        self.assertEqual(index.search(1, "cr", 10), [3, 1])
+
+        index.remove(1, 1)
+        self.assertEqual(index.search(1, "cr", 10), [3])
+
+        index.add(1, 4, "Crab")
+        self.assertEqual(index.search(1, "cr", 10), [4, 3])
+
+    def test_matches(self):
+        self.assertTrue(NameIndex.matches("The Knights", "kni th"))
+        self.assertTrue(NameIndex.matches("The Knights", "IGHT"))
+        self.assertFalse(NameIndex.matches("The Knights", "ni"))
+        self.assertFalse(NameIndex.matches("The Knights", "knights watch"))
+        self.assertFalse(NameIndex.matches("The Knights", ""))
@@ -0,0 +1,88 @@
+from tornado.gen import multi
+from tornado.testing import gen_test
+
+from .. server import SocialServer
+from .. model.names import NamesModel
+
+from anthill.common import testing
+from .. import options as _opts
+
+
+class NamesTestCase(testing.ServerTestCase):
+    GAMESPACE_ID = 1
+    ACCOUNT_A = 1
+    KIND = "nickname"
+
+    @classmethod
+    def need_test_db(cls):
+        return True
+
+    @classmethod
+    def get_server_instance(cls, db=None):
+        return SocialServer(db)
+
+    @gen_test
+    async def test_index_of_another_instance(self):
+        names = self.application.names
+
+        # another instance of the service, with an index of its own
+        other = NamesModel(self.application.db, self.application.cache, name_index=True)
+        other.name_index.ready = True
+
+        await names.acquire_name(NamesTestCase.GAMESPACE_ID, NamesTestCase.ACCOUNT_A, NamesTestCase.KIND,
+                                 "Stormbringer")
+
+        # acquired elsewhere, so not in the index, but found anyway
+        result = await other.search_names(NamesTestCase.GAMESPACE_ID, NamesTestCase.KIND, "stormbr")
+        self.assertEqual([name.account_id for name in result], [NamesTestCase.ACCOUNT_A])
+
+        # renamed elsewhere, the old name is not found anymore
+        await names.acquire_name(NamesTestCase.GAMESPACE_ID, NamesTestCase.ACCOUNT_A, NamesTestCase.KIND,
+                                 "Peacekeeper")
+
+        result = await other.search_names(NamesTestCase.GAMESPACE_ID, NamesTestCase.KIND, "stormbr")
+        self.assertEqual(result, [])
+
+        result = await other.search_names(NamesTestCase.GAMESPACE_ID, NamesTestCase.KIND, "peacek")
+        self.assertEqual([name.name for name in result], ["Peacekeeper"])
+
+        # released elsewhere
+        await names.release_name(NamesTestCase.GAMESPACE_ID, NamesTestCase.ACCOUNT_A, NamesTestCase.KIND)
+
+        result = await other.search_names(NamesTestCase.GAMESPACE_ID, NamesTestCase.KIND, "peacek")
+        self.assertEqual(result, [])
+        self.assertEqual(other.name_index.size(), 0)
+
+    @gen_test
+    async def test_bloom_filter(self):
+        gamespace_id, kind = 2, "bloom"
+        names = NamesModel(self.application.db, self.application.cache, bloom_filter_bits=1024)
+        bloom_filter = names.bloom_filter
+
+        async with self.application.cache.acquire() as db:
+            await db.delete(bloom_filter.key(gamespace_id, kind))
+
+        await names.acquire_name(gamespace_id, NamesTestCase.ACCOUNT_A, kind, "Taken Name")
+
+        # nothing is known before the bitmap is built
+        self.assertEqual(await bloom_filter.are_free(gamespace_id, kind, ["Free Name"]), [False])
+        await bloom_filter.building[(gamespace_id, kind)]
+
+        self.assertEqual(
+            await bloom_filter.are_free(gamespace_id, kind, ["Taken Name", "taken name ", "Free Name"]),
+            [False, False, True])
+
+        # a lost bitmap does not make taken names free
+        async with self.application.cache.acquire() as db:
+            await db.delete(bloom_filter.key(gamespace_id, kind))
+
+        self.assertEqual(await names.check_name(gamespace_id, kind, "Taken Name"), NamesTestCase.ACCOUNT_A)
+        # the bitmap is being rebuilt meanwhile
+        await multi(list(bloom_filter.building.values()))
+
+        self.assertEqual(await bloom_filter.are_free(gamespace_id, kind, ["Free Name"]), [True])
+
+        # neither does a bitmap of another size
+        resized = NamesModel(self.application.db, self.application.cache, bloom_filter_bits=2048).bloom_filter
+        self.assertEqual(await resized.are_free(gamespace_id, kind, ["Free Name"]), [False])
+        await resized.building[(gamespace_id, kind)]
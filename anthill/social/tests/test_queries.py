@@ -0,0 +1,104 @@
+from tornado.testing import gen_test
+
+from .. server import SocialServer
+from .. model.group import GroupFlags, GroupJoinMethod
+from . queries import QueryRecorder
+
+from anthill.common import testing
+from .. import options as _opts
+
+
+class QueriesTestCase(testing.ServerTestCase):
+    """
+    Upper bounds of database round trips of the hot paths, a method that starts to make more statements than
+        before (say, a query per participant) fails here. The counts of all the methods are printed at the end.
+    """
+
+    GAMESPACE_ID = 1
+
+    recorder = QueryRecorder()
+
+    @classmethod
+    def need_test_db(cls):
+        return True
+
+    @classmethod
+    def get_server_instance(cls, db=None):
+        application = SocialServer(QueriesTestCase.recorder.wrap(db))
+        QueriesTestCase.recorder.instrument(application.groups, application.requests, application.connections)
+        return application
+
+    @classmethod
+    def tearDownClass(cls):
+        print("\n" + cls.recorder.report(cls.application.groups, cls.application.requests, cls.application.connections))
+        super(QueriesTestCase, cls).tearDownClass()
+
+    @gen_test
+    async def test_groups(self):
+        groups = self.application.groups
+        expect = QueriesTestCase.recorder.expect
+        owner, member = 101, 102
+
+        with expect(queries=2):
+            group_id = await groups.create_group(
+                QueriesTestCase.GAMESPACE_ID, {}, GroupFlags([]),
+                GroupJoinMethod(GroupJoinMethod.FREE), 50, owner, {})
+
+        with expect(queries=1):
+            await groups.get_group(QueriesTestCase.GAMESPACE_ID, group_id)
+
+        # the group, the participation and the members counter, in one transaction
+        with expect(queries=4, commits=1):
+            await groups.join_group(QueriesTestCase.GAMESPACE_ID, group_id, member, {})
+
+        # no matter how many participants there are
+        with expect(queries=2):
+            await groups.get_group_with_participants(QueriesTestCase.GAMESPACE_ID, group_id)
+
+        with expect(queries=3, commits=1):
+            await groups.leave_group(QueriesTestCase.GAMESPACE_ID, group_id, member)
+
+    @gen_test
+    async def test_group_requests(self):
+        groups = self.application.groups
+        expect = QueriesTestCase.recorder.expect
+        owner, member = 201, 202
+
+        group_id = await groups.create_group(
+            QueriesTestCase.GAMESPACE_ID, {}, GroupFlags([]),
+            GroupJoinMethod(GroupJoinMethod.APPROVE), 50, owner, {})
+
+        with expect(queries=4):
+            key = await groups.join_group_request(QueriesTestCase.GAMESPACE_ID, group_id, member, {})
+
+        # the authorization, the request, and the join itself
+        with expect(queries=6, commits=2):
+            await groups.approve_join_group(QueriesTestCase.GAMESPACE_ID, group_id, owner, member, 0, key, [])
+
+    @gen_test
+    async def test_connections(self):
+        connections = self.application.connections
+        requests = self.application.requests
+        expect = QueriesTestCase.recorder.expect
+        account_a, account_b = 301, 302
+
+        with expect(queries=2):
+            result = await connections.request_connection(QueriesTestCase.GAMESPACE_ID, account_a, account_b)
+
+        with expect(queries=1):
+            await requests.list_incoming_account_requests(QueriesTestCase.GAMESPACE_ID, account_b)
+
+        with expect(queries=3, commits=1):
+            await connections.approve_connection(
+                QueriesTestCase.GAMESPACE_ID, account_b, account_a, result["key"])
+
+        with expect(queries=1):
+            await connections.list_connections(QueriesTestCase.GAMESPACE_ID, account_a)
+
+        with expect(queries=1):
+            await connections.delete(QueriesTestCase.GAMESPACE_ID, account_a, account_b)
+
+        # everything made by the model methods called is counted towards the outermost one
+        calls = QueriesTestCase.recorder.operations["ConnectionsModel.approve_connection"]
+        self.assertEqual(calls[-1].queries, 3)
+        self.assertNotIn("RequestsModel.acquire", QueriesTestCase.recorder.operations)
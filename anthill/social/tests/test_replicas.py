@@ -0,0 +1,95 @@
+from tornado.testing import gen_test
+
+from anthill.common.options import options
+
+from .. server import SocialServer
+from .. model.group import GroupFlags, GroupJoinMethod
+from .. replicas import begin, session
+from . queries import QueryRecorder
+
+from anthill.common import testing
+from .. import options as _opts
+
+
+class ReplicaServer(SocialServer):
+    # the test database is its own replica, reads made on it are recorded
+    recorder = QueryRecorder()
+
+    def create_replica_db(self, host):
+        return ReplicaServer.recorder.wrap(self.db)
+
+
+class ReplicasTestCase(testing.ServerTestCase):
+    GAMESPACE_ID = 1
+    ACCOUNT_OWNER = 1
+    ACCOUNT_MEMBER = 2
+
+    @classmethod
+    def need_test_db(cls):
+        return True
+
+    @classmethod
+    def get_server_instance(cls, db=None):
+        replica_hosts = options.db_replica_hosts
+        options.db_replica_hosts = "test"
+
+        try:
+            return ReplicaServer(db)
+        finally:
+            options.db_replica_hosts = replica_hosts
+
+    @gen_test
+    async def test_routing(self):
+        groups = self.application.groups
+        expect = ReplicaServer.recorder.expect
+
+        # writes, and reads made by the methods that write, are made on the primary
+        with expect(queries=0):
+            group_id = await groups.create_group(
+                ReplicasTestCase.GAMESPACE_ID, {}, GroupFlags([]),
+                GroupJoinMethod(GroupJoinMethod.FREE), 50, ReplicasTestCase.ACCOUNT_OWNER, {})
+
+            await groups.join_group(ReplicasTestCase.GAMESPACE_ID, group_id, ReplicasTestCase.ACCOUNT_MEMBER, {})
+
+        with expect(queries=1) as replica:
+            await groups.get_group(ReplicasTestCase.GAMESPACE_ID, group_id)
+
+        self.assertEqual(replica.queries, 1)
+
+        # a session that has written something reads its own writes
+        token = begin()
+
+        try:
+            with expect(queries=1) as replica:
+                await groups.list_group_participants(ReplicasTestCase.GAMESPACE_ID, group_id)
+
+            await groups.leave_group(ReplicasTestCase.GAMESPACE_ID, group_id, ReplicasTestCase.ACCOUNT_MEMBER)
+
+            with expect(queries=0):
+                participants = await groups.list_group_participants(ReplicasTestCase.GAMESPACE_ID, group_id)
+        finally:
+            session.reset(token)
+
+        self.assertEqual(replica.queries, 1)
+        self.assertEqual(len(participants), 1)
+
+    @gen_test
+    async def test_fallback(self):
+        groups = self.application.groups
+        replica, = self.application.replicas.replicas
+
+        group_id = await groups.create_group(
+            ReplicasTestCase.GAMESPACE_ID, {}, GroupFlags([]),
+            GroupJoinMethod(GroupJoinMethod.FREE), 50, ReplicasTestCase.ACCOUNT_OWNER, {})
+
+        # the test database is not replicating, so it's never behind
+        await self.application.replicas.check()
+        self.assertTrue(replica.healthy)
+
+        replica.healthy = False
+
+        try:
+            with ReplicaServer.recorder.expect(queries=0):
+                await groups.get_group(ReplicasTestCase.GAMESPACE_ID, group_id)
+        finally:
+            replica.healthy = True
@@ -0,0 +1,138 @@
+from tornado.gen import multi
+from tornado.testing import gen_test
+
+from .. server import SocialServer
+from .. model.request import RequestType, RequestsModel
+
+from anthill.common import testing
+from .. import options as _opts
+
+import logging
+import time
+
+
+class FakeProfileService(object):
+    def __init__(self):
+        self.calls = []
+
+    async def request(self, service, method, accounts=None, profile_fields=None, **kwargs):
+        self.calls.append(list(accounts))
+        return {
+            str(account): {"name": "account " + str(account)}
+            for account in accounts
+        }
+
+
+class RequestsTestCase(testing.ServerTestCase):
+    GAMESPACE_ID = 1
+    ACCOUNT_A = 1
+    PENDING_REQUESTS = 500
+    FIRST_SENDER = 1000
+
+    @classmethod
+    def need_test_db(cls):
+        return True
+
+    @classmethod
+    def get_server_instance(cls, db=None):
+        return SocialServer(db)
+
+    async def __create_pending_requests__(self):
+        first = RequestsTestCase.FIRST_SENDER
+        senders = range(first, first + RequestsTestCase.PENDING_REQUESTS)
+
+        await multi([
+            self.application.requests.create_request(
+                RequestsTestCase.GAMESPACE_ID, sender, RequestType.ACCOUNT, RequestsTestCase.ACCOUNT_A, {})
+            for sender in senders
+        ])
+
+    @gen_test(timeout=60)
+    async def test_incoming_requests_profiles(self):
+        await self.__create_pending_requests__()
+
+        profiles = FakeProfileService()
+        self.application.requests.profiles.internal = profiles
+
+        started = time.perf_counter()
+        requests = await self.application.requests.list_incoming_account_requests(
+            RequestsTestCase.GAMESPACE_ID, RequestsTestCase.ACCOUNT_A, profile_fields=["name"])
+        first = time.perf_counter() - started
+
+        self.assertEqual(len(requests), RequestsTestCase.PENDING_REQUESTS)
+
+        for r in requests:
+            self.assertEqual(r.profile, {"name": "account " + r.account})
+
+        # profiles that were not cached yet are requested once, in one batch
+        self.assertLessEqual(len(profiles.calls), 1)
+        for accounts in profiles.calls:
+            self.assertEqual(len(accounts), len(set(accounts)))
+
+        calls = len(profiles.calls)
+
+        started = time.perf_counter()
+        for i in range(0, 10):
+            requests = await self.application.requests.list_total_account_requests(
+                RequestsTestCase.GAMESPACE_ID, RequestsTestCase.ACCOUNT_A, profile_fields=["name"])
+        cached = (time.perf_counter() - started) / 10
+
+        self.assertEqual(len(profiles.calls), calls, "Cached profiles should not be requested again")
+        self.assertTrue(all(r.profile is not None for r in requests))
+
+        logging.info("Listing {0} requests: {1:.1f}ms first, {2:.1f}ms cached".format(
+            len(requests), first * 1000, cached * 1000))
+
+    @gen_test(timeout=60)
+    async def test_total_requests_pages(self):
+        account = RequestsTestCase.ACCOUNT_A + 1
+
+        await multi([
+            self.application.requests.create_request(
+                RequestsTestCase.GAMESPACE_ID, sender, RequestType.ACCOUNT, account, {"n": sender})
+            for sender in range(2000, 2025)
+        ])
+
+        await multi([
+            self.application.requests.create_request(
+                RequestsTestCase.GAMESPACE_ID, account, RequestType.ACCOUNT, target, {"n": target})
+            for target in range(3000, 3015)
+        ])
+
+        everything = await self.application.requests.list_total_account_requests(
+            RequestsTestCase.GAMESPACE_ID, account)
+
+        self.assertEqual(len(everything), 40)
+
+        pages = []
+        cursor = None
+
+        while True:
+            page = await self.application.requests.list_total_account_requests(
+                RequestsTestCase.GAMESPACE_ID, account, limit=7, cursor=cursor)
+            pages.extend(page)
+            if len(page) < 7:
+                break
+            cursor = RequestsModel.cursor(page[-1])
+
+        self.assertEqual([(r.account, r.object) for r in pages], [(r.account, r.object) for r in everything])
+        self.assertTrue(all(isinstance(r.payload, dict) for r in pages))
+
+    @gen_test
+    async def test_requests_without_remote_account(self):
+        account = 77
+
+        await self.application.requests.create_request(
+            RequestsTestCase.GAMESPACE_ID, account, RequestType.ACCOUNT, 0, {})
+
+        profiles = FakeProfileService()
+        self.application.requests.profiles.internal = profiles
+
+        requests = await self.application.requests.list_outgoing_account_requests(
+            RequestsTestCase.GAMESPACE_ID, account, profile_fields=["name"])
+
+        self.assertEqual(len(requests), 1)
+        self.assertIsNone(requests[0].profile)
+
+        # no account to look the profile up for
+        self.assertEqual(profiles.calls, [])
@@ -0,0 +1,98 @@
+from tornado.testing import gen_test
+
+from .. server import SocialServer
+from .. model.social import SocialAPI
+from .. benchmarks.stubs import FakeServices
+
+from anthill.common import testing
+from .. import options as _opts
+
+import datetime
+
+
+class FriendsAPI(SocialAPI):
+    """
+    A social network where everyone has the same friends
+    """
+
+    CREDENTIAL = "test"
+
+    def __init__(self, application, tokens, cache, friends):
+        super(FriendsAPI, self).__init__(application, tokens, FriendsAPI.CREDENTIAL, cache)
+        self.friends = friends
+
+    def has_friend_list(self):
+        return True
+
+    async def list_friends(self, gamespace, account_id):
+        return self.friends
+
+
+class SocialConnectionsTestCase(testing.AcceptanceTestCase):
+    ACCOUNT_A = 1
+    ACCOUNT_B = 2
+    ACCOUNT_C = 3
+    ACCOUNT_D = 4
+
+    @classmethod
+    def need_test_db(cls):
+        return True
+
+    @classmethod
+    def need_access_token(cls):
+        return ["social"]
+
+    @classmethod
+    def get_server_instance(cls, db=None):
+        return SocialServer(db)
+
+    @classmethod
+    async def co_setup_acceptance_tests(cls):
+        application = cls.application
+        gamespace_id = int(testing.AcceptanceTestCase.TOKEN_GAMESPACE)
+        expires_at = datetime.datetime.now() + datetime.timedelta(days=1)
+
+        application.social.register(FriendsAPI(application, application.tokens, application.cache, {
+            "user2": {"name": "User 2"},
+            "user3": {"name": "User 3"},
+            "stranger": {"name": "Not playing"}
+        }))
+
+        # profiles of the connections are requested from the profile service
+        application.social.internal = FakeServices()
+
+        for account_id, username in [(SocialConnectionsTestCase.ACCOUNT_A, "user1"),
+                                     (SocialConnectionsTestCase.ACCOUNT_B, "user2"),
+                                     (SocialConnectionsTestCase.ACCOUNT_C, "user3")]:
+            await application.tokens.update_token(
+                gamespace_id, FriendsAPI.CREDENTIAL, username, "token" + str(account_id), expires_at, {})
+            await application.tokens.attach(gamespace_id, FriendsAPI.CREDENTIAL, username, account_id)
+
+        # and a friend made in game
+        await application.connections.create_many(gamespace_id, [
+            [SocialConnectionsTestCase.ACCOUNT_A, SocialConnectionsTestCase.ACCOUNT_D]
+        ])
+
+        async with application.cache.acquire() as db:
+            await db.delete("friends:{0}:{1}".format(gamespace_id, SocialConnectionsTestCase.ACCOUNT_A))
+
+    @gen_test
+    async def test_connections(self):
+        result = await self.get_success(
+            "connections", query_args={"access_token": self.access_token}, pass_access_token=False)
+
+        connections = result["connections"]
+
+        self.assertEqual(set(connections.keys()), {"2", "3", "4"})
+
+        self.assertEqual(connections["2"]["credentials"], {
+            "test:user2": {"social": {"name": "User 2"}}
+        })
+        self.assertEqual(connections["2"]["profile"], {"name": "Player 2"})
+        self.assertEqual(connections["3"]["credentials"], {
+            "test:user3": {"social": {"name": "User 3"}}
+        })
+
+        # connected in game only
+        self.assertEqual(connections["4"]["credentials"], {})
+        self.assertEqual(connections["4"]["profile"], {"name": "Player 4"})
@@ -0,0 +1,234 @@
+"""
+Tracing of slow requests: every request (and every incoming internal call) gets a tree of spans, one per model method,
+    database statement, cache command, request to other services and social network API call made on its behalf,
+    with timings. Traces of requests that took longer than a threshold are kept in a ring buffer (see the admin page)
+    and, optionally, appended to a file, one JSON object per line.
+
+Spans are made at the same points metrics are collected (see Metrics.time), so tracing requires the 'metrics' option.
+"""
+
+import collections
+import contextvars
+import logging
+import random
+import re
+import time
+
+import ujson
+
+
+# (Trace, Span) of the code being executed, or None if it's not traced
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span(object):
+    __slots__ = ("name", "tags", "started", "duration", "error", "children")
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self.started = time.perf_counter()
+        self.duration = None
+        self.error = False
+        self.children = []
+
+    def finish(self, error=False):
+        self.duration = time.perf_counter() - self.started
+        self.error = error
+
+    def dump(self, trace_started):
+        return {
+            "name": self.name,
+            "tags": self.tags,
+            "start": round((self.started - trace_started) * 1000.0, 3),
+            "duration": round((self.duration or 0) * 1000.0, 3),
+            "error": self.error,
+            "children": [child.dump(trace_started) for child in self.children]
+        }
+
+
+class Trace(object):
+    def __init__(self, name, tags):
+        self.time = time.time()
+        self.root = Span(name, tags)
+        self.spans = 1
+        self.dropped = 0
+        self.finished = False
+
+    def dump(self):
+        return {
+            "time": self.time,
+            "name": self.root.name,
+            "duration": round(self.root.duration * 1000.0, 3),
+            "spans": self.spans,
+            "dropped": self.dropped,
+            "root": self.root.dump(self.root.started)
+        }
+
+
+class Tracer(object):
+    """
+    Traces are started with `start` (by the server, when a request is routed), and completed with `finish` in the
+        same context. Everything timed in between (see `span`) becomes a child of the innermost span being executed.
+
+    Whether a request is traced at all is decided at `start` (see `sample_rate`), whether the trace is kept
+        is decided at `finish` (see `threshold`).
+    """
+
+    # a span is named after a metric it's timed by, labels of the metric become tags of the span
+    SPAN_NAMES = {
+        "model_method_duration_seconds": "{operation}",
+        "db_statement_duration_seconds": "db.{statement}",
+        "cache_command_duration_seconds": "cache.{command}",
+        "internal_request_duration_seconds": "{kind} {service}.{method}",
+        "social_api_duration_seconds": "{provider}.{method}"
+    }
+
+    # a runaway trace (a long loop, or a background job spawned by the request) stops growing at this point
+    MAX_SPANS = 1000
+    MAX_STATEMENT_LENGTH = 500
+
+    def __init__(self, threshold, sample_rate=1.0, buffer_size=100, path=None):
+        """
+        :param threshold: traces of requests that took at least that long (in seconds) are kept
+        :param sample_rate: a share of requests to trace, from 0 to 1
+        :param buffer_size: how many recent traces to keep in memory
+        :param path: a file to append the traces to, if any
+        """
+
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.path = path
+        self.traces = collections.deque(maxlen=buffer_size)
+        self.last_id = 0
+
+    @staticmethod
+    def statement(query):
+        """
+        :returns a query in a single line, cut to MAX_STATEMENT_LENGTH, to be a tag of a span
+        """
+
+        query = re.sub(r"\s+", " ", query).strip()
+
+        if len(query) > Tracer.MAX_STATEMENT_LENGTH:
+            query = query[:Tracer.MAX_STATEMENT_LENGTH] + "..."
+
+        return query
+
+    def start(self, name, **tags):
+        """
+        Starts a trace in the current context, replacing the one that may be there already.
+
+        :returns a token to pass to `current_span.reset` if the context has to be restored afterwards
+        """
+
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return current_span.set(None)
+
+        trace = Trace(name, tags)
+        return current_span.set((trace, trace.root))
+
+    def finish(self, duration=None, error=False, **tags):
+        """
+        Completes the trace of the current context (if any), and keeps it if it took longer than the threshold.
+
+        :param duration: how long the request took (in seconds), if known better than from the start of the trace
+        :param tags: more tags to the root span
+        """
+
+        current = current_span.get()
+
+        if current is None:
+            return
+
+        trace, _ = current
+
+        if trace.finished:
+            return
+
+        trace.finished = True
+        trace.root.finish(error)
+        trace.root.tags.update(tags)
+
+        if duration is not None:
+            trace.root.duration = duration
+
+        if trace.root.duration >= self.threshold:
+            self.__keep__(trace.dump())
+
+    def __keep__(self, data):
+        self.last_id += 1
+        data["id"] = self.last_id
+        self.traces.append(data)
+
+        if not self.path:
+            return
+
+        # slow traces are rare, and a single short write is cheaper than a thread to do it
+        try:
+            with open(self.path, "a") as f:
+                f.write(ujson.dumps(data, escape_forward_slashes=False) + "\n")
+        except OSError as e:
+            logging.warning("Failed to write a trace to {0}: {1}".format(self.path, str(e)))
+
+    async def span(self, metric, awaitable, extra=None, **labels):
+        """
+        Awaits the awaitable as a child span of the current one, if the current context is traced
+        """
+
+        current = current_span.get()
+
+        if current is None:
+            return await awaitable
+
+        trace, parent = current
+
+        if trace.finished:
+            return await awaitable
+
+        if trace.spans >= Tracer.MAX_SPANS:
+            trace.dropped += 1
+            return await awaitable
+
+        template = Tracer.SPAN_NAMES.get(metric)
+        name = template.format(**labels) if template else metric
+        # which operation that is, is told by the parent span already
+        tags = {key: value for key, value in labels.items() if key != "operation"}
+
+        if extra:
+            tags.update(extra)
+
+        span = Span(name, tags)
+        parent.children.append(span)
+        trace.spans += 1
+
+        token = current_span.set((trace, span))
+        error = False
+
+        try:
+            return await awaitable
+        except Exception:
+            error = True
+            raise
+        finally:
+            span.finish(error)
+            current_span.reset(token)
+
+    def recent(self, limit=None):
+        """
+        :returns the traces being kept, the most recent first
+        """
+
+        traces = list(reversed(self.traces))
+        return traces[:limit] if limit else traces
+
+    def get(self, trace_id):
+        """
+        :returns a trace being kept, or None if there's no such (anymore)
+        """
+
+        for trace in self.traces:
+            if trace["id"] == trace_id:
+                return trace
+
+        return None